@@ -0,0 +1,84 @@
+"""
+Compares keeping location history in an archive against keeping the JSON
+responses and parsing them again: the size on disk, and the time to load
+an hour of one device's history.
+
+    $ python benchmarks/bench_archive.py [points] [devices]
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from geoloqi.archive import ArchiveReader, ArchiveWriter
+from geoloqi.track import LocationTrack
+from server import fake_point
+
+
+def timed(func, n):
+    start = time.time()
+    for i in xrange(n):
+        result = func(i)
+    return (time.time() - start) / n, result
+
+
+def main(n=200000, devices=10, page_size=500):
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'history.glq')
+        json_size = 0
+        pages = {}
+        start = time.time()
+        with ArchiveWriter(path) as archive:
+            for offset in xrange(0, n / devices, page_size):
+                for device in xrange(devices):
+                    page = [fake_point(i) for i in
+                            xrange(offset, min(n / devices, offset + page_size))]
+                    body = json.dumps({'points': page})
+                    json_size += len(body)
+                    if device == 0:
+                        pages[offset] = body
+                    archive.write(page, device)
+        print 'write      %8.3f s for %d points' % (time.time() - start, n)
+        print 'size       %8.1f bytes per point archived, %.1f as JSON' % (
+                os.path.getsize(path) / float(n), json_size / float(n))
+
+        elapsed, archive = timed(lambda i: ArchiveReader(path), 10)
+        print 'open       %8.3f ms (%d blocks indexed)' % (1000 * elapsed,
+                sum(len(blocks) for blocks in archive.blocks.values()))
+
+        # An hour of one device's points, starting at different times
+        first = fake_point(0)['date_ts']
+        span = (n / devices) * 10 - 3600
+        m = 200
+        hour = lambda i: first + span * i / m
+
+        elapsed, track = timed(lambda i: archive.read(0, hour(i), hour(i) + 3600), m)
+        print 'read       %8.3f ms per hour (%d points)' % (1000 * elapsed, len(track))
+        elapsed, points = timed(lambda i: list(archive.scan(0, hour(i), hour(i) + 3600)), m)
+        print 'scan       %8.3f ms per hour' % (1000 * elapsed)
+
+        def parse(i):
+            # The pages holding the hour, parsed and sliced
+            track = LocationTrack()
+            offset = (hour(i) - first) / 10 // page_size * page_size
+            while offset in pages:
+                track.extend(json.loads(pages[offset])['points'])
+                if track.timestamp[-1] >= hour(i) + 3600:
+                    break
+                offset += page_size
+            return track.between(hour(i), hour(i) + 3600)
+
+        elapsed, track = timed(parse, m)
+        print 'json       %8.3f ms per hour (%d points)' % (1000 * elapsed, len(track))
+        archive.close()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,80 @@
+"""
+Compares the NumPy calculations of `geoloqi.geo` against looping over
+history points with the scalar `distance` function.
+
+    $ python benchmarks/bench_geo.py [points] [places]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from geoloqi import geo
+from geoloqi.location import distance, position
+from server import fake_place, fake_point
+
+
+def timed(func, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(name, scalar, vectorized):
+    print '%-16s scalar %9.3fms  numpy %9.3fms  %6.1fx' % (name,
+            1000 * scalar, 1000 * vectorized, scalar / vectorized)
+
+
+def scalar_track(points):
+    positions = [position(point) for point in points]
+    return [distance(a[0], a[1], b[0], b[1])
+            for a, b in zip(positions, positions[1:])]
+
+
+def scalar_matrix(points, others):
+    return [[distance(a[0], a[1], b[0], b[1]) for b in others]
+            for a in points]
+
+
+def scalar_within(points, places):
+    positions = [position(point) for point in points]
+    return [[distance(lat, lng, place['latitude'], place['longitude'])
+            <= place['radius'] for place in places] for lat, lng in positions]
+
+
+def main(n=100000, m=1000):
+    history = {'points': [fake_point(i) for i in xrange(n)]}
+    rand = random.Random(1)
+    for point in history['points']:
+        pos = point['location']['position']
+        pos['latitude'] = 45.5 + rand.uniform(0, 0.1)
+        pos['longitude'] = -122.6 - rand.uniform(0, 0.1)
+    places = [fake_place(i) for i in xrange(m)]
+    pairs = [position(point) for point in history['points'][:m]]
+
+    report('coordinates', timed(lambda: [position(point)
+            for point in history['points']]),
+            timed(lambda: geo.coordinates(history)))
+    report('track', timed(lambda: scalar_track(history['points'])),
+            timed(lambda: geo.track_distances(history)))
+
+    lat, lng = geo.coordinates(history)
+    report('track (arrays)', timed(lambda: scalar_track(history['points'])),
+            timed(lambda: geo.haversine(lat[:-1], lng[:-1], lat[1:], lng[1:])))
+    report('matrix %dx%d' % (m, m), timed(lambda: scalar_matrix(pairs, pairs), 1),
+            timed(lambda: geo.distance_matrix(pairs)))
+
+    points = history['points'][:n / 10]
+    report('within %dx%d' % (len(points), m),
+            timed(lambda: scalar_within(points, places), 1),
+            timed(lambda: geo.within(points, places)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,61 @@
+"""
+Compares per-call latency of a fresh `urllib2.urlopen` connection against
+the pooled keep-alive transport used by `Session`.
+
+    $ python benchmarks/bench_pool.py [requests]
+"""
+import os
+import ssl
+import sys
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from geoloqi.geoloqi import API_VERSION, Session
+from geoloqi.pool import ConnectionPool
+from server import FakeGeoloqiServer
+
+
+def timed(func, n):
+    timings = []
+    for i in xrange(n):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings
+
+
+def report(name, timings):
+    print '%-10s mean %7.3fms  p50 %7.3fms  p99 %7.3fms' % (name,
+            1000 * sum(timings) / len(timings),
+            1000 * timings[len(timings) / 2],
+            1000 * timings[int(len(timings) * 0.99)])
+
+
+def main(n=500):
+    context = ssl._create_unverified_context()
+    server = FakeGeoloqiServer(https=True).start()
+    try:
+        url = server.url_template % (API_VERSION, 'account/profile')
+
+        def unpooled():
+            urllib2.urlopen(url, context=context).read()
+
+        session = Session(access_token='benchmark',
+                pool=ConnectionPool(context=context))
+        session.url_template = server.url_template
+
+        def pooled():
+            session.get('account/profile')
+
+        report('urlopen', timed(unpooled, n))
+        report('pooled', timed(pooled, n))
+        session.pool.clear()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,228 @@
+"""
+Measures the throughput, tail latency, memory and CPU use of `Session`
+requests against the fake API server, run in a separate process so its
+work isn't counted against the client. Each endpoint is requested
+sequentially, from a pool of threads and in batches, and the results are
+written as JSON so they can be compared between runs.
+
+    $ python benchmarks/bench_requests.py [options] > results.json
+"""
+import json
+import optparse
+import os
+import resource
+import ssl
+import subprocess
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from geoloqi.batch import Batch
+from geoloqi.geoloqi import Session
+from geoloqi.pool import ConnectionPool
+from geoloqi.version import __version__
+from server import fake_point
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+SCENARIOS = [
+    ('location/history', 'get', lambda options: {'count': options.payload}),
+    ('place/list', 'get', lambda options: {'count': options.payload}),
+    ('location/update', 'post', lambda options: [fake_point(0)]),
+]
+
+
+def rss():
+    """
+    Read the process's resident set size in kilobytes, or None where
+    `/proc` isn't available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    n = len(timings)
+    return {
+        'mean': 1000 * sum(timings) / n,
+        'p50': 1000 * timings[n // 2],
+        'p95': 1000 * timings[min(n - 1, int(n * 0.95))],
+        'p99': 1000 * timings[min(n - 1, int(n * 0.99))],
+        'max': 1000 * timings[-1],
+    }
+
+
+def is_error(response):
+    return not isinstance(response, (dict, list)) or \
+            (isinstance(response, dict) and response.has_key('error'))
+
+
+def sequential(session, method, path, args, n, options):
+    timings, errors = [], 0
+    for i in xrange(n):
+        start = time.time()
+        response = getattr(session, method)(path, args)
+        timings.append(time.time() - start)
+        errors += is_error(response)
+    return timings, errors
+
+
+def threaded(session, method, path, args, n, options):
+    def call(i):
+        start = time.time()
+        try:
+            response = getattr(session, method)(path, args)
+        except Exception, e:
+            response = e
+        return time.time() - start, is_error(response)
+
+    pool = ThreadPool(options.threads)
+    try:
+        results = pool.map(call, xrange(n))
+    finally:
+        pool.close()
+        pool.join()
+    return [timing for timing, error in results], \
+            sum(error for timing, error in results)
+
+
+def batched(session, method, path, args, n, options):
+    # Every call in a batch waits for the whole batch, so each is timed as
+    # the batch's latency.
+    timings, errors = [], 0
+    for offset in xrange(0, n, options.batch_size):
+        size = min(options.batch_size, n - offset)
+        batch = Batch(session, per_request_limit=options.batch_size)
+        for i in xrange(size):
+            getattr(batch, method)(path, args)
+
+        start = time.time()
+        responses = batch.run()
+        elapsed = time.time() - start
+        timings.extend([elapsed] * size)
+        errors += sum(is_error(response) for response in responses)
+    return timings, errors
+
+
+MODES = [
+    ('sequential', sequential),
+    ('threaded', threaded),
+    ('batched', batched),
+]
+
+
+def measure(session, mode, func, path, method, args, options):
+    """
+    Run one scenario in one mode.
+
+    Returns:
+        A dictionary of the scenario's results, including the phase
+        latencies the session recorded in its metrics.
+    """
+    # Warm up the connections and the token
+    func(session, method, path, args, min(options.threads, options.requests),
+            options)
+
+    session.metrics.reset()
+    rss_before = rss()
+    times_before = os.times()
+    start = time.time()
+    timings, errors = func(session, method, path, args, options.requests, options)
+    elapsed = time.time() - start
+    times_after = os.times()
+    rss_after = rss()
+
+    cpu = (times_after[0] - times_before[0]) + (times_after[1] - times_before[1])
+    rss_delta = None
+    if rss_before is not None:
+        rss_delta = rss_after - rss_before
+    return {
+        'endpoint': path,
+        'method': method.upper(),
+        'mode': mode,
+        'requests': len(timings),
+        'errors': errors,
+        'elapsed': elapsed,
+        'throughput': len(timings) / elapsed,
+        'latency_ms': summarize(timings),
+        'cpu_ms_per_request': 1000 * cpu / len(timings),
+        'rss_kb': rss_after,
+        'rss_delta_kb': rss_delta,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'session_metrics': session.metrics.stats(),
+    }
+
+
+def start_server(options):
+    args = [sys.executable, SERVER, '--latency', str(options.latency),
+            '--payload', str(options.payload)]
+    if not options.https:
+        args.append('--http')
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    return process, process.stdout.readline().strip()
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--requests', type='int', default=500,
+            help='requests per endpoint and mode')
+    parser.add_option('--threads', type='int', default=8,
+            help='threads used by the threaded mode')
+    parser.add_option('--batch-size', type='int', default=50,
+            help='calls per request in the batched mode')
+    parser.add_option('--latency', type='float', default=0,
+            help='seconds the server waits before answering')
+    parser.add_option('--payload', type='int', default=100,
+            help='items in list responses')
+    parser.add_option('--https', action='store_true', default=False,
+            help='talk to the server over TLS')
+    parser.add_option('--modes', default=','.join(name for name, func in MODES),
+            help='comma separated modes to run')
+    parser.add_option('-o', '--output', help='write the results to a file')
+    options, args = parser.parse_args()
+
+    process, url_template = start_server(options)
+    try:
+        Session.url_template = url_template
+        context = options.https and ssl._create_unverified_context() or None
+        session = Session('benchmark-key', 'benchmark-secret',
+                pool=ConnectionPool(maxsize=options.threads, context=context))
+
+        modes = options.modes.split(',')
+        results = []
+        for path, method, args in SCENARIOS:
+            for mode, func in MODES:
+                if mode in modes:
+                    results.append(measure(session, mode, func, path, method,
+                            args(options), options))
+        session.pool.clear()
+    finally:
+        process.terminate()
+        process.wait()
+
+    config = dict(vars(options))
+    config.pop('output')
+    report = {
+        'python': sys.version.split()[0],
+        'geoloqi': __version__,
+        'timestamp': int(time.time()),
+        'config': config,
+        'results': results,
+    }
+
+    output = options.output and open(options.output, 'w') or sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if options.output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Measures how long new processes take to construct a `Geoloqi` client from
+application credentials, with and without the on-disk token cache.
+
+    $ python benchmarks/bench_startup.py [processes] [latency]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from server import FakeGeoloqiServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CHILD = """
+import sys, time
+sys.path.insert(0, %(root)r)
+from geoloqi.geoloqi import Geoloqi, Session
+from geoloqi.tokens import TokenCache
+Session.url_template = %(url_template)r
+kwargs = %(cache)r and {'token_cache': TokenCache(%(cache)r)} or {}
+start = time.time()
+Geoloqi('benchmark-key', 'benchmark-secret', **kwargs)
+print time.time() - start
+"""
+
+
+def startup(url_template, cache, n):
+    code = CHILD % {'root': ROOT, 'url_template': url_template, 'cache': cache}
+    timings = [float(subprocess.check_output([sys.executable, '-c', code]))
+            for i in xrange(n)]
+    timings.sort()
+    return timings
+
+
+def report(name, timings):
+    print '%-12s mean %7.3fms  p50 %7.3fms  max %7.3fms' % (name,
+            1000 * sum(timings) / len(timings),
+            1000 * timings[len(timings) / 2],
+            1000 * timings[-1])
+
+
+def main(n=20, latency=0.02):
+    server = FakeGeoloqiServer(https=False, latency=latency).start()
+    tempdir = tempfile.mkdtemp()
+    try:
+        cache = os.path.join(tempdir, 'tokens')
+        report('no cache', startup(server.url_template, None, n))
+        report('token cache', startup(server.url_template, cache, n))
+    finally:
+        server.stop()
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    n = len(sys.argv) > 1 and int(sys.argv[1]) or 20
+    latency = len(sys.argv) > 2 and float(sys.argv[2]) or 0.02
+    main(n, latency)
@@ -0,0 +1,72 @@
+"""
+Measures the memory each user takes in a `MultiUserGeoloqi`, compared to
+creating a `Geoloqi` client per user, and the cost of acting as a user.
+
+    $ python benchmarks/bench_tenants.py [users]
+"""
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from geoloqi.geoloqi import Geoloqi, Session
+from geoloqi.tenants import MultiUserGeoloqi
+from server import FakeGeoloqiServer
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def per_user(func, n):
+    gc.collect()
+    before = rss()
+    kept = func(n)
+    gc.collect()
+    return (rss() - before) / float(n), kept
+
+
+def main(n=100000):
+    server = FakeGeoloqiServer(https=False).start()
+    Session.url_template = server.url_template
+    try:
+        client = MultiUserGeoloqi('benchmark-key', 'benchmark-secret',
+                maxsize=n)
+
+        def registry(n):
+            for user_id in xrange(n):
+                client.add_user(user_id, 'token-%d' % user_id,
+                        'refresh-%d' % user_id, time.time() + 3600)
+            return client
+
+        def clients(n):
+            return [Geoloqi(access_token='token-%d' % user_id)
+                    for user_id in xrange(n)]
+
+        size, kept = per_user(registry, n)
+        print 'registry     %8.0f bytes per user (%d users)' % (size, n)
+        m = min(n, 5000)
+        size, kept = per_user(clients, m)
+        print 'clients      %8.0f bytes per user (%d users)' % (size, m)
+        del kept
+
+        start = time.time()
+        for user_id in xrange(n):
+            client.as_user(user_id)
+        print 'as_user      %8.3f us per call' % (1e6 * (time.time() - start) / n)
+
+        m = min(n, 1000)
+        start = time.time()
+        for user_id in xrange(m):
+            client.as_user(user_id).get('account/profile')
+        print 'as_user.get  %8.3f ms per call' % (1000 * (time.time() - start) / m)
+        client.session.pool.clear()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
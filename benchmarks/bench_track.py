@@ -0,0 +1,79 @@
+"""
+Compares the memory taken by location history kept as the dictionaries the
+API returns against a `LocationTrack`, and the cost of slicing it by time.
+
+    $ python benchmarks/bench_track.py [points]
+"""
+import gc
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from geoloqi.track import LocationTrack
+from server import fake_point
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def pages(n, page_size=500):
+    # Pages decoded from JSON, as Session.run returns them
+    for start in xrange(0, n, page_size):
+        yield json.loads(json.dumps([fake_point(i)
+                for i in xrange(start, min(n, start + page_size))]))
+
+
+def measure(build, n):
+    gc.collect()
+    before = rss()
+    start = time.time()
+    kept = build(n)
+    elapsed = time.time() - start
+    gc.collect()
+    return (rss() - before) / float(n), elapsed, kept
+
+
+def main(n=200000):
+    def dicts(n):
+        points = []
+        for page in pages(n):
+            points.extend(page)
+        return points
+
+    def track(n):
+        track = LocationTrack()
+        for page in pages(n):
+            track.extend(page)
+        return track
+
+    # The track is built first, so it can't reuse memory the dicts freed
+    size, elapsed, kept = measure(track, n)
+    print 'track      %8.1f bytes per point  %6.2fs to build (%d bytes of arrays)' % (
+            size, elapsed, kept.nbytes())
+
+    size, elapsed, points = measure(dicts, n)
+    print 'dicts      %8.1f bytes per point  %6.2fs to build' % (size, elapsed)
+    del points
+
+    first, last = kept.timestamp[0], kept.timestamp[-1]
+    m = 1000
+    start = time.time()
+    for i in xrange(m):
+        lower = first + (last - first) * i / m
+        kept.find(lower)
+    print 'find       %8.3f us per search' % (1e6 * (time.time() - start) / m)
+
+    start = time.time()
+    for i in xrange(m):
+        lower = first + (last - first) * i / m
+        kept.between(lower, lower + 3600)
+    print 'between    %8.3f us per hour sliced' % (1e6 * (time.time() - start) / m)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
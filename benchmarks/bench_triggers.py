@@ -0,0 +1,89 @@
+"""
+Measures building a `TriggerIndex` of many radius triggers, finding the
+triggers containing a point compared to checking every trigger, and
+following devices through them with a `TriggerTracker`.
+
+    $ python benchmarks/bench_triggers.py [triggers] [fixes]
+"""
+import gc
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from geoloqi.location import distance
+from geoloqi.triggers import TriggerIndex, TriggerTracker
+
+# Triggers are spread over a metro area about 110 by 80 kilometers
+AREA = (45.0, 46.0, -123.5, -122.5)
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def fake_trigger(n, rand):
+    return {
+        'trigger_id': 'trigger-%d' % n,
+        'latitude': rand.uniform(AREA[0], AREA[1]),
+        'longitude': rand.uniform(AREA[2], AREA[3]),
+        'radius': rand.choice([50, 100, 150, 250, 500, 1000]),
+    }
+
+
+def linear(triggers, latitude, longitude):
+    return [trigger for trigger in triggers
+            if distance(latitude, longitude, trigger['latitude'],
+                    trigger['longitude']) <= trigger['radius']]
+
+
+def main(n=300000, fixes=100000):
+    rand = random.Random(1)
+    triggers = [fake_trigger(i, rand) for i in xrange(n)]
+    points = [(rand.uniform(AREA[0], AREA[1]), rand.uniform(AREA[2], AREA[3]))
+            for i in xrange(fixes)]
+
+    gc.collect()
+    before = rss()
+    start = time.time()
+    index = TriggerIndex(triggers)
+    elapsed = time.time() - start
+    gc.collect()
+    print 'build        %8.3f s for %d triggers (%d cells, %.0f bytes per trigger)' % (
+            elapsed, n, sum(len(grid) for grid in index.grids), (rss() - before) / float(n))
+
+    start = time.time()
+    found = 0
+    for latitude, longitude in points:
+        found += len(index.containing(latitude, longitude))
+    elapsed = time.time() - start
+    print 'containing   %8.3f us per point (%.2f triggers per point)' % (
+            1e6 * elapsed / fixes, found / float(fixes))
+
+    m = min(fixes, 20)
+    start = time.time()
+    for latitude, longitude in points[:m]:
+        linear(triggers, latitude, longitude)
+    print 'linear scan  %8.3f us per point' % (1e6 * (time.time() - start) / m)
+
+    # Devices drive around at about 15 meters a second, one fix a second
+    tracker = TriggerTracker(index)
+    devices = [list(point) for point in points[:100]]
+    transitions = 0
+    start = time.time()
+    for i in xrange(fixes):
+        position = devices[i % len(devices)]
+        position[0] += rand.uniform(-0.0002, 0.0002)
+        position[1] += rand.uniform(-0.0002, 0.0002)
+        entered, exited = tracker.update(position[0], position[1], i % len(devices))
+        transitions += len(entered) + len(exited)
+    elapsed = time.time() - start
+    print 'tracker      %8.3f us per fix (%d transitions for %d devices)' % (
+            1e6 * elapsed / fixes, transitions, len(devices))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,229 @@
+"""
+A local stand-in for the Geoloqi API server, used by the benchmarks.
+
+Run it on its own to serve requests from another process:
+
+    $ python benchmarks/server.py [--http] [--latency SECONDS] [--payload COUNT]
+"""
+import BaseHTTPServer
+import json
+import optparse
+import os
+import shutil
+import signal
+import socket
+import SocketServer
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+
+def fake_point(n):
+    """
+    Build the nth point of a fake location history.
+    """
+    ts = 1325376000 + n * 10
+    return {
+        'uuid': 'point-%d' % n,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(ts)),
+        'date_ts': ts,
+        'location': {
+            'type': 'point',
+            'position': {
+                'latitude': 45.5165 + n * 0.00001,
+                'longitude': -122.6764 - n * 0.00001,
+                'speed': 3,
+                'altitude': 50,
+                'heading': 90,
+                'horizontal_accuracy': 10,
+                'vertical_accuracy': 20,
+            },
+        },
+        'raw': {'battery': 80},
+    }
+
+
+def fake_place(n):
+    """
+    Build the nth place of a fake place list.
+    """
+    return {
+        'place_id': 'place-%d' % n,
+        'layer_id': 'layer-1',
+        'name': 'Place %d' % n,
+        'latitude': 45.5 + (n % 100) * 0.001,
+        'longitude': -122.6 - (n // 100) * 0.001,
+        'radius': 100,
+        'extra': {},
+    }
+
+
+class FakeGeoloqiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers requests with JSON documents shaped like the API's over a
+    keep-alive HTTP/1.1 connection. List endpoints return the server's
+    `payload_size` items unless the request asks for fewer with `count`.
+    """
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.respond(None)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.respond(self.rfile.read(length))
+
+    def respond(self, data):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        # Strip the API version from the path
+        path = self.path.split('/', 2)[-1]
+        if path.split('?', 1)[0] == 'batch/run':
+            jobs = json.loads(data)['batch']
+            body = '{"result": [%s]}' % ', '.join(
+                    json.dumps({'body': self.server.get_body(job['relative_url'],
+                            job.get('body'))}) for job in jobs)
+        else:
+            body = self.server.get_body(path, data)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGeoloqiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A threaded HTTP(S) server listening on a random local port.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, https=True, latency=0, payload_size=100,
+            handler=FakeGeoloqiHandler):
+        """
+        Create a new fake API server.
+
+        Args:
+            https: Serve over TLS using a throwaway self-signed certificate.
+            latency: Seconds to sleep before answering each request.
+            payload_size: The number of items in list responses.
+            handler: The request handler class.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.https = https
+        self.latency = latency
+        self.payload_size = payload_size
+        self.thread = None
+        self.bodies = {}
+
+        if https:
+            self.certdir = tempfile.mkdtemp()
+            certfile = os.path.join(self.certdir, 'cert.pem')
+            subprocess.check_call(['openssl', 'req', '-x509', '-nodes',
+                    '-newkey', 'rsa:2048', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', certfile, '-out', certfile],
+                    stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+            self.socket = ssl.wrap_socket(self.socket, certfile=certfile,
+                    server_side=True)
+
+    def get_body(self, path, data=None):
+        """
+        Build the JSON response body for a request. List responses are
+        built once per size and reused, so the server's own work stays
+        small next to the client's.
+
+        Args:
+            path: The requested path without the API version.
+            data: The POST body, if any.
+
+        Returns:
+            The response body as a string.
+        """
+        path, query = (path.split('?', 1) + [''])[:2]
+        count = urlparse.parse_qs(query).get('count', [self.payload_size])[0]
+        count = min(int(count), self.payload_size)
+
+        if path == 'oauth/token':
+            return json.dumps({
+                'access_token': 'fake-access-token',
+                'refresh_token': 'fake-refresh-token',
+                'expires_in': 3600,
+            })
+        if path not in ('location/history', 'place/list'):
+            return '{"result": "ok"}'
+
+        key = (path, count)
+        body = self.bodies.get(key)
+        if body is None:
+            if path == 'location/history':
+                body = json.dumps({'points': map(fake_point, xrange(count))})
+            else:
+                body = json.dumps({'places': map(fake_place, xrange(count)),
+                        'paging': {'next_offset': None}})
+            self.bodies[key] = body
+        return body
+
+    def handle_error(self, request, client_address):
+        # Clients dropping idle keep-alive connections is expected.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def url_template(self):
+        """
+        The URL template to assign to `Session.url_template`.
+        """
+        scheme = self.https and 'https' or 'http'
+        return '%s://127.0.0.1:%d/%%d/%%s' % (scheme, self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.shutdown()
+        self.server_close()
+        if self.https:
+            shutil.rmtree(self.certdir, ignore_errors=True)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--http', action='store_false', dest='https', default=True,
+            help='serve plain HTTP instead of HTTPS')
+    parser.add_option('--latency', type='float', default=0,
+            help='seconds to wait before answering each request')
+    parser.add_option('--payload', type='int', default=100,
+            help='the number of items in list responses')
+    options, args = parser.parse_args()
+
+    server = FakeGeoloqiServer(options.https, options.latency, options.payload)
+    print server.url_template
+    sys.stdout.flush()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+"""
+Compact, append-only files of location history that are read through a
+memory map.
+
+An archive starts with a short header and is followed by blocks, each
+holding points of one device in time order. A block has a header giving
+its device, number of points and time range, and then the points'
+`LocationTrack` columns one after another as little-endian arrays. Blocks
+are only ever appended, and a block left incomplete by a crash is ignored
+and overwritten by the next write.
+"""
+import array
+import bisect
+import mmap
+import os
+import struct
+import sys
+
+from collections import namedtuple
+from track import COLUMNS, LocationTrack, TrackPoint
+
+MAGIC = 'GLQA'
+VERSION = 1
+BLOCK_MAGIC = 'GLQB'
+
+# The archive header: magic, version and padding
+HEADER = struct.Struct('<4sH2x')
+# A block header: magic, device name length, point count, first and last time
+BLOCK = struct.Struct('<4sHIdd')
+
+Block = namedtuple('Block', 'device start end count offset')
+
+
+def align(offset):
+    """
+    Round an offset up so the columns after it are 8-byte aligned.
+    """
+    return (offset + 7) & ~7
+
+
+def device_name(device):
+    """
+    Find the name a device is archived under. Devices are identified by
+    text, so a device 42 is archived as u'42'.
+    """
+    if device is None or device == '':
+        return None
+    return unicode(device)
+
+
+def point_size():
+    return sum(array.array(code).itemsize for name, code, key in COLUMNS)
+
+
+class ArchiveReader:
+    """
+    Reads an archive written by `ArchiveWriter` through a read-only memory
+    map, so only the parts of it that are used are read from disk, and
+    nothing is parsed or decoded.
+
+    Opening an archive builds an index of each device's blocks and their
+    time ranges from the block headers. A time range is then found with a
+    binary search of the timestamps inside the blocks that overlap it.
+
+    ::
+
+        >>> with ArchiveReader('history.glq') as archive:
+        ...     track = archive.read('truck-12', 1331020800, 1331064000)
+    """
+
+    def __init__(self, path):
+        """
+        Open an archive.
+
+        Args:
+            path: The archive's file name.
+
+        Raises:
+            ValueError: If the file isn't an archive.
+        """
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = None
+        self.blocks = {}
+        self.size = HEADER.size
+        self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return sum(block.count for blocks in self.blocks.values()
+                for block in blocks)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def refresh(self):
+        """
+        Map the archive again and index any blocks appended since it was
+        opened.
+        """
+        length = os.fstat(self.file.fileno()).st_size
+        if length < HEADER.size:
+            raise ValueError('%s is not a Geoloqi archive.' % self.path)
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), length, access=mmap.ACCESS_READ)
+
+        magic, version = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a Geoloqi archive.' % self.path)
+
+        size = point_size()
+        offset = self.size
+        while offset + BLOCK.size <= length:
+            magic, name_length, count, start, end = BLOCK.unpack_from(self.map, offset)
+            name_offset = offset + BLOCK.size
+            data = align(name_offset + name_length)
+            if magic != BLOCK_MAGIC or data + count * size > length:
+                break
+
+            device = self.map[name_offset:name_offset + name_length].decode('utf-8') or None
+            self.blocks.setdefault(device, []).append(
+                    Block(device, start, end, count, data))
+            offset = data + count * size
+        self.size = offset
+
+    def devices(self):
+        """
+        List the devices with points in the archive.
+        """
+        return self.blocks.keys()
+
+    def last_timestamp(self, device=None):
+        """
+        Find the time of a device's latest point.
+
+        Returns:
+            A Unix timestamp, or None if the device has no points.
+        """
+        blocks = self.blocks.get(device_name(device))
+        if not blocks:
+            return None
+        return max(block.end for block in blocks)
+
+    def column(self, block, index, first=0, last=None):
+        """
+        Read part of one of a block's columns.
+
+        Args:
+            block: The `Block`.
+            index: The column's position in `COLUMNS`.
+            first: The first point to read.
+            last: The point to stop before. Defaults to the block's end.
+
+        Returns:
+            An `array.array` of the column's values.
+        """
+        if last is None:
+            last = block.count
+        offset = block.offset
+        for name, code, key in COLUMNS[:index]:
+            offset += block.count * array.array(code).itemsize
+
+        values = array.array(COLUMNS[index][1])
+        values.fromstring(buffer(self.map, offset + first * values.itemsize,
+                (last - first) * values.itemsize))
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values
+
+    def timestamp(self, block, index):
+        return struct.unpack_from('<d', self.map, block.offset + 8 * index)[0]
+
+    def find(self, block, timestamp):
+        """
+        Find the first of a block's points at or after a time, with a binary
+        search of its timestamps in place.
+        """
+        low, high = 0, block.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(block, middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def ranges(self, device=None, start=None, end=None):
+        """
+        Find the points of a device's blocks in a time range.
+
+        Returns:
+            A list of (block, first, last) tuples, oldest first.
+        """
+        ranges = []
+        for block in self.blocks.get(device_name(device), []):
+            if start is not None and block.end < start or \
+                    end is not None and block.start >= end:
+                continue
+            first = start is not None and self.find(block, start) or 0
+            last = block.count
+            if end is not None:
+                last = self.find(block, end)
+            if first < last:
+                ranges.append((block, first, last))
+        return ranges
+
+    def read(self, device=None, start=None, end=None):
+        """
+        Read a device's points in a time range.
+
+        Args:
+            device: The device, or None for points archived without one.
+            start: The earliest timestamp to include.
+            end: The timestamp to stop before.
+
+        Returns:
+            A new `LocationTrack`.
+        """
+        track = LocationTrack()
+        for block, first, last in self.ranges(device, start, end):
+            for index, (name, code, key) in enumerate(COLUMNS):
+                getattr(track, name).extend(self.column(block, index, first, last))
+        return track
+
+    def scan(self, device=None, start=None, end=None):
+        """
+        Iterate over a device's points in a time range, reading each from
+        the memory map as it is reached.
+
+        Returns:
+            A generator of `TrackPoint` tuples.
+        """
+        for block, first, last in self.ranges(device, start, end):
+            offsets = []
+            offset = block.offset
+            for name, code, key in COLUMNS:
+                item = struct.Struct('<' + code)
+                offsets.append((item, offset))
+                offset += block.count * item.size
+
+            for i in xrange(first, last):
+                yield TrackPoint(*[item.unpack_from(self.map, column + i * item.size)[0]
+                        for item, column in offsets])
+
+
+class ArchiveWriter:
+    """
+    Appends devices' location history to an archive, creating it if it
+    doesn't exist. Each write adds a block, so history is best written a
+    page or more at a time.
+
+    A device's points that aren't newer than its latest archived point are
+    skipped, so exporting overlapping ranges of history doesn't store
+    points twice.
+
+    ::
+
+        >>> with ArchiveWriter('history.glq') as archive:
+        ...     archive.write(g.location_track({'after': 1331000000}), 'truck-12')
+    """
+
+    def __init__(self, path):
+        """
+        Open an archive for appending.
+
+        Args:
+            path: The archive's file name.
+
+        Raises:
+            ValueError: If the file exists and isn't an archive.
+        """
+        self.path = path
+        self.last = {}
+        if os.path.exists(path) and os.path.getsize(path):
+            with ArchiveReader(path) as reader:
+                size = reader.size
+                for device in reader.devices():
+                    self.last[device] = reader.last_timestamp(device)
+            self.file = open(path, 'r+b')
+            # Drop any block left incomplete by a crash
+            self.file.truncate(size)
+            self.file.seek(size)
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(HEADER.pack(MAGIC, VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def last_timestamp(self, device=None):
+        """
+        Find the time of a device's latest archived point.
+
+        Returns:
+            A Unix timestamp, or None if the device has no points.
+        """
+        return self.last.get(device_name(device))
+
+    def write(self, points, device=None):
+        """
+        Append a device's points to the archive.
+
+        Args:
+            points: A `LocationTrack`, or a list of location history points,
+                    oldest first.
+            device: An optional identifier of the device.
+
+        Returns:
+            The number of points written.
+        """
+        track = points
+        if not isinstance(track, LocationTrack):
+            track = LocationTrack(points)
+
+        device = device_name(device)
+        last = self.last.get(device)
+        if last is not None:
+            track = track[bisect.bisect_right(track.timestamp, last):]
+        if not len(track):
+            return 0
+
+        name = (device or u'').encode('utf-8')
+        header = BLOCK.pack(BLOCK_MAGIC, len(name), len(track),
+                track.timestamp[0], track.timestamp[-1]) + name
+        offset = self.file.tell() + len(header)
+        chunks = [header, '\0' * (align(offset) - offset)]
+        for name, code, key in COLUMNS:
+            column = getattr(track, name)
+            if sys.byteorder != 'little':
+                column = array.array(code, column)
+                column.byteswap()
+            chunks.append(column.tostring())
+
+        self.file.write(''.join(chunks))
+        self.file.flush()
+        self.last[device] = track.timestamp[-1]
+        return len(track)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,264 @@
+"""
+Non-blocking interfaces to the Geoloqi API.
+"""
+from multiprocessing.pool import ThreadPool
+
+from fanout import map_requests_async
+from geoloqi import Session, read_config, read_credentials
+from pool import ConnectionPool
+
+
+class AsyncSession:
+    """
+    A session with the Geoloqi API whose requests run in the background.
+
+    Requests are handed to a fixed set of worker threads that share a
+    `Session` and its pooled connections, so at most `max_concurrency`
+    requests are in flight at once. Each request method returns an
+    `AsyncResult` immediately; call its `get` method to wait for the JSON
+    response.
+    """
+    max_concurrency = 10
+    session = None
+    workers = None
+
+    def __init__(self, api_key=None, api_secret=None, access_token=None,
+            max_concurrency=None, pool=None, **kwargs):
+        """
+        Create a new asynchronous Geoloqi API session.
+
+        Args:
+            api_key: Your application's Geoloqi API key.
+            api_secret: Your application's Geoloqi API secret.
+            access_token: Your personal user access token.
+            max_concurrency: The maximum number of requests in flight.
+            pool: An optional `ConnectionPool` to send requests through.
+
+        Any other keyword arguments are passed on to the underlying `Session`.
+
+        Raises:
+            ValueError: If the proper client credentials were not provided.
+        """
+        if max_concurrency is not None:
+            self.max_concurrency = max_concurrency
+
+        # Keep an idle connection around for every worker
+        if pool is None:
+            pool = ConnectionPool(maxsize=self.max_concurrency)
+
+        self.session = Session(api_key, api_secret, access_token, pool=pool,
+                **kwargs)
+        self.workers = ThreadPool(self.max_concurrency)
+
+    @property
+    def access_token(self):
+        return self.session.access_token
+
+    @property
+    def auth(self):
+        return self.session.auth
+
+    def get(self, path, args=None, headers=None, callback=None, **kwargs):
+        """
+        Make a GET request to the Geoloqi API server in the background.
+
+        Args:
+            path: Path to the resource being requested (example: 'account/profile')
+            args: An optional dictonary of GET arguments.
+            headers: An optional dictonary of extra headers to send with the request.
+            callback: An optional function called with the response once
+                      the request succeeds.
+
+        Any other keyword arguments, such as `timeout` and `deadline`, are
+        passed on to the session.
+
+        Returns:
+            An `AsyncResult` for the JSON response.
+        """
+        return self.submit(self.session.get, (path, args, headers), callback,
+                kwargs)
+
+    def post(self, path, data=None, headers=None, callback=None, **kwargs):
+        """
+        Make a POST request to the Geoloqi API server in the background.
+
+        Args:
+            path: Path to the resource being requested (example: 'account/profile')
+            data: An optional dictonary to be sent to the server as a POST.
+            headers: An optional dictonary of extra headers to send with the request.
+            callback: An optional function called with the response once
+                      the request succeeds.
+
+        Any other keyword arguments, such as `timeout` and `deadline`, are
+        passed on to the session.
+
+        Returns:
+            An `AsyncResult` for the JSON response.
+        """
+        return self.submit(self.session.post, (path, data, headers), callback,
+                kwargs)
+
+    def run(self, path, data=None, headers=None, callback=None, **kwargs):
+        """
+        Make a request to the Geoloqi API server in the background.
+
+        Args:
+            path: Path to the resource being requested (example: 'account/profile')
+            data: An optional dictonary to be sent to the server as a POST.
+            headers: An optional dictonary of extra headers to send with the request.
+            callback: An optional function called with the response once
+                      the request succeeds.
+
+        Any other keyword arguments, such as `timeout` and `deadline`, are
+        passed on to the session.
+
+        Returns:
+            An `AsyncResult` for the JSON response.
+        """
+        return self.submit(self.session.run, (path, data, headers), callback,
+                kwargs)
+
+    def map(self, requests, callback=None):
+        """
+        Make many requests on the worker threads, as `Geoloqi.map` does. A
+        request that raises an exception doesn't stop the others; the
+        exception is returned in place of its response.
+
+        Args:
+            requests: A list of requests, each a path to GET or a tuple of
+                      a method name followed by its arguments.
+            callback: An optional function called with the list of
+                      responses once every request has finished.
+
+        Returns:
+            An `AsyncResult` for the list of responses, in the same order
+            as the requests.
+        """
+        return map_requests_async(self.session, list(requests), self.workers,
+                callback)
+
+    def establish(self, data):
+        """
+        Retrieve an access token from the Geoloqi OAuth2 server in the
+        background. See `Session.establish`.
+
+        Returns:
+            An `AsyncResult` that completes once the token has been stored.
+        """
+        return self.submit(self.session.establish, (data,))
+
+    def renew_access_token(self):
+        """
+        Renew the access token in the background. See
+        `Session.renew_access_token`.
+
+        Returns:
+            An `AsyncResult` that completes once the token has been stored.
+        """
+        return self.submit(self.session.renew_access_token, ())
+
+    def submit(self, func, args, callback=None, kwargs=None):
+        """
+        Queue a call to run on the worker threads.
+
+        Args:
+            func: The function to call.
+            args: A tuple of positional arguments for the function.
+            callback: An optional function called with the result.
+            kwargs: An optional dictionary of keyword arguments for the
+                    function.
+
+        Returns:
+            An `AsyncResult` for the call.
+        """
+        return self.workers.apply_async(func, args, kwargs or {},
+                callback=callback)
+
+    def close(self):
+        """
+        Wait for any queued requests to finish and stop the worker threads.
+        """
+        self.workers.close()
+        self.workers.join()
+
+
+class AsyncGeoloqi:
+    """
+    A Geoloqi API wrapper whose methods return an `AsyncResult` immediately
+    instead of blocking on the response.
+
+    Credentials are found as for `Geoloqi`, and requests are made through an
+    `AsyncSession`. Only the request methods are offered; the helpers of
+    `Geoloqi` that page through or upload data need blocking responses.
+    """
+    config = None
+    api_key = None
+    api_secret = None
+    access_token = None
+    session = None
+
+    def __init__(self, api_key=None, api_secret=None, access_token=None,
+            **kwargs):
+        """
+        Initializes a new instance of the asynchronous Geoloqi API wrapper.
+
+        Args:
+            api_key: Your application's Geoloqi API key.
+            api_secret: Your application's Geoloqi API secret.
+            access_token: Your personal user access token.
+
+        Any other keyword arguments (such as `max_concurrency` and `pool`)
+        are passed on to the `AsyncSession`.
+
+        Raises:
+            ValueError: If the proper client credentials were not provided.
+        """
+        self.config = read_config()
+        self.api_key, self.api_secret, self.access_token = read_credentials(
+                self.config, api_key, api_secret, access_token)
+        self.session = AsyncSession(self.api_key, self.api_secret,
+                self.access_token, **kwargs)
+
+    def get(self, path, args=None, headers=None, **kwargs):
+        """
+        Make a GET request in the background. See `AsyncSession.get`.
+        """
+        return self.session.get(path, args, headers, **kwargs)
+
+    def post(self, path, data=None, headers=None, **kwargs):
+        """
+        Make a POST request in the background. See `AsyncSession.post`.
+        """
+        return self.session.post(path, data, headers, **kwargs)
+
+    def run(self, path, data=None, headers=None, **kwargs):
+        """
+        Make a request in the background. See `AsyncSession.run`.
+        """
+        return self.session.run(path, data, headers, **kwargs)
+
+    def map(self, requests, callback=None):
+        """
+        Make many requests in the background. See `AsyncSession.map`.
+        """
+        return self.session.map(requests, callback)
+
+    def establish(self, data):
+        """
+        Retrieve an access token in the background. See
+        `AsyncSession.establish`.
+        """
+        return self.session.establish(data)
+
+    def renew_access_token(self):
+        """
+        Renew the access token in the background. See
+        `AsyncSession.renew_access_token`.
+        """
+        return self.session.renew_access_token()
+
+    def close(self):
+        """
+        Wait for any queued requests to finish and stop the worker threads.
+        """
+        self.session.close()
@@ -0,0 +1,224 @@
+"""
+Batched requests to the Geoloqi API.
+"""
+
+from cache import get_path
+from codec import Payload
+from fanout import map_requests
+from urllib2 import HTTPError
+
+
+class Batch:
+    """
+    Queues up API calls and sends them together in as few round trips as
+    possible.
+
+    Calls are packed into requests to the API's `batch/run` endpoint, at
+    most `per_request_limit` calls at a time. If the server doesn't
+    support batching, the calls are instead run concurrently on up to
+    `max_workers` threads. Either way the results come back in the order
+    the calls were queued.
+
+    A batch can be used as a builder:
+
+    ::
+
+        >>> results = g.batch().get('account/profile').post('location/update', point).run()
+
+    or as a context manager, which runs the batch on exit:
+
+    ::
+
+        >>> with g.batch() as batch:
+        ...     for point in points:
+        ...         batch.post('location/update', point)
+        >>> batch.results
+    """
+    per_request_limit = 200
+    max_workers = 8
+
+    session = None
+    jobs = None
+    results = None
+
+    def __init__(self, session, per_request_limit=None, max_workers=None):
+        """
+        Create a new, empty batch.
+
+        Args:
+            session: The `Session` used to send the batch.
+            per_request_limit: The maximum number of calls in one batch request.
+            max_workers: The number of threads used when batching isn't supported.
+        """
+        self.session = session
+        self.jobs = []
+
+        if per_request_limit is not None:
+            self.per_request_limit = per_request_limit
+        if max_workers is not None:
+            self.max_workers = max_workers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def get(self, path, args=None, headers=None):
+        """
+        Queue a GET request.
+
+        Args:
+            path: Path to the resource being requested (example: 'account/profile')
+            args: An optional dictonary of GET arguments.
+            headers: An optional dictonary of extra headers to send with the request.
+
+        Returns:
+            The batch, so calls can be chained.
+        """
+        path = get_path(path, args)
+
+        self.jobs.append({
+            'relative_url': path,
+            'body': None,
+            'headers': headers or {},
+        })
+        return self
+
+    def post(self, path, data=None, headers=None):
+        """
+        Queue a POST request.
+
+        Args:
+            path: Path to the resource being requested (example: 'account/profile')
+            data: An optional dictonary to be sent to the server as a POST, or
+                  a JSON string or `Payload` that has already been encoded.
+            headers: An optional dictonary of extra headers to send with the request.
+
+        Returns:
+            The batch, so calls can be chained.
+        """
+        # Batched bodies are nested in the batch request, so they are sent
+        # decoded
+        if isinstance(data, Payload):
+            data = data.data
+        elif isinstance(data, basestring):
+            data = self.session.codec.loads(data)
+
+        self.jobs.append({
+            'relative_url': path,
+            'body': data or {},
+            'headers': headers or {},
+        })
+        return self
+
+    def run(self):
+        """
+        Send every queued call to the API server.
+
+        The result for each call is its JSON response as a dictionary, which
+        will contain an 'error' key if that call failed. If a call raised an
+        exception while running without batch support, the exception is
+        returned in its place rather than aborting the rest of the batch.
+        If a batch request fails as a whole, its error is returned in the
+        place of each of its calls.
+
+        If sending raises an exception, the calls that weren't sent are
+        queued again and the results of those that were are kept in
+        `results`, so the batch can be run again.
+
+        Returns:
+            A list of results in the order the calls were queued.
+        """
+        jobs, self.jobs = self.jobs, []
+        results = []
+
+        try:
+            for start in xrange(0, len(jobs), self.per_request_limit):
+                chunk = jobs[start:start + self.per_request_limit]
+
+                if self.session.batch_supported is not False:
+                    chunk_results = self.run_batched(chunk)
+                    if chunk_results is not None:
+                        results.extend(chunk_results)
+                        continue
+
+                results.extend(self.run_concurrently(chunk))
+        except:
+            self.jobs = jobs[len(results):] + self.jobs
+            self.results = results
+            raise
+
+        self.results = results
+        return results
+
+    def run_batched(self, jobs):
+        """
+        Send calls to the API's batch endpoint in one request.
+
+        Args:
+            jobs: A list of queued calls.
+
+        Returns:
+            A list of results, or None if the server doesn't support batching.
+            Only a 404 or 'not_found' response is taken to mean batching
+            isn't supported; other errors are returned for every call.
+        """
+        try:
+            response = self.session.post('batch/run', {
+                'access_token': self.session.access_token,
+                'batch': jobs,
+            })
+        except HTTPError, e:
+            if e.code == 404:
+                self.session.batch_supported = False
+                return None
+            return [e] * len(jobs)
+
+        if response.get('error') == 'not_found':
+            self.session.batch_supported = False
+            return None
+        if response.has_key('error'):
+            return [response] * len(jobs)
+
+        responses = response.get('result')
+        if not isinstance(responses, list) or len(responses) != len(jobs):
+            return [{'error': 'invalid_response', 'error_description':
+                    'The batch response does not match the calls sent.'}] * len(jobs)
+        self.session.batch_supported = True
+
+        results = []
+        for result in responses:
+            body = result.get('body')
+            if isinstance(body, basestring):
+                try:
+                    body = self.session.codec.loads(body)
+                except ValueError:
+                    body = {'error': 'invalid_response', 'error_description': body}
+            results.append(body)
+        return results
+
+    def run_concurrently(self, jobs):
+        """
+        Run calls as individual requests spread over several threads.
+
+        Args:
+            jobs: A list of queued calls.
+
+        Returns:
+            A list of results.
+        """
+        requests = []
+        for job in jobs:
+            if job['body'] is None:
+                requests.append(('run', job['relative_url'], None,
+                        dict(job['headers'])))
+            else:
+                requests.append(('post', job['relative_url'], job['body'],
+                        dict(job['headers'])))
+
+        return map_requests(self.session, requests, self.max_workers)
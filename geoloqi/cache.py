@@ -0,0 +1,208 @@
+"""
+An in-memory cache of Geoloqi API responses.
+"""
+import threading
+import time
+import urllib
+
+from collections import OrderedDict
+
+
+def get_path(path, args=None):
+    """
+    Add GET arguments to a path. The arguments are sorted, so a request
+    always has the same path, and so the same cache and coalescing key,
+    however its dictionary happens to order them.
+
+    Args:
+        path: Path to the resource (example: 'place/list').
+        args: An optional dictionary of GET arguments.
+
+    Returns:
+        The path with its query string.
+    """
+    if not args:
+        return path
+    return '%s?%s' % (path, urllib.urlencode(sorted(args.items())))
+
+
+class CacheEntry:
+    """
+    A cached response along with the validators needed to revalidate it.
+    """
+
+    def __init__(self, response, expires_at, etag=None, last_modified=None):
+        self.response = response
+        self.expires_at = expires_at
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def is_fresh(self):
+        return time.time() < self.expires_at
+
+    def validators(self):
+        """
+        Build the conditional request headers for revalidating the entry.
+
+        Returns:
+            A dictionary of headers, which is empty if the server didn't
+            send an ETag or Last-Modified header.
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    A thread-safe LRU cache of GET responses, keyed by path, query
+    arguments and access token.
+
+    Responses are served from the cache for `ttl` seconds, or for the
+    number of seconds given for the longest matching path prefix in `ttls`.
+    Once an entry goes stale it is revalidated with a conditional request
+    if the server sent an ETag or Last-Modified header. A POST invalidates
+    every cached response in the same resource family, so a POST to
+    'place/create' drops cached 'place/list' and 'place/info' responses.
+
+    Cached responses are shared between callers and shouldn't be modified.
+    """
+    maxsize = 1000
+    ttl = 60
+
+    def __init__(self, maxsize=None, ttl=None, ttls=None):
+        """
+        Create a new response cache.
+
+        Args:
+            maxsize: The maximum number of responses to keep.
+            ttl: The default number of seconds a response stays fresh.
+            ttls: An optional dictionary mapping path prefixes (example:
+                  'place/list') to the number of seconds their responses
+                  stay fresh.
+        """
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if ttl is not None:
+            self.ttl = ttl
+        self.ttls = ttls or {}
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    def lookup(self, path, access_token):
+        """
+        Find the cached response for a request.
+
+        Args:
+            path: The requested path, including any query string.
+            access_token: The access token the request is made with.
+
+        Returns:
+            The `CacheEntry` for the request, which may be stale, or None.
+        """
+        key = (path, access_token)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries[key] = entry
+            if entry.is_fresh():
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def store(self, path, access_token, response, headers=None):
+        """
+        Cache a response.
+
+        Args:
+            path: The requested path, including any query string.
+            access_token: The access token the request was made with.
+            response: The parsed JSON response.
+            headers: The response headers, used to find the validators.
+        """
+        etag = last_modified = None
+        if headers is not None:
+            etag = headers.getheader('ETag')
+            last_modified = headers.getheader('Last-Modified')
+
+        ttl = self.get_ttl(path)
+        if ttl <= 0 and not (etag or last_modified):
+            return
+
+        entry = CacheEntry(response, time.time() + ttl, etag, last_modified)
+        key = (path, access_token)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def revalidate(self, entry, path):
+        """
+        Mark a stale entry fresh again after the server answered a
+        conditional request with 304 Not Modified.
+
+        Args:
+            entry: The revalidated `CacheEntry`.
+            path: The requested path, including any query string.
+
+        Returns:
+            The cached response.
+        """
+        with self.lock:
+            entry.expires_at = time.time() + self.get_ttl(path)
+            self.revalidations += 1
+        return entry.response
+
+    def invalidate(self, path):
+        """
+        Drop every cached response in the same resource family as a path.
+
+        Args:
+            path: The path that was modified (example: 'place/create').
+        """
+        family = path.split('?', 1)[0].split('/', 1)[0] + '/'
+        with self.lock:
+            for key in [key for key in self.entries if key[0].startswith(family)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_ttl(self, path):
+        path = path.split('?', 1)[0]
+        prefixes = [prefix for prefix in self.ttls if path.startswith(prefix)]
+        if prefixes:
+            return self.ttls[max(prefixes, key=len)]
+        return self.ttl
+
+    def stats(self):
+        """
+        Report how effective the cache has been.
+
+        Returns:
+            A dictionary of hit, miss, revalidation and eviction counts
+            along with the current number of entries.
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+            }
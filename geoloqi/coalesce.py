@@ -0,0 +1,94 @@
+"""
+Coalescing of identical requests made at the same time.
+"""
+import sys
+import threading
+
+from errors import DeadlineExceeded
+
+
+class Call:
+    """
+    A call in flight, whose outcome is shared with duplicate callers.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class Coalescer:
+    """
+    Lets only one of several identical calls made at the same time run.
+    While a call with a given key is in flight, later callers with the same
+    key wait for it and share its result, or its exception, instead of
+    making their own call. Nothing is kept once the call has finished, so
+    unlike a `ResponseCache` a coalescer never returns stale data.
+
+    Callers share the same result object, so they shouldn't modify it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.made = 0
+        self.coalesced = 0
+
+    def call(self, key, func, timeout=None):
+        """
+        Make a call, unless an identical one is already in flight.
+
+        Args:
+            key: A hashable key identifying identical calls.
+            func: A function taking no arguments that makes the call.
+            timeout: The maximum number of seconds to wait for an identical
+                     call in flight.
+
+        Returns:
+            The result of the call.
+
+        Raises:
+            DeadlineExceeded: If an identical call didn't finish in time.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = Call()
+                self.made += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = func()
+            except:
+                call.exc_info = sys.exc_info()
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result
+
+        if not call.done.wait(timeout):
+            raise DeadlineExceeded()
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+    def stats(self):
+        """
+        Report how many calls were made and how many shared another's result.
+
+        Returns:
+            A dictionary of call counts and the number of calls in flight.
+        """
+        with self.lock:
+            return {
+                'made': self.made,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.calls),
+            }
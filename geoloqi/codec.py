@@ -0,0 +1,139 @@
+"""
+Pluggable JSON encoding and decoding of request and response bodies.
+"""
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+class JSONCodec:
+    """
+    Encodes and decodes JSON with the standard library's `json` module.
+    """
+    name = 'json'
+
+    def dumps(self, value):
+        """
+        Encode a value as a JSON string.
+        """
+        return json.dumps(value)
+
+    def loads(self, data):
+        """
+        Decode a JSON string.
+
+        Raises:
+            ValueError: If the string isn't valid JSON.
+        """
+        return json.loads(data)
+
+
+class UltraJSONCodec(JSONCodec):
+    """
+    Encodes and decodes JSON with `ujson`, if it is installed.
+    """
+    name = 'ujson'
+
+    def dumps(self, value):
+        return ujson.dumps(value)
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+class SimpleJSONCodec(JSONCodec):
+    """
+    Encodes and decodes JSON with `simplejson` and its C speedups, if it is
+    installed.
+    """
+    name = 'simplejson'
+
+    def dumps(self, value):
+        return simplejson.dumps(value)
+
+    def loads(self, data):
+        return simplejson.loads(data)
+
+
+# The available codecs, fastest first
+CODECS = [codec for codec, module in [
+    (UltraJSONCodec, ujson),
+    (SimpleJSONCodec, simplejson),
+    (JSONCodec, json),
+] if module is not None]
+
+
+def get_codec(name=None):
+    """
+    Find a JSON codec. The standard library's `json` module is used unless
+    another codec is asked for, since `ujson` and `simplejson` may encode
+    some values, such as floats, differently.
+
+    Args:
+        name: An optional codec name (example: 'ujson'), or 'fastest' for
+              the fastest installed codec. Defaults to 'json'.
+
+    Returns:
+        A codec instance.
+
+    Raises:
+        ValueError: If the named codec isn't installed.
+    """
+    name = name or 'json'
+    for codec in CODECS:
+        if name == 'fastest' or codec.name == name:
+            return codec()
+    raise ValueError('The %r JSON codec is not installed.' % name)
+
+
+class Payload:
+    """
+    A request body that is serialized once and can then be posted any
+    number of times, for example to many users or through `Geoloqi.map`,
+    without being encoded again:
+
+    ::
+
+        >>> payload = Payload(points)
+        >>> g.post('location/update', payload)
+    """
+
+    def __init__(self, data, codec=None):
+        """
+        Serialize a request body.
+
+        Args:
+            data: The body as a dictionary or list.
+            codec: An optional codec to encode it with. Defaults to the
+                   standard library's `json` module.
+        """
+        self.data = data
+        self.body = (codec or get_codec()).dumps(data)
+
+
+def encode(data, codec):
+    """
+    Serialize a request body, unless it already has been.
+
+    Args:
+        data: A dictionary or list, an encoded JSON string, or a `Payload`.
+        codec: The codec to encode dictionaries and lists with.
+
+    Returns:
+        The body as a JSON string of UTF-8 bytes.
+    """
+    if isinstance(data, Payload):
+        return data.body
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    if isinstance(data, str):
+        return data
+    return codec.dumps(data)
@@ -0,0 +1,177 @@
+"""
+Compressed transfer of request and response bodies.
+"""
+import socket
+import threading
+import urllib
+import zlib
+
+from urllib2 import HTTPError
+
+ACCEPT_ENCODING = 'gzip, deflate'
+
+
+def gzip_compress(data, level=6):
+    """
+    Compress a request body in gzip format.
+
+    Args:
+        data: The body as a string.
+        level: The zlib compression level.
+
+    Returns:
+        The compressed body.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Transfer:
+    """
+    The number of bytes a single request and its response took on the
+    wire, compared to their size once decompressed.
+    """
+
+    def __init__(self, sent_wire=0, sent_logical=0):
+        self.sent_wire = sent_wire
+        self.sent_logical = sent_logical
+        self.received_wire = 0
+        self.received_logical = 0
+
+
+class TransferStats:
+    """
+    Thread-safe running totals of the bytes sent and received by a session.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.sent_wire = 0
+        self.sent_logical = 0
+        self.received_wire = 0
+        self.received_logical = 0
+
+    def add(self, transfer):
+        """
+        Add a finished request to the totals.
+
+        Args:
+            transfer: The request's `Transfer`.
+        """
+        with self.lock:
+            self.requests += 1
+            self.sent_wire += transfer.sent_wire
+            self.sent_logical += transfer.sent_logical
+            self.received_wire += transfer.received_wire
+            self.received_logical += transfer.received_logical
+
+    def stats(self):
+        """
+        Report the bytes transferred so far.
+
+        Returns:
+            A dictionary of request and byte counts.
+        """
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'sent_wire': self.sent_wire,
+                'sent_logical': self.sent_logical,
+                'received_wire': self.received_wire,
+                'received_logical': self.received_logical,
+            }
+
+
+class DecodingReader:
+    """
+    A socket-like wrapper around a response body that counts the bytes
+    read off the wire and transparently decodes gzip and deflate bodies.
+    """
+
+    def __init__(self, f, encoding, transfer, stats=None):
+        self.f = f
+        self.transfer = transfer
+        self.stats = stats
+        self.finished = False
+
+        encoding = (encoding or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.decompressor = None
+        self.deflate = encoding == 'deflate'
+        self.first = True
+
+    def recv(self, amt=None):
+        while True:
+            chunk = self.f.read(amt)
+            self.transfer.received_wire += len(chunk)
+
+            if not chunk:
+                data = self.decompressor and self.decompressor.flush() or ''
+                self.transfer.received_logical += len(data)
+                self.finish()
+                return data
+
+            data = self.decompress(chunk)
+            if data:
+                self.transfer.received_logical += len(data)
+                return data
+
+    def decompress(self, chunk):
+        if self.decompressor is None:
+            return chunk
+
+        first, self.first = self.first, False
+        try:
+            return self.decompressor.decompress(chunk)
+        except zlib.error:
+            if not (self.deflate and first):
+                raise
+
+            # Some servers send raw deflate data without the zlib header
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decompressor.decompress(chunk)
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            if self.stats is not None:
+                self.stats.add(self.transfer)
+
+    def close(self):
+        self.finish()
+        self.f.close()
+
+
+def decode_response(f, transfer, stats=None):
+    """
+    Wrap a response so its body is counted and decoded as it is read.
+
+    Args:
+        f: The response returned by `urllib2`, or the `HTTPError` raised.
+        transfer: The request's `Transfer`, updated as the body is read.
+        stats: An optional `TransferStats` the request is added to once
+               its body has been read.
+
+    Returns:
+        A response of the same type whose `transfer` attribute holds the
+        request's `Transfer`.
+    """
+    if isinstance(f, HTTPError) and f.fp is None:
+        return f
+
+    info = f.info()
+    reader = DecodingReader(f, info.getheader('Content-Encoding'), transfer, stats)
+    fp = socket._fileobject(reader, close=True)
+
+    if isinstance(f, HTTPError):
+        response = HTTPError(f.filename, f.code, f.msg, f.hdrs, fp)
+    else:
+        response = urllib.addinfourl(fp, info, f.geturl(), f.getcode())
+        response.msg = getattr(f, 'msg', None)
+    response.transfer = transfer
+    return response
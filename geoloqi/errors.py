@@ -0,0 +1,41 @@
+"""
+Exceptions raised by the Geoloqi API client.
+"""
+from urllib2 import URLError
+
+
+class GeoloqiError(Exception):
+    """
+    Raised when the Geoloqi API responds with an error.
+    """
+    error = None
+    description = None
+    response = None
+
+    def __init__(self, response):
+        """
+        Create a new error from an API response.
+
+        Args:
+            response: The JSON error response as a dictionary.
+        """
+        self.response = response
+        self.error = response.get('error')
+        self.description = response.get('error_description')
+        Exception.__init__(self, self.description and '%s: %s' % (self.error,
+                self.description) or self.error)
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a request is held back by a client-side rate limit.
+    """
+
+
+class DeadlineExceeded(URLError):
+    """
+    Raised when a request can't be completed before its deadline.
+    """
+
+    def __init__(self, reason='deadline exceeded'):
+        URLError.__init__(self, reason)
@@ -0,0 +1,99 @@
+"""
+Bounded-concurrency fan-out of many Geoloqi API requests.
+"""
+from multiprocessing.pool import ThreadPool
+
+METHODS = ('get', 'post', 'run')
+
+
+def run_request(session, request):
+    """
+    Make a single request, returning any exception it raises instead of
+    raising it.
+
+    Args:
+        session: The `Session` to make the request with.
+        request: Either a path to GET, or a tuple of the method name ('get',
+                 'post' or 'run') followed by the method's arguments
+                 (example: ('post', 'location/update', point)).
+
+    Returns:
+        The JSON response as a dictionary, or the exception raised.
+    """
+    if isinstance(request, basestring):
+        request = ('get', request)
+
+    try:
+        if request[0] not in METHODS:
+            raise ValueError('Unknown request method %r' % (request[0],))
+        return getattr(session, request[0])(*request[1:])
+    except Exception, e:
+        return e
+
+
+def map_requests_async(session, requests, workers, callback=None):
+    """
+    Make many requests on an existing pool of threads without waiting for
+    them.
+
+    Args:
+        session: The `Session` to make the requests with.
+        requests: A list of requests, as accepted by `run_request`.
+        workers: The `ThreadPool` to make the requests on.
+        callback: An optional function called with the list of responses
+                  once every request has finished.
+
+    Returns:
+        An `AsyncResult` for a list of responses or exceptions in the same
+        order as the requests.
+    """
+    return workers.map_async(lambda request: run_request(session, request),
+            requests, 1, callback)
+
+
+def map_requests(session, requests, max_workers):
+    """
+    Make many requests on a pool of threads.
+
+    Args:
+        session: The `Session` to make the requests with.
+        requests: A list of requests, as accepted by `run_request`.
+        max_workers: The maximum number of requests in flight at once.
+
+    Returns:
+        A list of responses or exceptions in the same order as the requests.
+    """
+    requests = list(requests)
+    if not requests:
+        return []
+
+    workers = ThreadPool(min(max_workers, len(requests)))
+    try:
+        return map_requests_async(session, requests, workers).get()
+    finally:
+        workers.close()
+
+
+def imap_requests_unordered(session, requests, max_workers):
+    """
+    Make many requests on a pool of threads, yielding each response as soon
+    as it arrives.
+
+    Args:
+        session: The `Session` to make the requests with.
+        requests: An iterable of requests, as accepted by `run_request`.
+        max_workers: The maximum number of requests in flight at once.
+
+    Returns:
+        A generator of (index, response) tuples in the order the responses
+        arrive, where index is the position of the request and response is
+        the JSON response as a dictionary or the exception raised.
+    """
+    workers = ThreadPool(max_workers)
+    try:
+        for result in workers.imap_unordered(
+                lambda (index, request): (index, run_request(session, request)),
+                enumerate(requests)):
+            yield result
+    finally:
+        workers.terminate()
@@ -0,0 +1,188 @@
+"""
+Vectorized geodesic calculations over many points at once, using NumPy.
+
+Points may be given as a 'location/history' response, a `LocationTrack`, a
+list of location updates or places, or a list or array of (latitude,
+longitude) pairs.
+"""
+try:
+    import numpy
+except ImportError:
+    raise ImportError('geoloqi.geo needs NumPy, which is installed with '
+            '`pip install geoloqi-python[geo]`.')
+
+from itertools import chain
+from location import EARTH_RADIUS, METERS_PER_DEGREE, position
+from track import LocationTrack
+from triggers import get_region
+
+
+def coordinates(points):
+    """
+    Gather the latitudes and longitudes of many points into arrays.
+
+    Args:
+        points: A 'location/history' response, a `LocationTrack`, a list of
+                location updates in the API's nested 'location' form or
+                with top level 'latitude' and 'longitude' keys, or a list or
+                array of (latitude, longitude) pairs.
+
+    Returns:
+        A tuple of latitude and longitude arrays in degrees. Points without
+        a position are NaN.
+    """
+    if isinstance(points, LocationTrack):
+        # Copied, since the track's arrays may move as they grow
+        return (numpy.frombuffer(points.latitude, numpy.float64).copy(),
+                numpy.frombuffer(points.longitude, numpy.float64).copy())
+    if isinstance(points, dict):
+        points = points.get('points', [])
+    if len(points) and isinstance(points[0], dict):
+        nan = (float('nan'), float('nan'))
+        array = numpy.fromiter(chain.from_iterable(position(point) or nan
+                for point in points), numpy.float64, 2 * len(points))
+    else:
+        array = numpy.asarray(points, dtype=numpy.float64)
+
+    array = array.reshape(-1, 2)
+    return array[:, 0], array[:, 1]
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Calculate great circle distances between arrays of points, which are
+    broadcast against each other.
+
+    Returns:
+        An array of distances in meters.
+    """
+    lat1, lng1, lat2, lng2 = [numpy.radians(value)
+            for value in (lat1, lng1, lat2, lng2)]
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + \
+            numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.minimum(1, numpy.sqrt(a)))
+
+
+def bearing(lat1, lng1, lat2, lng2):
+    """
+    Calculate the initial bearings from one array of points to another.
+
+    Returns:
+        An array of bearings in degrees clockwise from north, from 0 to 360.
+    """
+    lat1, lng1, lat2, lng2 = [numpy.radians(value)
+            for value in (lat1, lng1, lat2, lng2)]
+    y = numpy.sin(lng2 - lng1) * numpy.cos(lat2)
+    x = numpy.cos(lat1) * numpy.sin(lat2) - \
+            numpy.sin(lat1) * numpy.cos(lat2) * numpy.cos(lng2 - lng1)
+    return numpy.degrees(numpy.arctan2(y, x)) % 360
+
+
+def track_distances(points):
+    """
+    Calculate the distance between each point of a track and the next.
+
+    Args:
+        points: The track's points. See `coordinates`.
+
+    Returns:
+        An array of one distance in meters fewer than there are points.
+    """
+    lat, lng = coordinates(points)
+    return haversine(lat[:-1], lng[:-1], lat[1:], lng[1:])
+
+
+def distance_matrix(points, others=None):
+    """
+    Calculate the distance between every pair of points.
+
+    Args:
+        points: The first set of points. See `coordinates`.
+        others: The second set of points. Defaults to the first.
+
+    Returns:
+        An array of distances in meters with a row for each point and a
+        column for each of the others.
+    """
+    lat, lng = coordinates(points)
+    other_lat, other_lng = (lat, lng) if others is None else coordinates(others)
+    return haversine(lat[:, None], lng[:, None], other_lat[None, :],
+            other_lng[None, :])
+
+
+def bounding_boxes(lat, lng, radius):
+    """
+    Find the boxes around circles, which are never smaller than the circles.
+
+    Args:
+        lat: An array of the circles' latitudes.
+        lng: An array of their longitudes.
+        radius: An array of their radii in meters.
+
+    Returns:
+        A tuple of south, west, north and east arrays in degrees.
+    """
+    lat, lng, radius = [numpy.asarray(value, dtype=numpy.float64)
+            for value in (lat, lng, radius)]
+    dlat = radius / METERS_PER_DEGREE
+    cos = numpy.cos(numpy.radians(numpy.minimum(89.0, numpy.abs(lat))))
+    dlng = numpy.minimum(180.0, dlat / cos)
+    return lat - dlat, lng - dlng, lat + dlat, lng + dlng
+
+
+def in_bounding_box(points, south, west, north, east):
+    """
+    Find the points inside a box, or inside each of many boxes.
+
+    Args:
+        points: The points. See `coordinates`.
+        south: The boxes' southern latitudes, as a number or an array.
+        west: Their western longitudes.
+        north: Their northern latitudes.
+        east: Their eastern longitudes.
+
+    Returns:
+        A boolean array with a row for each point and, when given arrays of
+        boxes, a column for each box.
+    """
+    lat, lng = coordinates(points)
+    return box_mask(lat, lng, south, west, north, east)
+
+
+def box_mask(lat, lng, south, west, north, east):
+    """
+    Like `in_bounding_box`, given arrays of latitudes and longitudes.
+    """
+    if numpy.ndim(south):
+        lat, lng = lat[:, None], lng[:, None]
+    with numpy.errstate(invalid='ignore'):
+        return (lat >= south) & (lat <= north) & (lng >= west) & (lng <= east)
+
+
+def within(points, places):
+    """
+    Test which points fall inside the radius of each of many places. Only
+    the pairs whose point is in the place's bounding box are measured.
+
+    Args:
+        points: The points. See `coordinates`.
+        places: A list of places or triggers with a 'latitude', 'longitude'
+                and 'radius', or of `Region` tuples.
+
+    Returns:
+        A boolean array with a row for each point and a column for each
+        place. Places without a position and radius contain no points.
+    """
+    lat, lng = coordinates(points)
+    regions = [place if hasattr(place, 'radius') else get_region(place)
+            for place in places]
+    circles = numpy.array([(region.latitude, region.longitude, region.radius)
+            if region else (numpy.nan, numpy.nan, -1.0) for region in regions],
+            dtype=numpy.float64).reshape(-1, 3)
+
+    result = box_mask(lat, lng,
+            *bounding_boxes(circles[:, 0], circles[:, 1], circles[:, 2]))
+    rows, columns = numpy.nonzero(result)
+    result[rows, columns] = haversine(lat[rows], lng[rows],
+            circles[columns, 0], circles[columns, 1]) <= circles[columns, 2]
+    return result
@@ -1,15 +1,148 @@
-import json
 import os
+import socket
 import sys
-import urllib
+import threading
+import time
 import urllib2
 
 from ConfigParser import ConfigParser, NoOptionError, NoSectionError
+from StringIO import StringIO
+from functools import partial
+from fanout import imap_requests_unordered, map_requests
+from archive import ArchiveWriter
+from batch import Batch
+from cache import get_path
+from codec import encode, get_codec
+from compression import ACCEPT_ENCODING, Transfer, TransferStats, \
+        decode_response, gzip_compress
+from errors import DeadlineExceeded, GeoloqiError
+from metrics import Metrics, get_timings
+from pagination import history_args, history_id, offset_args, paginate
+from pool import ConnectionPool, PooledHandler
+from retry import RetryPolicy
+from stream import iter_array
+from track import LocationTrack
+from triggers import TriggerIndex
+from uploader import LocationUploader
 from version import __version__
 from urllib2 import HTTPError, URLError
 
 API_VERSION = 1
 API_URL_BASE_TEMPLATE = 'https://api.geoloqi.com/%d/%s'
+CONFIG_FILES = ['/etc/geoloqi/geoloqi.cfg', os.path.expanduser('~/.geoloqi')]
+
+_config_cache = {}
+_config_lock = threading.Lock()
+
+
+def read_config(filenames=None):
+    """
+    Parse the Geoloqi config files. Parsed files are cached for the life of
+    the process and only read again once they have been modified.
+
+    Args:
+        filenames: An optional list of config files. Defaults to
+                   `CONFIG_FILES`.
+
+    Returns:
+        A `ConfigParser` holding the parsed config. The same instance is
+        shared by every caller, so it shouldn't be modified.
+    """
+    filenames = tuple(filenames or CONFIG_FILES)
+
+    stamps = []
+    for filename in filenames:
+        try:
+            stamps.append(os.stat(filename).st_mtime)
+        except OSError:
+            stamps.append(None)
+    stamps = tuple(stamps)
+
+    with _config_lock:
+        cached = _config_cache.get(filenames)
+        if cached and cached[0] == stamps:
+            return cached[1]
+
+        config = ConfigParser()
+        config.read(filenames)
+        _config_cache[filenames] = (stamps, config)
+        return config
+
+
+def read_credentials(config, api_key=None, api_secret=None, access_token=None):
+    """
+    Fill in any credentials that weren't given from the 'Credentials'
+    section of the config files.
+
+    Args:
+        config: The `ConfigParser` returned by `read_config`.
+        api_key: Your application's Geoloqi API key.
+        api_secret: Your application's Geoloqi API secret.
+        access_token: Your personal user access token.
+
+    Returns:
+        A tuple of the api_key, api_secret and access_token.
+
+    Raises:
+        ValueError: If the proper client credentials were not provided.
+    """
+    def option(name):
+        try:
+            return config.get('Credentials', name)
+        except NoOptionError:
+            pass
+        except NoSectionError:
+            pass
+
+    api_key = api_key or option('application_access_key')
+    api_secret = api_secret or option('application_secret_key')
+    access_token = access_token or option('user_access_token')
+
+    # Determine if Credentials exist
+    if not access_token and not (api_key and api_secret):
+        raise ValueError('Missing application credentials or a valid user access token!')
+    return api_key, api_secret, access_token
+
+
+def split_timeout(timeout):
+    """
+    Split a timeout into its connect and read timeouts.
+
+    Args:
+        timeout: A number of seconds used for both, a tuple of the connect
+                 and read timeouts, or None for no timeout.
+
+    Returns:
+        A tuple of the connect and read timeouts.
+    """
+    if isinstance(timeout, tuple):
+        return timeout
+    return timeout, timeout
+
+
+def time_left(expires, timeout=None):
+    """
+    Shorten a timeout so that it ends by a deadline.
+
+    Args:
+        expires: The time the deadline passes, or None.
+        timeout: An optional timeout in seconds.
+
+    Returns:
+        The shorter of the timeout and the time left until the deadline.
+
+    Raises:
+        DeadlineExceeded: If the deadline has passed.
+    """
+    if expires is None:
+        return timeout
+
+    left = expires - time.time()
+    if left <= 0:
+        raise DeadlineExceeded()
+    if timeout is None:
+        return left
+    return min(timeout, left)
 
 
 class Geoloqi:
@@ -22,7 +155,7 @@ class Geoloqi:
     access_token = None
     session = None
 
-    def __init__(self, api_key=None, api_secret=None, access_token=None):
+    def __init__(self, api_key=None, api_secret=None, access_token=None, **kwargs):
         """
         Initializes a new instance of the Geoloqi API wrapper.
         
@@ -51,47 +184,22 @@ class Geoloqi:
             api_secret: Your application's Geoloqi API secret.
             access_token: Your personal user access token.
 
+        Any other keyword arguments (such as `pool`) are passed on to the
+        `Session`.
+
         Raises:
             ValueError: If the proper client credentials were not provided.
         """
-        self.api_key = api_key
-        self.api_secret = api_secret
-        self.access_token = access_token
-
         # Parse any config files
-        self.config = ConfigParser()
-        self.config.read(['/etc/geoloqi/geoloqi.cfg', os.path.expanduser('~/.geoloqi')])
-
-        if not self.api_key:
-            try:
-                self.api_key = self.config.get('Credentials', 'application_access_key')
-            except NoOptionError:
-                pass
-            except NoSectionError:
-                pass
-        if not self.api_secret:
-            try:
-                self.api_secret = self.config.get('Credentials', 'application_secret_key')
-            except NoOptionError:
-                pass
-            except NoSectionError:
-                pass
-        if not self.access_token:
-            try:
-                self.access_token = self.config.get('Credentials', 'user_access_token')
-            except NoOptionError:
-                pass
-            except NoSectionError:
-                pass
-
-        # Determine if Credentials exist
-        if not self.access_token and not (self.api_key and self.api_secret):
-            raise ValueError('Missing application credentials or a valid user access token!')
+        self.config = read_config()
+        self.api_key, self.api_secret, self.access_token = read_credentials(
+                self.config, api_key, api_secret, access_token)
 
         # Create our session
-        self.session = Session(self.api_key, self.api_secret, self.access_token)
+        self.session = Session(self.api_key, self.api_secret, self.access_token,
+                **kwargs)
 
-    def get(self, path, args=None, headers=None):
+    def get(self, path, args=None, headers=None, **kwargs):
         """
         Make a GET request to the Geoloqi API server.
 
@@ -100,26 +208,31 @@ class Geoloqi:
             args: An optional dictonary of GET arguments.
             headers: An optional dictonary of extra headers to send with the request.
 
+        Any other keyword arguments are passed on to the session.
+
         Returns:
             The JSON response as a dictionary.
         """
-        return self.session.get(path, args, headers)
+        return self.session.get(path, args, headers, **kwargs)
 
-    def post(self, path, data=None, headers=None):
+    def post(self, path, data=None, headers=None, **kwargs):
         """
         Make a POST request to the Geoloqi API server.
 
         Args:
             path: Path to the resource being requested (example: 'account/profile')
-            data: An optional dictonary to be sent to the server as a POST.
+            data: An optional dictonary to be sent to the server as a POST, or
+                  a JSON string or `Payload` that has already been encoded.
             headers: An optional dictonary of extra headers to send with the request.
 
+        Any other keyword arguments are passed on to the session.
+
         Returns:
             The JSON response as a dictionary.
         """
-        return self.session.post(path, data, headers)
+        return self.session.post(path, data, headers, **kwargs)
 
-    def run(self, path, data=None, headers=None):
+    def run(self, path, data=None, headers=None, **kwargs):
         """
         Make a request to the Geoloqi API server.
 
@@ -128,31 +241,304 @@ class Geoloqi:
             data: An optional dictonary to be sent to the server as a POST.
             headers: An optional dictonary of extra headers to send with the request.
 
+        Any other keyword arguments are passed on to the session.
+
         Returns:
             The JSON response as a dictionary.
         """
-        return self.session.run(path, data, headers)
+        return self.session.run(path, data, headers, **kwargs)
+
+    def map(self, requests, max_workers=8):
+        """
+        Make many requests concurrently over the session's pooled connections.
+
+        Each request is either a path to GET, or a tuple of a method name
+        followed by its arguments:
+
+        ::
+
+            >>> g.map([('get', 'location/last', {'user_id': uid}) for uid in uids])
+
+        A request that raises an exception doesn't stop the others; the
+        exception is returned in place of its response.
+
+        Args:
+            requests: A list of requests.
+            max_workers: The maximum number of requests in flight at once.
+
+        Returns:
+            A list of responses in the same order as the requests.
+        """
+        return map_requests(self.session, requests, max_workers)
+
+    def imap_unordered(self, requests, max_workers=8):
+        """
+        Make many requests concurrently, yielding each response as soon as
+        it arrives. Requests are given as for `map`.
+
+        Args:
+            requests: An iterable of requests.
+            max_workers: The maximum number of requests in flight at once.
+
+        Returns:
+            A generator of (index, response) tuples, where index is the
+            position of the request.
+        """
+        return imap_requests_unordered(self.session, requests, max_workers)
+
+    def iter_history(self, args=None, page_size=500, prefetch=True):
+        """
+        Iterate over location history, oldest point first, requesting pages
+        from the 'location/history' endpoint as they are needed.
+
+        Args:
+            args: An optional dictonary of GET arguments (example:
+                  {'after': 1331000000, 'before': 1332000000}).
+            page_size: The number of points to request per page.
+            prefetch: Request the next page while the current one is consumed.
+
+        Returns:
+            A generator of location points.
+
+        Raises:
+            GeoloqiError: If the API responds with an error.
+        """
+        args = dict(args or {})
+        args.update({'count': page_size, 'sort': 'asc'})
+
+        return paginate(lambda args: self.get('location/history', args),
+                args, 'points', partial(history_args, page_size=page_size),
+                prefetch, history_id)
+
+    def location_track(self, args=None, page_size=500):
+        """
+        Download location history into a compact `LocationTrack`, a page
+        at a time.
+
+        Args:
+            args: An optional dictonary of GET arguments (example:
+                  {'after': 1331000000, 'before': 1332000000}).
+            page_size: The number of points to request per page.
+
+        Returns:
+            A new `LocationTrack`.
+
+        Raises:
+            GeoloqiError: If the API responds with an error.
+        """
+        track = LocationTrack()
+        page = []
+        for point in self.iter_history(args, page_size):
+            page.append(point)
+            if len(page) >= page_size:
+                track.extend(page)
+                page = []
+        track.extend(page)
+        return track
+
+    def export_history(self, path, args=None, device=None, page_size=500):
+        """
+        Append location history to an archive file, a page at a time. Only
+        points newer than the device's latest archived point are requested,
+        so exporting the same range again is cheap.
+
+        Args:
+            path: The archive's file name. See `ArchiveWriter`.
+            args: An optional dictonary of GET arguments (example:
+                  {'after': 1331000000, 'before': 1332000000}).
+            device: An optional identifier to archive the points under.
+            page_size: The number of points to request per page.
+
+        Returns:
+            The number of points written.
+
+        Raises:
+            GeoloqiError: If the API responds with an error.
+        """
+        args = dict(args or {})
+        written = 0
+        with ArchiveWriter(path) as archive:
+            last = archive.last_timestamp(device)
+            if last is not None:
+                args['after'] = max(args.get('after', 0), int(last))
+
+            page = []
+            for point in self.iter_history(args, page_size):
+                page.append(point)
+                if len(page) >= page_size:
+                    written += archive.write(page, device)
+                    page = []
+            written += archive.write(page, device)
+        return written
+
+    def iter_list(self, path, key, args=None, page_size=100, prefetch=True):
+        """
+        Iterate over the records of a list endpoint, requesting pages as they
+        are needed.
+
+        Args:
+            path: Path to the list being requested (example: 'place/list')
+            key: The key holding the records in each response (example: 'places')
+            args: An optional dictonary of GET arguments.
+            page_size: The number of records to request per page.
+            prefetch: Request the next page while the current one is consumed.
+
+        Returns:
+            A generator of records.
+
+        Raises:
+            GeoloqiError: If the API responds with an error.
+        """
+        args = dict(args or {})
+        args.update({'count': page_size})
+
+        return paginate(lambda args: self.get(path, args), args, key,
+                offset_args, prefetch)
+
+    def batch(self, **kwargs):
+        """
+        Start a batch of API calls that will be sent together in as few
+        requests as possible.
+
+        Any keyword arguments are passed on to the `Batch`.
+
+        Returns:
+            A new, empty `Batch`.
+        """
+        return Batch(self.session, **kwargs)
+
+    def uploader(self, **kwargs):
+        """
+        Start a background uploader that buffers location updates and posts
+        them to the API server in bulk.
+
+        Any keyword arguments are passed on to the `LocationUploader`.
+
+        Returns:
+            A new `LocationUploader`.
+        """
+        return LocationUploader(self.session, **kwargs)
+
+    def trigger_index(self, places=False, **kwargs):
+        """
+        Load your triggers into a local spatial index, so positions can be
+        checked against them without a request per position.
+
+        Args:
+            places: Also load your places from 'place/list'.
+
+        Any keyword arguments are passed on to the `TriggerIndex`.
+
+        Returns:
+            A new `TriggerIndex`.
+
+        Raises:
+            GeoloqiError: If the API responds with an error.
+        """
+        index = TriggerIndex(**kwargs)
+        index.load(self.iter_list('trigger/list', 'triggers'))
+        if places:
+            index.load(self.iter_list('place/list', 'places'))
+        return index
 
 
 class Session:
     """
     This class represents a session with the Geoloqi API.
+
+    A session may be shared by many threads. If several requests find that
+    the access token has expired at the same time, only one of them renews
+    it while the others wait and then retry with the new token.
+
+    When the OAuth server says how long a token lasts, the session renews
+    it in a background thread once it is within `refresh_margin` seconds of
+    expiring, so requests don't have to wait for the renewal.
     """
     api_key = None
     api_secret = None
     access_token = None
     auth = None
-
-    retry_attempt = 0
-
-    def __init__(self, api_key=None, api_secret=None, access_token=None):
+    pool = None
+    opener = None
+    url_template = API_URL_BASE_TEMPLATE
+    batch_supported = None
+    token_lock = None
+    expires_at = None
+    refresh_margin = 60
+    refresh_thread = None
+    token_cache = None
+    cache = None
+    compress_threshold = None
+    transfer = None
+    retry_policy = None
+    rate_limiter = None
+    metrics = None
+    timeout = None
+    codec = None
+    coalescer = None
+
+    def __init__(self, api_key=None, api_secret=None, access_token=None,
+            pool=None, token_cache=None, cache=None, compress_threshold=None,
+            retry_policy=None, rate_limiter=None, metrics=None, timeout=None,
+            codec=None, coalescer=None):
         """
         Create a new Geoloqi API session.
 
+        Requests are sent over persistent keep-alive connections borrowed
+        from `pool`. Sessions may share a pool, and a new one is created for
+        the session if none is provided.
+
+        If a `TokenCache` is provided, application access tokens are saved
+        to it, and a session for an application with an unexpired cached
+        token uses it instead of requesting a new one.
+
+        If a `ResponseCache` is provided, GET responses are served from it
+        while fresh and revalidated with the server once stale, and POSTs
+        invalidate the cached responses they may have changed.
+
+        Responses are always requested with gzip or deflate compression and
+        decoded transparently. Request bodies of at least
+        `compress_threshold` bytes are sent gzip compressed, which the
+        server must support.
+
+        Connection errors and transient server errors are retried according
+        to `retry_policy`, or a default `RetryPolicy` if none is provided.
+
+        If a `RateLimiter` is provided, each request waits for its rate limit
+        before it is sent, and is rejected if it can't be sent in time.
+
+        Every request is recorded in `metrics`, a new `Metrics` collector
+        unless one is provided, and reported by `stats`.
+
+        Without a `timeout`, requests wait on a stalled connection for as
+        long as the socket default allows. The timeout may be a number of
+        seconds, or a tuple of the seconds allowed to connect and to wait
+        for each read. Individual calls can override it, and can set a
+        deadline for the whole call.
+
+        Request and response bodies are encoded with `codec`, by default the
+        standard library's `json` module. Pass codec='fastest' to use
+        `ujson` or `simplejson` when either is installed.
+
+        If a `Coalescer` is provided, identical GETs made at the same time
+        share a single request.
+
         Args:
             api_key: Your application's Geoloqi API key.
             api_secret: Your application's Geoloqi API secret.
             access_token: Your personal user access token.
+            pool: An optional `ConnectionPool` to send requests through.
+            token_cache: An optional `TokenCache` to share tokens through.
+            cache: An optional `ResponseCache` for GET responses.
+            compress_threshold: An optional size in bytes above which request
+                                bodies are compressed.
+            retry_policy: An optional `RetryPolicy` for failed requests.
+            rate_limiter: An optional `RateLimiter` shared by sessions.
+            metrics: An optional `Metrics` collector shared by sessions.
+            timeout: An optional timeout for each request, in seconds.
+            codec: An optional JSON codec, or the name of one (example:
+                   'ujson' or 'fastest').
+            coalescer: An optional `Coalescer` for concurrent identical GETs.
 
         Raises:
             ValueError: If the proper client credentials were not provided.
@@ -160,6 +546,21 @@ class Session:
         self.api_key = api_key
         self.api_secret = api_secret
         self.access_token = access_token
+        self.pool = pool or ConnectionPool()
+        self.opener = urllib2.build_opener(PooledHandler(self.pool))
+        self.token_lock = threading.Lock()
+        self.token_cache = token_cache
+        self.cache = cache
+        self.compress_threshold = compress_threshold
+        self.transfer = TransferStats()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics or Metrics()
+        self.timeout = timeout
+        if isinstance(codec, basestring) or codec is None:
+            codec = get_codec(codec)
+        self.codec = codec
+        self.coalescer = coalescer
 
         # Verify the Session has the needed Credentials
         if not self.access_token and not (self.api_key and self.api_secret):
@@ -170,7 +571,7 @@ class Session:
         if not self.access_token:
             self.get_access_token()
 
-    def get(self, path, args=None, headers=None):
+    def get(self, path, args=None, headers=None, **kwargs):
         """
         Make a GET request to the Geoloqi API server.
 
@@ -179,89 +580,325 @@ class Session:
             args: An optional dictonary of GET arguments.
             headers: An optional dictonary of extra headers to send with the request.
 
+        Any other keyword arguments are passed on to `run`.
+
+        If the session has a `Coalescer`, a GET made while an identical one
+        (the same path, arguments and access token) is in flight waits for
+        that request and returns the same response instead. Streamed GETs
+        are never coalesced.
+
         Returns:
             The JSON response as a dictionary.
         """
-        if args:
-            path = "%s?%s" % (path, urllib.urlencode(args))
+        url = get_path(path, args)
+
+        if not self.coalescer or kwargs.get('stream'):
+            return self.run(url, None, headers, **kwargs)
 
-        return self.run(path, None, headers)
+        key = ('GET', url, self.access_token)
+        return self.coalescer.call(key,
+                lambda: self.run(url, None, headers, **kwargs),
+                kwargs.get('deadline'))
 
-    def post(self, path, data=None, headers=None):
+    def post(self, path, data=None, headers=None, **kwargs):
         """
         Make a POST request to the Geoloqi API server.
 
         Args:
             path: Path to the resource being requested (example: 'account/profile')
-            data: An optional dictonary to be sent to the server as a POST.
+            data: An optional dictonary to be sent to the server as a POST, or
+                  a JSON string or `Payload` that has already been encoded.
             headers: An optional dictonary of extra headers to send with the request.
 
+        Any other keyword arguments are passed on to `run`.
+
         Returns:
             The JSON response as a dictionary.
         """
-        if not headers:
-            headers = {}
-
+        headers = dict(headers or {})
         headers.update({
             'Content-Type': 'application/json',
         })
 
-        return self.run(path, data, headers)
+        return self.run(path, data, headers, **kwargs)
 
-    def run(self, path, data=None, headers=None):
+    def run(self, path, data=None, headers=None, stream=None, timeout=None,
+            deadline=None):
         """
         Make a request to the Geoloqi API server.
 
+        If `stream` is given, the elements of the array it names in the
+        response (example: 'points') are decoded and yielded one at a time
+        as the response arrives, rather than parsing the whole response at
+        once. Pass `stream=True` if the response is itself an array.
+
+        If `deadline` is given, the call fails rather than let its retries,
+        waits for the rate limit and any renewal of the access token run
+        past that many seconds. Each socket operation is given no longer
+        than the time left, though reading a streamed response isn't.
+
         Args:
             path: Path to the resource being requested (example: 'account/profile')
             data: An optional dictonary to be sent to the server as a POST.
             headers: An optional dictonary of extra headers to send with the request.
+            stream: The key of an array in the response to stream.
+            timeout: An optional timeout overriding the session's `timeout`.
+            deadline: An optional number of seconds the call must finish in.
 
         Returns:
-            The JSON response as a dictionary.
+            The JSON response as a dictionary, or a generator of array
+            elements when streaming.
+
+        Raises:
+            DeadlineExceeded: If the call couldn't finish before its deadline.
+            GeoloqiError: If streaming and the API responds with an error, or
+                          the access token couldn't be renewed.
+            HTTPError: If the server responds with an error that isn't JSON.
+            RateLimitExceeded: If the session's rate limit was exceeded.
+            URLError: If the server couldn't be reached.
+            ValueError: If a successful response isn't valid JSON.
         """
-        if not headers:
-            headers = {}
+        expires = deadline is not None and time.time() + deadline or None
+        headers = dict(headers or {})
 
         # Update the request headers
         headers.update({
             'User-Agent': self.get_user_agent_string(),
         })
 
-        # Authorize the request
-        if self.access_token:
-            headers.update({'Authorization': 'OAuth %s' % self.access_token,})
+        # Renew the access token before it expires
+        if path != 'oauth/token':
+            self.check_access_token(time_left(expires))
 
-        # Execute request
-        f = self.execute(path, data, headers)
-        raw = f.read()
+        retry_attempt = 0
+        while True:
+            start = time.time()
 
-        # Parse response
-        response = json.loads(raw)
-        if response.has_key('error'):
-            error = response.get('error')
+            # Authorize the request
+            access_token = self.access_token
+            if access_token:
+                headers.update({'Authorization': 'OAuth %s' % access_token,})
+            else:
+                headers.pop('Authorization', None)
 
-            if error == 'expired_token':
-                # Our access token has expired
-                if self.retry_attempt < 1:
-                    self.renew_access_token()
+            # Check for a cached response
+            entry = None
+            if self.cache and data is None and not stream:
+                headers.pop('If-None-Match', None)
+                headers.pop('If-Modified-Since', None)
 
-                    # Retry the request
-                    self.retry_attempt += 1
-                    return self.run(path, data, headers)
+                entry = self.cache.lookup(path, access_token)
+                if entry is not None:
+                    if entry.is_fresh():
+                        return entry.response
+                    headers.update(entry.validators())
+
+            # Execute request
+            try:
+                f = self.send(path, data, headers, timeout, time_left(expires))
+            except URLError, e:
+                self.record(path, data, start, e)
+                raise
+            if entry is not None and getattr(f, 'code', None) == 304:
+                # Finish the empty body so its connection can be reused
+                if getattr(f, 'fp', None) is not None:
+                    f.read()
+                f.close()
+                self.record(path, data, start, f)
+                return self.cache.revalidate(entry, path)
+
+            # Stream successful responses, leaving errors to be parsed below
+            if stream and not isinstance(f, URLError):
+                return self.record_stream(path, data, start, f,
+                        iter_array(f, stream is not True and stream or None))
+            read_start = time.time()
+            raw = f.read()
+
+            # Parse response
+            decode_start = time.time()
+            try:
+                response = self.codec.loads(raw)
+            except ValueError:
+                self.record(path, data, start, f, error='invalid_response',
+                        read=decode_start - read_start)
+                if isinstance(f, HTTPError):
+                    # An error page rather than an API error, such as a 502
+                    # from a proxy. Raise it with the body that was read.
+                    raise HTTPError(f.filename, f.code, f.msg, f.hdrs,
+                            StringIO(raw))
+                raise
+            self.record(path, data, start, f, response.get('error'),
+                    read=decode_start - read_start,
+                    decode=time.time() - decode_start)
+            if response.has_key('error'):
+                error = response.get('error')
+
+                if error == 'expired_token' and path != 'oauth/token':
+                    # Our access token has expired
+                    if retry_attempt < 1:
+                        self.refresh_access_token(access_token,
+                                time_left(expires))
+
+                        # Retry the request
+                        retry_attempt += 1
+                        continue
+                    else:
+                        # TODO: Failed to refresh the access token!
+                        pass
                 else:
-                    # TODO: Failed to refresh the access token!
+                    # TODO: Throw or log the error?
                     pass
-            else:
-                # TODO: Throw or log the error?
-                pass
+            elif self.cache:
+                if data is None:
+                    self.cache.store(path, access_token, response, f.info())
+                else:
+                    self.cache.invalidate(path)
 
-        # Reset our retry counter
-        self.retry_attempt = 0
+            if stream:
+                if response.has_key('error'):
+                    raise GeoloqiError(response)
+                if stream is True:
+                    return iter(response)
+                return iter(response.get(stream) or [])
 
-        return response
+            return response
 
-    def execute(self, path, data=None, headers=None):
+    def record(self, path, data, start, f, error=None, **timings):
+        """
+        Record a finished request in the session's metrics.
+
+        Args:
+            path: The requested path.
+            data: The request's POST data, if any.
+            start: The time the request started.
+            f: The response returned by `send`, or the exception it raised.
+            error: The API error code of the response, if any.
+
+        Any other keyword arguments are the seconds spent in other phases of
+        the request, such as 'read' and 'decode'.
+        """
+        if not self.metrics:
+            return
+
+        timings.update(get_timings(f))
+        timings['total'] = time.time() - start
+
+        status = getattr(f, 'code', None)
+        if error is None and isinstance(f, DeadlineExceeded):
+            error = 'deadline_exceeded'
+        elif error is None and isinstance(f, URLError) \
+                and not isinstance(f, HTTPError):
+            error = isinstance(f.reason, socket.timeout) and 'timeout' \
+                    or 'connection_error'
+        transfer = getattr(f, 'transfer', None)
+        if not isinstance(transfer, Transfer):
+            transfer = Transfer()
+
+        self.metrics.record({
+            'path': path,
+            'method': data is None and 'GET' or 'POST',
+            'status': isinstance(status, int) and status or None,
+            'error': error,
+            'sent': transfer.sent_wire,
+            'received': transfer.received_wire,
+            'timings': timings,
+        })
+
+    def record_stream(self, path, data, start, f, iterator):
+        """
+        Yield the elements of a streamed response, recording the request in
+        the session's metrics once the stream has been consumed.
+        """
+        error = None
+        try:
+            for element in iterator:
+                yield element
+        except GeoloqiError, e:
+            error = e.error
+            raise
+        finally:
+            self.record(path, data, start, f, error)
+
+    def stats(self):
+        """
+        Report what the session has sent and received.
+
+        Returns:
+            A dictionary holding the per-endpoint request metrics under
+            'endpoints', the byte counts from `TransferStats` under
+            'transfer' and, if the session has a response cache or a
+            coalescer, their counts under 'cache' and 'coalescer'.
+        """
+        stats = {
+            'endpoints': self.metrics and self.metrics.stats() or {},
+            'transfer': self.transfer.stats(),
+        }
+        if self.cache:
+            stats['cache'] = self.cache.stats()
+        if self.coalescer:
+            stats['coalescer'] = self.coalescer.stats()
+        return stats
+
+    def send(self, path, data=None, headers=None, timeout=None, deadline=None):
+        """
+        Execute a request, retrying transient failures according to the
+        session's `RetryPolicy`.
+
+        Args:
+            path: Path to the resource being requested (example: 'account/profile')
+            data: An optional dictonary to be sent to the server as a POST.
+            headers: An optional dictonary of extra headers to send with the request.
+            timeout: An optional timeout overriding the session's `timeout`.
+            deadline: An optional number of seconds to finish the retries in.
+
+        Returns:
+            A file like response object, or an `HTTPError` carrying the
+            server's error response.
+
+        Raises:
+            DeadlineExceeded: If no request could be sent before the deadline.
+            RateLimitExceeded: If the session's rate limit was exceeded.
+            URLError: If the server couldn't be reached.
+        """
+        policy = self.retry_policy
+        limiter = self.rate_limiter
+        start = time.time()
+        expires = deadline is not None and start + deadline or None
+        if timeout is None:
+            timeout = self.timeout
+        connect_timeout, read_timeout = split_timeout(timeout)
+        attempt = 0
+
+        while True:
+            if limiter:
+                limiter.acquire(path, self.access_token,
+                        timeout=time_left(expires, limiter.timeout))
+            f = self.execute(path, data, headers,
+                    (time_left(expires, connect_timeout),
+                    time_left(expires, read_timeout)))
+            if limiter:
+                limiter.observe(path, self.access_token, f)
+
+            if not policy.is_retryable(f, data is not None) \
+                    or attempt >= policy.max_retries:
+                break
+
+            delay = policy.get_delay(attempt, f)
+            if time.time() - start + delay > policy.budget:
+                break
+            if expires is not None and time.time() + delay >= expires:
+                break
+
+            if isinstance(f, HTTPError) and f.fp is not None:
+                f.close()
+            policy.sleep(delay)
+            attempt += 1
+
+        if isinstance(f, URLError) and not isinstance(f, HTTPError):
+            raise f
+        return f
+
+    def execute(self, path, data=None, headers=None, timeout=None):
         """
         Makes a low-level request to the Geoloqi API server. Does no
         processing of the response.
@@ -270,25 +907,53 @@ class Session:
             path: Path to the resource being requested (example: 'account/profile')
             data: An optional dictonary to be sent to the server as a POST.
             headers: An optional dictonary of extra headers to send with the request.
+            timeout: An optional timeout in seconds, or a tuple of the
+                     connect and read timeouts.
 
         Returns:
-            A file like object returned from `urllib2.urlopen`.
+            A file like response object, or the `HTTPError` or `URLError`
+            raised by the request. Responses have a `transfer` attribute
+            counting the bytes sent and received on the wire and after
+            decompression, and a `timings` attribute holding the seconds
+            spent connecting and waiting for the first byte.
         """
-        if data:
-            data = json.dumps(data)
-        if not headers:
-            headers = {}
-
-        request = urllib2.Request(API_URL_BASE_TEMPLATE % (API_VERSION, path),
+        headers = dict(headers or {})
+        if data is not None:
+            data = encode(data, self.codec)
+
+        # Compress large request bodies
+        transfer = Transfer(len(data or ''), len(data or ''))
+        if data and self.compress_threshold is not None \
+                and len(data) >= self.compress_threshold:
+            data = gzip_compress(data)
+            transfer.sent_wire = len(data)
+            headers['Content-Encoding'] = 'gzip'
+
+        request = urllib2.Request(self.url_template % (API_VERSION, path),
                 data, headers=headers)
+        request.add_unredirected_header('Accept-Encoding', ACCEPT_ENCODING)
 
-        # Execute the request
+        # The pooled handler connects with the request's connect timeout
+        connect_timeout, read_timeout = split_timeout(timeout)
+        if connect_timeout is not None:
+            request.connect_timeout = connect_timeout
+        if read_timeout is None:
+            read_timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+
+        # Execute the request over a pooled connection
         try:
-            return urllib2.urlopen(request)
+            f = self.opener.open(request, timeout=read_timeout)
         except (HTTPError, URLError), e:
-            return e
+            f = e
+
+        if isinstance(f, URLError) and not isinstance(f, HTTPError):
+            return f
+        timings = get_timings(f)
+        f = decode_response(f, transfer, self.transfer)
+        f.timings = timings
+        return f
 
-    def establish(self, data):
+    def establish(self, data, **kwargs):
         """
         Used to retrieve the access token from the Geoloqi OAuth2 server. This
         is used internally and you shouldn't need to call it manually.
@@ -298,30 +963,183 @@ class Session:
                   include the OAuth2 'grant_type' and other data like your
                   refresh token.
 
+        Any other keyword arguments, such as `deadline`, are passed on to `run`.
+
         Returns:
             None
+
+        Raises:
+            GeoloqiError: If the OAuth server responds with an error, in which
+                          case the current token is kept.
+        """
+        self.request_token(data, **kwargs)
+
+        # Share the new token with other processes
+        if self.token_cache and self.api_key and self.access_token:
+            self.token_cache.set(self.api_key, self.auth, self.expires_at)
+
+    def request_token(self, data, **kwargs):
+        """
+        Retrieve an access token from the OAuth2 server and store it on the
+        session, without sharing it through the `TokenCache`.
+
+        Raises:
+            GeoloqiError: If the OAuth server responds with an error.
         """
         data.update({
             'client_id': self.api_key,
             'client_secret': self.api_secret,
         })
 
-        self.auth = self.post('oauth/token', data)
+        auth = self.post('oauth/token', data, **kwargs)
+        if auth.has_key('error'):
+            raise GeoloqiError(auth)
+        self.auth = auth
+
+        # Note when the token expires so it can be renewed ahead of time
+        expires_in = self.auth.get('expires_in')
+        self.expires_at = expires_in and time.time() + float(expires_in) or None
         self.access_token = self.auth.get('access_token')
 
-    def renew_access_token(self):
+    def renew_access_token(self, **kwargs):
         """
         Renew the access token using the stored refresh token. This method is
         called automatically when the server returns an expired_token response,
         so you shouldn't need to call it manually.
 
+        Any keyword arguments, such as `deadline`, are passed on to `run`.
+
         Returns:
             None
+
+        If the session has a `TokenCache`, the renewal holds its lock and
+        uses the newest refresh token stored there, since another process
+        may have renewed the token and been issued a new refresh token. A
+        token another process has already renewed is used as it is.
+
+        Raises:
+            GeoloqiError: If the OAuth server responds with an error.
         """
-        self.establish({
-            'grant_type': 'refresh_token',
-            'refresh_token': self.auth.get('refresh_token'),
-        })
+        if not (self.token_cache and self.api_key):
+            self.establish({
+                'grant_type': 'refresh_token',
+                'refresh_token': self.auth.get('refresh_token'),
+            }, **kwargs)
+            return
+
+        def renew(entry):
+            if entry and entry.get('access_token') != self.access_token and \
+                    (entry.get('expires_at') or float('inf')) > time.time():
+                self.use_token(entry)
+                return None
+
+            refresh_token = entry and entry.get('refresh_token') or \
+                    self.auth.get('refresh_token')
+            self.request_token({
+                'grant_type': 'refresh_token',
+                'refresh_token': refresh_token,
+            }, **kwargs)
+            # Keep the refresh token if the server didn't issue a new one
+            self.auth.setdefault('refresh_token', refresh_token)
+            return self.auth, self.expires_at
+
+        self.token_cache.update(self.api_key, renew)
+
+    def refresh_access_token(self, expired_token, deadline=None):
+        """
+        Renew an access token that the server reported as expired, unless
+        another thread has already replaced it. Concurrent callers wait for
+        a single renewal instead of each sending their own.
+
+        Args:
+            expired_token: The access token that was rejected by the server.
+            deadline: An optional number of seconds to finish the renewal in,
+                      including any wait for another thread's renewal.
+
+        Returns:
+            The current access token as a String.
+
+        Raises:
+            DeadlineExceeded: If the token couldn't be renewed in time.
+            GeoloqiError: If the OAuth server responds with an error.
+        """
+        expires = deadline is not None and time.time() + deadline or None
+        if not self.acquire_token_lock(expires):
+            raise DeadlineExceeded()
+        try:
+            if self.access_token == expired_token:
+                self.renew_access_token(deadline=time_left(expires))
+            return self.access_token
+        finally:
+            self.token_lock.release()
+
+    def acquire_token_lock(self, expires=None):
+        """
+        Acquire the token lock, giving up once a deadline has passed.
+
+        Args:
+            expires: The time the deadline passes, or None to wait for as
+                     long as it takes.
+
+        Returns:
+            True if the lock was acquired.
+        """
+        if expires is None:
+            return self.token_lock.acquire()
+
+        while not self.token_lock.acquire(False):
+            if time.time() >= expires:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def check_access_token(self, deadline=None):
+        """
+        Renew the access token if it is about to expire. A token that is
+        within `refresh_margin` seconds of expiring is renewed in the
+        background, while one that has already expired is renewed before
+        returning. This method is called automatically before each request,
+        so you shouldn't need to call it manually.
+
+        Args:
+            deadline: An optional number of seconds to finish a renewal in.
+
+        Returns:
+            None
+        """
+        if self.expires_at is None or not (self.auth and self.auth.get('refresh_token')):
+            return
+
+        remaining = self.expires_at - time.time()
+        if remaining <= 0:
+            self.refresh_access_token(self.access_token, deadline)
+        elif remaining <= self.refresh_margin:
+            self.start_background_refresh()
+
+    def start_background_refresh(self):
+        """
+        Renew the access token in a background thread, unless a renewal is
+        already under way.
+
+        Returns:
+            None
+        """
+        if not self.token_lock.acquire(False):
+            return
+
+        def refresh():
+            try:
+                if self.expires_at - time.time() <= self.refresh_margin:
+                    self.renew_access_token()
+            except Exception:
+                # The token will be renewed again before the next request.
+                pass
+            finally:
+                self.token_lock.release()
+
+        self.refresh_thread = threading.Thread(target=refresh)
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
 
     def get_access_token(self):
         """
@@ -331,17 +1149,49 @@ class Session:
         user within the app.
 
         This call makes a request to the API server once for each instantiation
-        of the object, then cache the result on the object.
+        of the object, then cache the result on the object. If the session has
+        a `TokenCache` holding an unexpired token for the application, that
+        token is used instead.
 
         Returns:
             The current access token as a String.
         """
         if not self.access_token:
-            self.establish({
-                'grant_type': 'client_credentials',
-            })
+            with self.token_lock:
+                if not self.access_token and self.token_cache:
+                    self.load_cached_token()
+                if not self.access_token:
+                    self.establish({
+                        'grant_type': 'client_credentials',
+                    })
         return self.access_token
 
+    def load_cached_token(self):
+        """
+        Use the application's token from the session's `TokenCache`, if it
+        holds one that hasn't expired.
+
+        Returns:
+            True if a cached token was loaded.
+        """
+        auth = self.token_cache.get(self.api_key)
+        if not auth:
+            return False
+
+        self.use_token(auth)
+        return True
+
+    def use_token(self, entry):
+        """
+        Use a token stored in the `TokenCache`.
+
+        Args:
+            entry: The cached OAuth response with its 'expires_at' timestamp.
+        """
+        self.auth = entry
+        self.expires_at = entry.get('expires_at')
+        self.access_token = entry.get('access_token')
+
     def get_user_agent_string(self):
         """
         Retrieve a 'User-Agent' string to be used when making API requests.
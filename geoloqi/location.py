@@ -0,0 +1,66 @@
+"""
+Helpers for reading the position and time of location updates and
+measuring the distance between them.
+"""
+import calendar
+import math
+import time
+
+EARTH_RADIUS = 6371009.0
+
+# Meters in a degree of latitude
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """
+    Calculate the great circle distance between two points.
+
+    Returns:
+        The distance in meters.
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+            math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+def position(point):
+    """
+    Find the latitude and longitude of a location update, which may either
+    be in the API's nested 'location' form or have top level 'latitude' and
+    'longitude' keys.
+
+    Returns:
+        A tuple of latitude and longitude, or None.
+    """
+    pos = point.get('location', {}).get('position', point)
+    try:
+        return float(pos['latitude']), float(pos['longitude'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def point_time(point):
+    """
+    Find the time of a location update, from its 'date_ts' or its ISO 8601
+    'date' (example: '2012-03-07T10:00:00-08:00').
+
+    Returns:
+        A Unix timestamp, or None.
+    """
+    if point.get('date_ts') is not None:
+        return float(point['date_ts'])
+
+    date = point.get('date')
+    if not date:
+        return None
+    try:
+        timestamp = calendar.timegm(time.strptime(date[:19], '%Y-%m-%dT%H:%M:%S'))
+        offset = date[19:].replace(':', '')
+        if offset and offset != 'Z':
+            sign = offset[0] == '-' and -1 or 1
+            timestamp -= sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+        return float(timestamp)
+    except (ValueError, IndexError):
+        return None
@@ -0,0 +1,232 @@
+"""
+Request counts, error counts and latency histograms for API requests.
+"""
+import bisect
+import threading
+
+PHASES = ('connect', 'first_byte', 'read', 'decode', 'total')
+
+
+def get_timings(f):
+    """
+    Find the phase timings recorded for a response by the pooled handler.
+
+    Args:
+        f: The response returned by `urllib2`, or the `HTTPError` raised.
+
+    Returns:
+        A dictionary mapping phase names to seconds.
+    """
+    timings = getattr(f, 'timings', None)
+    if not isinstance(timings, dict):
+        timings = getattr(getattr(f, 'fp', None), 'timings', None)
+    if not isinstance(timings, dict):
+        return {}
+    return dict(timings)
+
+
+class Histogram:
+    """
+    A histogram of latencies in logarithmically spaced buckets, each 10%
+    wider than the last, from 1 microsecond to about 2 minutes. Percentiles
+    are reported as the upper bound of the bucket they fall in, so they are
+    never more than 10% too high. Histograms are not thread-safe.
+    """
+    growth = 1.1
+    bounds = [0.000001 * growth ** i for i in range(196)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """
+        Add a latency to the histogram.
+
+        Args:
+            value: The latency in seconds.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Estimate a percentile of the latencies.
+
+        Args:
+            percent: The percentile, between 0 and 100.
+
+        Returns:
+            The latency in seconds, or None if the histogram is empty.
+        """
+        if not self.count:
+            return None
+
+        rank = max(1, percent / 100.0 * self.count)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        if index == len(self.bounds):
+            return self.max
+        return max(self.min, min(self.max, self.bounds[index]))
+
+    def stats(self):
+        """
+        Summarize the histogram.
+
+        Returns:
+            A dictionary of the count, mean, minimum, maximum and the 50th,
+            95th and 99th percentiles, in seconds.
+        """
+        return {
+            'count': self.count,
+            'mean': self.count and self.sum / self.count or None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class EndpointStats:
+    """
+    The running totals for requests to one endpoint.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = {}
+        self.sent = 0
+        self.received = 0
+        self.latency = dict((phase, Histogram()) for phase in PHASES)
+
+    def add(self, sample):
+        self.requests += 1
+        error = sample.get('error')
+        if error is not None:
+            self.errors[error] = self.errors.get(error, 0) + 1
+        self.sent += sample.get('sent') or 0
+        self.received += sample.get('received') or 0
+
+        for phase, seconds in sample.get('timings', {}).items():
+            if phase in self.latency and seconds is not None:
+                self.latency[phase].add(seconds)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'errors': dict(self.errors),
+            'sent': self.sent,
+            'received': self.received,
+            'latency': dict((phase, histogram.stats())
+                    for phase, histogram in self.latency.items()
+                    if histogram.count),
+        }
+
+
+class Metrics:
+    """
+    Thread-safe per-endpoint request metrics, which may be shared by many
+    sessions.
+
+    Each finished request is recorded as a sample: a dictionary with the
+    request's 'path', 'endpoint', 'method', HTTP 'status', API 'error'
+    code, the bytes 'sent' and 'received' on the wire and its 'timings',
+    the seconds spent in each of the phases 'connect', 'first_byte',
+    'read', 'decode' and 'total'. Hooks are called with every sample, so
+    they can be forwarded to another metrics system:
+
+    ::
+
+        >>> g.session.metrics.add_hook(lambda sample: statsd.timing(
+        ...         sample['endpoint'], sample['timings']['total'] * 1000))
+    """
+
+    def __init__(self, hooks=None):
+        """
+        Create a new metrics collector.
+
+        Args:
+            hooks: An optional list of functions called with each sample.
+        """
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.hooks = list(hooks or [])
+
+    def add_hook(self, hook):
+        """
+        Call a function with every sample recorded from now on.
+
+        Args:
+            hook: A function taking a sample dictionary.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def get_endpoint(self, path):
+        """
+        Name the endpoint requests to a path are counted under. Override
+        this to group paths that embed identifiers.
+
+        Args:
+            path: The requested path.
+
+        Returns:
+            The endpoint name.
+        """
+        return path.split('?', 1)[0]
+
+    def record(self, sample):
+        """
+        Record a finished request and pass it to the hooks.
+
+        Args:
+            sample: The sample dictionary describing the request.
+        """
+        sample.setdefault('endpoint', self.get_endpoint(sample.get('path', '')))
+        with self.lock:
+            stats = self.endpoints.get(sample['endpoint'])
+            if stats is None:
+                stats = self.endpoints[sample['endpoint']] = EndpointStats()
+            stats.add(sample)
+
+        for hook in list(self.hooks):
+            try:
+                hook(sample)
+            except Exception:
+                # A broken metrics exporter shouldn't break API requests
+                pass
+
+    def stats(self):
+        """
+        Report the metrics recorded so far.
+
+        Returns:
+            A dictionary mapping endpoint names to their request and error
+            counts, bytes sent and received, and latency summaries for
+            each phase.
+        """
+        with self.lock:
+            return dict((endpoint, stats.stats())
+                    for endpoint, stats in self.endpoints.items())
+
+    def reset(self):
+        """
+        Forget every recorded sample.
+        """
+        with self.lock:
+            self.endpoints = {}
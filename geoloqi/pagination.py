@@ -0,0 +1,142 @@
+"""
+Iterators that page through Geoloqi API list and history endpoints.
+"""
+import json
+import sys
+import threading
+
+from errors import GeoloqiError
+
+
+class Prefetch:
+    """
+    Fetches a page in a background thread.
+    """
+
+    def __init__(self, fetch, args):
+        self.result = None
+        self.exc_info = None
+        self.thread = threading.Thread(target=self.run, args=(fetch, args))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, fetch, args):
+        try:
+            self.result = fetch(args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def get(self):
+        self.thread.join()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+def paginate(fetch, args, key, next_args, prefetch=True, record_id=None):
+    """
+    Yield the records from each page of an API response in turn.
+
+    Only the current page and, when prefetching, the next one are held in
+    memory. The next page is requested in the background as soon as the
+    current page arrives.
+
+    Args:
+        fetch: A function that requests a page given a dictionary of GET
+               arguments and returns the JSON response.
+        args: The GET arguments for the first page.
+        key: The key of the list of records in each response.
+        next_args: A function called with the current arguments, response
+                   and records that returns the arguments for the next page,
+                   or None if this was the last page.
+        prefetch: Request the next page while the current one is consumed.
+        record_id: An optional function giving a hashable identity of a
+                   record, for endpoints whose pages may overlap. Records
+                   with the same identity as one on the previous page are
+                   skipped.
+
+    Raises:
+        GeoloqiError: If the API responds with an error.
+    """
+    page = fetch(args)
+    seen = set()
+    while True:
+        if page.has_key('error'):
+            raise GeoloqiError(page)
+
+        records = page.get(key) or []
+        args = next_args(args, page, records)
+
+        pending = None
+        if args is not None and prefetch:
+            pending = Prefetch(fetch, args)
+
+        for record in records:
+            if record_id is None or record_id(record) not in seen:
+                yield record
+        if record_id is not None:
+            seen = set(record_id(record) for record in records)
+        records = page = None
+
+        if args is None:
+            return
+        if pending is not None:
+            page = pending.get()
+        else:
+            page = fetch(args)
+
+
+def history_args(args, page, points, page_size=None):
+    """
+    Page through location history in ascending time order, continuing from
+    the second of the last point. Points in that second may be split across
+    pages, so the next page starts with all of them again, and those already
+    returned are skipped by `history_id`. Timestamps are taken as whole
+    seconds, as the API returns them.
+
+    A page that is all one second is followed by one twice the size, so
+    paging makes progress, and the size goes back to `page_size` once a
+    page moves past a second.
+    """
+    if len(points) < int(args['count']):
+        return None
+
+    args = dict(args)
+    last = int(points[-1]['date_ts'])
+    args['after'] = last - 1
+    if int(points[0]['date_ts']) == last:
+        args['count'] = 2 * int(args['count'])
+    elif page_size is not None:
+        args['count'] = page_size
+    return args
+
+
+def history_id(point):
+    """
+    Identify a location history point by its time and uuid, or by all of
+    its fields if it has no uuid.
+    """
+    if point.get('uuid') is not None:
+        return point['date_ts'], point['uuid']
+    return json.dumps(point, sort_keys=True)
+
+
+def offset_args(args, page, records):
+    """
+    Page through a list by offset, following the server's 'paging'
+    information when it is provided.
+    """
+    paging = page.get('paging')
+    if paging is not None:
+        offset = paging.get('next_offset')
+    elif len(records) < int(args['count']):
+        offset = None
+    else:
+        offset = int(args.get('offset', 0)) + len(records)
+
+    if offset is None:
+        return None
+
+    args = dict(args)
+    args['offset'] = offset
+    return args
@@ -0,0 +1,278 @@
+"""
+Persistent keep-alive connection pooling for the Geoloqi API.
+"""
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urllib2
+
+from collections import deque
+from urllib2 import URLError
+
+# Methods that can be sent again without repeating their side effects
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS',
+        'TRACE'])
+
+
+def get_timeout(timeout):
+    """
+    Resolve a socket timeout, replacing the default timeout marker used by
+    `httplib` and `urllib2` with the current default.
+    """
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        return socket.getdefaulttimeout()
+    return timeout
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of persistent HTTP and HTTPS connections.
+
+    Idle connections are kept per host and reused by later requests, so
+    repeated API calls skip the TCP connect and TLS handshake. At most
+    `maxsize` idle connections are kept for each host, and connections
+    that have sat idle for longer than `idle_timeout` seconds are closed
+    instead of being reused.
+    """
+    maxsize = 10
+    idle_timeout = 60
+
+    def __init__(self, maxsize=None, idle_timeout=None, context=None):
+        """
+        Create a new connection pool.
+
+        Args:
+            maxsize: The maximum number of idle connections to keep per host.
+            idle_timeout: The number of seconds an idle connection may be
+                          kept before it is discarded.
+            context: An optional `ssl.SSLContext` used for HTTPS connections.
+        """
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        self.context = context
+
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def acquire(self, scheme, host, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        """
+        Check a connection out of the pool, opening a new one if no idle
+        connection to the host is available.
+
+        Args:
+            scheme: Either 'http' or 'https'.
+            host: The host (and optional port) to connect to.
+            timeout: The socket timeout for the connection.
+
+        Returns:
+            A tuple of the connection and a boolean that is True if the
+            connection was reused from the pool.
+        """
+        now = time.time()
+        with self.lock:
+            idle = self.connections.get((scheme, host))
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    if conn.sock is not None:
+                        conn.sock.settimeout(get_timeout(timeout))
+                    return conn, True
+                conn.close()
+
+        return self.connect(scheme, host, timeout), False
+
+    def release(self, scheme, host, conn):
+        """
+        Return a connection to the pool so it can be reused. The connection
+        is closed if the pool for the host is already full.
+
+        Args:
+            scheme: Either 'http' or 'https'.
+            host: The host the connection is connected to.
+            conn: The connection being returned.
+        """
+        with self.lock:
+            idle = self.connections.setdefault((scheme, host), deque())
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def connect(self, scheme, host, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        """
+        Open a new connection to a host.
+
+        Args:
+            scheme: Either 'http' or 'https'.
+            host: The host (and optional port) to connect to.
+            timeout: The socket timeout for the connection.
+
+        Returns:
+            A new `httplib.HTTPConnection` or `httplib.HTTPSConnection`.
+        """
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=timeout,
+                    context=self.context)
+        return httplib.HTTPConnection(host, timeout=timeout)
+
+    def clear(self):
+        """
+        Close every idle connection held by the pool.
+        """
+        with self.lock:
+            connections, self.connections = self.connections, {}
+
+        for idle in connections.values():
+            for conn, last_used in idle:
+                conn.close()
+
+    def size(self):
+        """
+        Count the idle connections currently held by the pool.
+
+        Returns:
+            The number of idle connections.
+        """
+        with self.lock:
+            return sum(len(idle) for idle in self.connections.values())
+
+
+class PooledResponseBody:
+    """
+    A socket-like wrapper around an `httplib.HTTPResponse` that hands its
+    connection back to the pool once the body has been fully read.
+    """
+
+    def __init__(self, pool, scheme, host, conn, response):
+        self.pool = pool
+        self.scheme = scheme
+        self.host = host
+        self.conn = conn
+        self.response = response
+
+    def recv(self, amt=None):
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self.release()
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed():
+            self.release()
+        else:
+            # The body was abandoned part way through, so the connection
+            # can't be reused for another request.
+            self.response.close()
+            self.conn.close()
+            self.conn = None
+
+    def release(self):
+        if self.conn is None:
+            return
+        if self.response.will_close:
+            self.conn.close()
+        else:
+            self.pool.release(self.scheme, self.host, self.conn)
+        self.conn = None
+
+
+class PooledHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """
+    A `urllib2` handler that sends HTTP and HTTPS requests over connections
+    borrowed from a `ConnectionPool`.
+    """
+
+    def __init__(self, pool=None):
+        """
+        Create a new pooled handler.
+
+        Args:
+            pool: The `ConnectionPool` to borrow connections from. A new pool
+                  is created if one isn't provided.
+        """
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool or ConnectionPool()
+
+    def http_open(self, req):
+        return self.pooled_open('http', req)
+
+    def https_open(self, req):
+        return self.pooled_open('https', req)
+
+    def pooled_open(self, scheme, req):
+        """
+        Send a request over a pooled connection.
+
+        Args:
+            scheme: Either 'http' or 'https'.
+            req: The `urllib2.Request` being sent.
+
+        Returns:
+            A file like `urllib.addinfourl` response. Its `timings`
+            attribute holds the seconds spent waiting for the first byte
+            of the response, and connecting if a new connection was opened.
+
+        A reused connection may have been closed by the server while it was
+        idle, so a request that fails on one is sent again on another,
+        unless it had already been written and its method isn't idempotent.
+
+        Raises:
+            URLError: If the request could not be sent.
+        """
+        host = req.get_host()
+        if not host:
+            raise URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        # Requests may be given a shorter timeout for connecting than for
+        # reading the response.
+        connect_timeout = getattr(req, 'connect_timeout', req.timeout)
+
+        idempotent = req.get_method() in IDEMPOTENT_METHODS
+        while True:
+            conn, reused = self.pool.acquire(scheme, host, connect_timeout)
+            written = False
+            try:
+                start = time.time()
+                connecting = conn.sock is None
+                if connecting:
+                    conn.connect()
+                if connect_timeout is not req.timeout:
+                    conn.sock.settimeout(get_timeout(req.timeout))
+                sent = time.time()
+                conn.request(req.get_method(), req.get_selector(), req.data,
+                        headers)
+                written = True
+                r = conn.getresponse(buffering=True)
+                break
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if not reused or isinstance(e, socket.timeout):
+                    raise URLError(e)
+                if written and not idempotent:
+                    # The server may have acted on the request before
+                    # closing the connection, so it can't safely be sent
+                    # again.
+                    raise URLError(e)
+                # The server closed an idle connection, so try again.
+
+        body = PooledResponseBody(self.pool, scheme, host, conn, r)
+        fp = socket._fileobject(body, close=True)
+
+        resp = urllib.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        resp.timings = {'first_byte': time.time() - sent}
+        if connecting:
+            resp.timings['connect'] = sent - start
+        return resp
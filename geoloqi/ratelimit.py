@@ -0,0 +1,342 @@
+"""
+Client-side rate limiting of Geoloqi API requests.
+"""
+import os
+import struct
+import threading
+import time
+
+from collections import OrderedDict
+from errors import RateLimitExceeded
+from retry import get_retry_after
+from urllib2 import HTTPError
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket that allows `rate` requests per second on
+    average, with bursts of up to `capacity` requests.
+
+    The rate adapts to the server. When a request is throttled with a 429
+    response the rate is halved, down to `min_rate`, and no tokens are
+    handed out until the server's Retry-After time has passed. Each
+    successful request then recovers a tenth of the configured rate.
+    """
+    recovery = 0.1
+
+    def __init__(self, rate, capacity=None, min_rate=None):
+        """
+        Create a new token bucket, initially full.
+
+        Args:
+            rate: The number of requests allowed per second.
+            capacity: The largest burst of requests allowed. Defaults to
+                      one second's worth of requests.
+            min_rate: The lowest rate 429 responses can slow the bucket to.
+                      Defaults to a tenth of `rate`.
+        """
+        self.max_rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.min_rate = float(min_rate or rate / 10.0)
+        self.lock = threading.Lock()
+        self.state = (self.capacity, time.time(), self.max_rate, 0.0)
+
+    def load(self):
+        """
+        Read the bucket's state: the number of tokens, when they were last
+        counted, the current rate and when any throttling pause ends.
+        """
+        return self.state
+
+    def store(self, state):
+        self.state = state
+
+    def update(self, func):
+        """
+        Apply a function to the bucket's state while holding its lock.
+
+        Args:
+            func: A function taking the current state and the time, and
+                  returning the new state and a result.
+
+        Returns:
+            The function's result.
+        """
+        with self.lock:
+            state, result = func(self.load(), time.time())
+            self.store(state)
+        return result
+
+    def refill(self, state, now):
+        tokens, updated, rate, paused_until = state
+        tokens = min(self.capacity, tokens + max(0, now - updated) * rate)
+        return tokens, now, rate, paused_until
+
+    def take(self, count=1):
+        """
+        Take tokens from the bucket if enough are available.
+
+        Args:
+            count: The number of tokens to take.
+
+        Returns:
+            0 if the tokens were taken, otherwise the number of seconds
+            until they should be available.
+        """
+        def take(state, now):
+            tokens, updated, rate, paused_until = self.refill(state, now)
+            if now < paused_until:
+                return (tokens, updated, rate, paused_until), paused_until - now
+            if tokens >= count:
+                return (tokens - count, updated, rate, paused_until), 0
+            return (tokens, updated, rate, paused_until), (count - tokens) / rate
+        return self.update(take)
+
+    def give(self, count=1):
+        """
+        Return unused tokens to the bucket.
+        """
+        def give(state, now):
+            tokens, updated, rate, paused_until = self.refill(state, now)
+            return (min(self.capacity, tokens + count), updated, rate, paused_until), None
+        self.update(give)
+
+    def acquire(self, count=1, block=True, timeout=None):
+        """
+        Take tokens from the bucket, waiting for them if necessary.
+
+        Args:
+            count: The number of tokens to take.
+            block: Wait for tokens rather than failing straight away.
+            timeout: The maximum number of seconds to wait.
+
+        Returns:
+            True if the tokens were taken.
+        """
+        deadline = timeout is not None and time.time() + timeout or None
+        while True:
+            wait = self.take(count)
+            if not wait:
+                return True
+            if not block or (deadline is not None and time.time() + wait > deadline):
+                return False
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        """
+        Slow the bucket down after the server throttled a request.
+
+        Args:
+            retry_after: The number of seconds the server asked us to wait.
+        """
+        def throttled(state, now):
+            tokens, updated, rate, paused_until = self.refill(state, now)
+            rate = max(self.min_rate, rate / 2)
+            if retry_after:
+                paused_until = max(paused_until, now + retry_after)
+            return (0.0, updated, rate, paused_until), None
+        self.update(throttled)
+
+    def succeeded(self):
+        """
+        Speed the bucket back up after a request that wasn't throttled.
+        """
+        def succeeded(state, now):
+            tokens, updated, rate, paused_until = self.refill(state, now)
+            rate = min(self.max_rate, rate + self.max_rate * self.recovery)
+            return (tokens, updated, rate, paused_until), None
+        if self.rate < self.max_rate:
+            self.update(succeeded)
+
+    @property
+    def rate(self):
+        return self.load()[2]
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    A token bucket whose state is kept in a small file, so one bucket can
+    be shared by every process on a machine. Updates hold an exclusive
+    lock on the file. Putting the file on a memory backed filesystem such
+    as `/dev/shm` avoids touching the disk.
+    """
+    format = '<dddd'
+
+    def __init__(self, path, rate, capacity=None, min_rate=None):
+        """
+        Create a new file backed token bucket, or attach to an existing one.
+
+        Args:
+            path: The file holding the bucket's state.
+            rate: The number of requests allowed per second.
+            capacity: The largest burst of requests allowed.
+            min_rate: The lowest rate 429 responses can slow the bucket to.
+        """
+        TokenBucket.__init__(self, rate, capacity, min_rate)
+        self.path = path
+        self.fd = None
+
+    def load(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        data = os.read(self.fd, struct.calcsize(self.format))
+        if len(data) < struct.calcsize(self.format):
+            return (self.capacity, time.time(), self.max_rate, 0.0)
+        return struct.unpack(self.format, data)
+
+    def store(self, state):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, struct.pack(self.format, *state))
+
+    def update(self, func):
+        with self.lock:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_EX)
+                state, result = func(self.load(), time.time())
+                self.store(state)
+            finally:
+                os.close(self.fd)
+                self.fd = None
+        return result
+
+    @property
+    def rate(self):
+        return self.update(lambda state, now: (state, state[2]))
+
+
+class RateLimiter:
+    """
+    Holds requests back until the token buckets that apply to them allow
+    them to be sent. A limiter may be shared by many sessions.
+
+    A request takes a token from the `shared` bucket, from the bucket for
+    its access token when `per_token` is set, and from the bucket for the
+    longest matching path prefix in `prefixes`:
+
+    ::
+
+        >>> limiter = RateLimiter(TokenBucket(50), per_token=(5, 10),
+        ...         prefixes={'location/update': TokenBucket(20)})
+        >>> g = Geoloqi(rate_limiter=limiter)
+
+    The buckets of at most `maxsize` access tokens are kept. The least
+    recently used are dropped, so a token seen again after that starts
+    with a full bucket.
+    """
+    shared = None
+    per_token = None
+    block = True
+    timeout = None
+    maxsize = 10000
+
+    def __init__(self, shared=None, per_token=None, prefixes=None, block=None,
+            timeout=None, maxsize=None):
+        """
+        Create a new rate limiter.
+
+        Args:
+            shared: An optional bucket used by every request.
+            per_token: An optional tuple of the rate and capacity of the
+                       bucket created for each access token.
+            prefixes: An optional dictionary mapping path prefixes (example:
+                      'location/update') to buckets.
+            block: Wait for tokens rather than rejecting requests.
+            timeout: The maximum number of seconds to wait for tokens.
+            maxsize: The maximum number of access tokens to keep buckets for.
+        """
+        self.shared = shared
+        self.per_token = per_token
+        self.prefixes = prefixes or {}
+        if block is not None:
+            self.block = block
+        if timeout is not None:
+            self.timeout = timeout
+        if maxsize is not None:
+            self.maxsize = maxsize
+
+        self.lock = threading.Lock()
+        self.tokens = OrderedDict()
+
+    def get_buckets(self, path, access_token=None):
+        """
+        Find the buckets that apply to a request.
+
+        Args:
+            path: The requested path.
+            access_token: The access token the request is made with.
+
+        Returns:
+            A list of token buckets.
+        """
+        buckets = []
+        if self.shared is not None:
+            buckets.append(self.shared)
+
+        if self.per_token is not None and access_token:
+            with self.lock:
+                bucket = self.tokens.pop(access_token, None)
+                if bucket is None:
+                    bucket = TokenBucket(*self.per_token)
+                self.tokens[access_token] = bucket
+                while len(self.tokens) > self.maxsize:
+                    self.tokens.popitem(last=False)
+            buckets.append(bucket)
+
+        path = path.split('?', 1)[0]
+        prefixes = [prefix for prefix in self.prefixes if path.startswith(prefix)]
+        if prefixes:
+            buckets.append(self.prefixes[max(prefixes, key=len)])
+        return buckets
+
+    def acquire(self, path, access_token=None, block=None, timeout=None):
+        """
+        Wait until a request may be sent.
+
+        Args:
+            path: The requested path.
+            access_token: The access token the request is made with.
+            block: Wait for tokens rather than rejecting the request.
+                   Defaults to the limiter's `block` setting.
+            timeout: The maximum number of seconds to wait.
+
+        Raises:
+            RateLimitExceeded: If the request can't be sent in time.
+        """
+        if block is None:
+            block = self.block
+        if timeout is None:
+            timeout = self.timeout
+        deadline = timeout is not None and time.time() + timeout or None
+
+        taken = []
+        for bucket in self.get_buckets(path, access_token):
+            remaining = deadline and max(0, deadline - time.time())
+            if not bucket.acquire(1, block, remaining):
+                for other in taken:
+                    other.give(1)
+                raise RateLimitExceeded('Rate limit exceeded for %s' % path)
+            taken.append(bucket)
+
+    def observe(self, path, access_token, f):
+        """
+        Adapt the buckets for a request to the server's response.
+
+        Args:
+            path: The requested path.
+            access_token: The access token the request was made with.
+            f: The response or exception returned by `Session.execute`.
+        """
+        buckets = self.get_buckets(path, access_token)
+        if isinstance(f, HTTPError) and f.code == 429:
+            retry_after = get_retry_after(f)
+            for bucket in buckets:
+                bucket.throttled(retry_after)
+        else:
+            for bucket in buckets:
+                bucket.succeeded()
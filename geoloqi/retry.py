@@ -0,0 +1,126 @@
+"""
+Retrying failed requests with exponential backoff.
+"""
+import random
+import socket
+import time
+
+from email.utils import mktime_tz, parsedate_tz
+from urllib2 import HTTPError, URLError
+
+
+def get_retry_after(f):
+    """
+    Read the Retry-After header of a response, which is either a number of
+    seconds or an HTTP date.
+
+    Args:
+        f: The response or exception returned by `Session.execute`.
+
+    Returns:
+        The number of seconds to wait, or None.
+    """
+    if not isinstance(f, HTTPError) or f.hdrs is None:
+        return None
+
+    value = f.hdrs.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, mktime_tz(date) - time.time())
+
+
+class RetryPolicy:
+    """
+    Decides which failed requests to retry and how long to wait first.
+
+    Connection errors and responses with one of the `statuses` are retried
+    up to `max_retries` times. The wait before each retry grows
+    exponentially from `backoff` seconds up to `max_backoff`, with full
+    random jitter so that many clients don't retry in lockstep, and is
+    never shorter than the server's Retry-After header. A request gives up
+    early rather than let its retries run past `budget` seconds in total.
+
+    POSTs may not be safe to repeat, so unless `retry_post` is set they are
+    only retried when the server is known not to have processed them (a
+    429 response).
+    """
+    max_retries = 3
+    backoff = 0.5
+    max_backoff = 30
+    budget = 60
+    statuses = (429, 500, 502, 503, 504)
+    retry_post = False
+
+    def __init__(self, max_retries=None, backoff=None, max_backoff=None,
+            budget=None, statuses=None, retry_post=None):
+        """
+        Create a new retry policy.
+
+        Args:
+            max_retries: The maximum number of retries per request.
+            backoff: The base number of seconds to wait before retrying.
+            max_backoff: The maximum number of seconds to wait between tries.
+            budget: The maximum number of seconds to spend on one request.
+            statuses: The HTTP status codes worth retrying.
+            retry_post: Retry POSTs after connection errors and server errors.
+        """
+        if max_retries is not None:
+            self.max_retries = max_retries
+        if backoff is not None:
+            self.backoff = backoff
+        if max_backoff is not None:
+            self.max_backoff = max_backoff
+        if budget is not None:
+            self.budget = budget
+        if statuses is not None:
+            self.statuses = statuses
+        if retry_post is not None:
+            self.retry_post = retry_post
+
+    def is_retryable(self, f, post=False):
+        """
+        Decide whether a request's outcome is a transient failure.
+
+        Args:
+            f: The response or exception returned by `Session.execute`.
+            post: True if the request was a POST.
+
+        Returns:
+            True if the request should be retried.
+        """
+        if isinstance(f, HTTPError):
+            if f.code == 429:
+                return True
+            return f.code in self.statuses and (self.retry_post or not post)
+        if isinstance(f, (URLError, socket.error)):
+            return self.retry_post or not post
+        return False
+
+    def get_delay(self, attempt, f=None):
+        """
+        Calculate how long to wait before a retry.
+
+        Args:
+            attempt: The number of retries already made.
+            f: The failed response, checked for a Retry-After header.
+
+        Returns:
+            The number of seconds to wait.
+        """
+        delay = random.uniform(0, min(self.max_backoff,
+                self.backoff * (2 ** attempt)))
+
+        retry_after = get_retry_after(f)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
@@ -0,0 +1,307 @@
+"""
+Simplification and compact encoding of location tracks.
+"""
+import math
+import threading
+
+from codec import get_codec
+from location import METERS_PER_DEGREE, distance, point_time, position
+
+
+def simplify(points, tolerance, time_aware=False):
+    """
+    Drop the points of a track that lie within `tolerance` meters of the
+    line through the points kept around them, with the Douglas-Peucker
+    algorithm. The first and last points are always kept, as are points
+    without a position.
+
+    Time-aware simplification measures each point against where the device
+    would have been at that time, moving steadily between the points kept
+    around it, so stops and changes of speed are kept too. It is used only
+    when every point has a time.
+
+    Args:
+        points: The track's location updates, oldest first.
+        tolerance: The largest offset in meters of a dropped point.
+        time_aware: Measure points against their synchronized position.
+
+    Returns:
+        A list of the points kept, in their original order.
+    """
+    indexes = []
+    coords = []
+    for index, point in enumerate(points):
+        pos = position(point)
+        if pos is not None:
+            indexes.append(index)
+            coords.append(pos)
+    if len(coords) < 3 or tolerance <= 0:
+        return list(points)
+
+    times = None
+    if time_aware:
+        times = [point_time(points[index]) for index in indexes]
+        if None in times:
+            times = None
+
+    # Project onto a plane in meters around the track's mean latitude
+    mean = sum(lat for lat, lng in coords) / len(coords)
+    scale = METERS_PER_DEGREE * math.cos(math.radians(mean))
+    xy = [(lng * scale, lat * METERS_PER_DEGREE) for lat, lng in coords]
+
+    keep = [False] * len(xy)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xy) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = xy[first], xy[last]
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+
+        worst, worst_index = tolerance, None
+        for i in xrange(first + 1, last):
+            x, y = xy[i]
+            if times is not None:
+                span = times[last] - times[first]
+                ratio = span and (times[i] - times[first]) / span or 0.0
+            elif length:
+                ratio = ((x - x1) * dx + (y - y1) * dy) / length
+            else:
+                ratio = 0.0
+            ratio = min(1.0, max(0.0, ratio))
+            offset = math.hypot(x - x1 - ratio * dx, y - y1 - ratio * dy)
+            if offset > worst:
+                worst, worst_index = offset, i
+
+        if worst_index is not None:
+            keep[worst_index] = True
+            stack.append((first, worst_index))
+            stack.append((worst_index, last))
+
+    dropped = set(index for index, kept in zip(indexes, keep) if not kept)
+    return [point for index, point in enumerate(points) if index not in dropped]
+
+
+def encode_number(value, chunks):
+    if value < 0:
+        value = ~(value << 1)
+    else:
+        value <<= 1
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+
+
+def decode_numbers(data):
+    index = 0
+    while index < len(data):
+        result = shift = 0
+        while True:
+            chunk = ord(data[index]) - 63
+            index += 1
+            result |= (chunk & 0x1f) << shift
+            shift += 5
+            if chunk < 0x20:
+                break
+        if result & 1:
+            yield ~(result >> 1)
+        else:
+            yield result >> 1
+
+
+def encode_track(points, precision=5):
+    """
+    Encode a track compactly as the differences between each point's
+    latitude, longitude and time and the previous point's, in the
+    printable format of Google's encoded polylines. A track takes a few
+    bytes per point rather than the hundred or so of its JSON form.
+
+    The 'location/update' endpoint only accepts JSON points, so this is
+    meant for storing tracks or sending them to your own services.
+
+    Args:
+        points: The track's location updates, oldest first. Points without
+                a position are skipped.
+        precision: The number of decimal places of latitude and longitude
+                   to keep. 5 places is about a meter.
+
+    Returns:
+        The encoded track as a string.
+    """
+    factor = 10 ** precision
+    chunks = []
+    previous = (0, 0, 0)
+    for point in points:
+        pos = position(point)
+        if pos is None:
+            continue
+        current = (int(round(pos[0] * factor)), int(round(pos[1] * factor)),
+                int(round(point_time(point) or 0)))
+        for value, last in zip(current, previous):
+            encode_number(value - last, chunks)
+        previous = current
+    return ''.join(chunks)
+
+
+def decode_track(data, precision=5):
+    """
+    Decode a track encoded by `encode_track`.
+
+    Returns:
+        A list of (latitude, longitude, timestamp) tuples. Timestamps of
+        points that had no time are None.
+    """
+    factor = float(10 ** precision)
+    values = list(decode_numbers(data))
+    track = []
+    lat = lng = timestamp = 0
+    for i in xrange(0, len(values) - 2, 3):
+        lat += values[i]
+        lng += values[i + 1]
+        timestamp += values[i + 2]
+        track.append((lat / factor, lng / factor, timestamp or None))
+    return track
+
+
+class TrackSimplifier:
+    """
+    Drops redundant points from devices' tracks before they are uploaded.
+
+    A device's point is filtered out as it arrives if it is within
+    `min_distance` meters or `min_time` seconds of the last point kept from
+    that device. Batches of points are then simplified to within
+    `tolerance` meters with `simplify`.
+
+    The number of points dropped and the JSON bytes saved are reported for
+    each device.
+
+    ::
+
+        >>> uploader = g.uploader(simplifier=TrackSimplifier(min_distance=20,
+        ...         min_time=60, tolerance=10))
+    """
+    min_distance = 0
+    min_time = 0
+    tolerance = 0
+    time_aware = False
+
+    def __init__(self, min_distance=None, min_time=None, tolerance=None,
+            time_aware=None, codec=None):
+        """
+        Create a new track simplifier.
+
+        Args:
+            min_distance: The distance in meters a device must move for a
+                          point to be kept.
+            min_time: The number of seconds that must pass for a point to
+                      be kept.
+            tolerance: The largest offset in meters of a point dropped by
+                       simplification, or 0 not to simplify batches.
+            time_aware: Simplify against synchronized positions. See
+                        `simplify`.
+            codec: An optional codec to measure the bytes saved with.
+                   Defaults to the standard library's `json` module.
+        """
+        if min_distance is not None:
+            self.min_distance = min_distance
+        if min_time is not None:
+            self.min_time = min_time
+        if tolerance is not None:
+            self.tolerance = tolerance
+        if time_aware is not None:
+            self.time_aware = time_aware
+        self.codec = codec or get_codec()
+
+        self.lock = threading.Lock()
+        self.last = {}
+        self.reports = {}
+
+    def accept(self, point, device=None, received=None):
+        """
+        Decide whether to keep a device's latest point.
+
+        Args:
+            point: The location update as a dictionary.
+            device: An optional identifier of the device.
+            received: When the point was received, used if it has no time.
+
+        Returns:
+            True if the point should be kept.
+        """
+        pos = position(point)
+        when = point_time(point)
+        if when is None:
+            when = received
+
+        last = self.last.get(device)
+        if pos is not None and last is not None:
+            near = distance(last[0], last[1], pos[0], pos[1]) < self.min_distance
+            soon = when is not None and last[2] is not None and \
+                    when - last[2] < self.min_time
+            if near or soon:
+                self.report(device, 1, [point], 'filtered')
+                return False
+
+        if pos is not None:
+            self.last[device] = (pos[0], pos[1], when)
+        self.report(device, 1, [], 'filtered')
+        return True
+
+    def simplify(self, points, device=None):
+        """
+        Simplify a batch of a device's points.
+
+        Args:
+            points: The device's location updates, oldest first.
+            device: An optional identifier of the device.
+
+        Returns:
+            A list of the points kept.
+        """
+        if not self.tolerance:
+            return list(points)
+
+        kept = simplify(points, self.tolerance, self.time_aware)
+        if len(kept) < len(points):
+            ids = set(id(point) for point in kept)
+            self.report(device, 0, [point for point in points
+                    if id(point) not in ids], 'simplified')
+        return kept
+
+    def report(self, device, seen, dropped, reason):
+        size = dropped and sum(len(self.codec.dumps(point)) + 1
+                for point in dropped) or 0
+        with self.lock:
+            report = self.reports.get(device)
+            if report is None:
+                report = self.reports[device] = {
+                    'points': 0,
+                    'filtered': 0,
+                    'simplified': 0,
+                    'dropped': 0,
+                    'bytes_saved': 0,
+                }
+            report['points'] += seen
+            report[reason] += len(dropped)
+            report['dropped'] += len(dropped)
+            report['bytes_saved'] += size
+
+    def forget(self, device=None):
+        """
+        Stop filtering a device's points against its last kept point.
+        """
+        self.last.pop(device, None)
+
+    def stats(self):
+        """
+        Report the points dropped and the bytes saved for each device.
+
+        Returns:
+            A dictionary of devices' reports, each with the number of points
+            seen, filtered out as they arrived, dropped by simplification
+            and dropped in all, and the JSON bytes saved.
+        """
+        with self.lock:
+            return dict((device, dict(report))
+                    for device, report in self.reports.items())
@@ -0,0 +1,187 @@
+"""
+Incremental decoding of JSON API responses.
+"""
+import json
+
+from errors import GeoloqiError
+
+WHITESPACE = ' \t\n\r'
+# The characters that may follow a complete value
+DELIMITERS = ',:]}' + WHITESPACE
+
+
+class ArrayDecoder:
+    """
+    Decodes the elements of a JSON array from a file like object as its
+    bytes arrive, without holding the whole document in memory.
+    """
+    chunk_size = 16384
+
+    def __init__(self, f, key=None, chunk_size=None):
+        """
+        Create a new array decoder.
+
+        Args:
+            f: A file like object holding a JSON document.
+            key: The key of the array in the top-level object, or None if
+                 the document itself is an array.
+            chunk_size: The number of bytes to read at a time.
+        """
+        self.f = f
+        self.key = key
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def __iter__(self):
+        try:
+            if self.find_array():
+                for element in self.elements():
+                    yield element
+
+            # Drain the rest of the response so its connection can be reused
+            while self.read():
+                self.pos = len(self.buffer)
+        finally:
+            self.f.close()
+
+    def read(self):
+        """
+        Append the next chunk of the document to the buffer, dropping the
+        part that has already been decoded.
+
+        Returns:
+            False once the end of the document has been reached.
+        """
+        if self.eof:
+            return False
+
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, reading more of the
+        document as needed.
+
+        Returns:
+            The next character, or None at the end of the document.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read():
+                return None
+
+    def decode(self):
+        """
+        Decode the next complete JSON value.
+
+        Returns:
+            The decoded value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number cut at the end of a chunk may still decode, such as
+                # '45.' of '45.5165', so only trust a value with a delimiter
+                # after it
+                if self.eof or end < len(self.buffer) and \
+                        self.buffer[end] in DELIMITERS:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            if not self.read():
+                value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+                return value
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected %r at position %d' % (char, self.pos))
+        self.pos += 1
+
+    def find_array(self):
+        """
+        Advance to the first element of the array.
+
+        Returns:
+            True if the array was found.
+
+        Raises:
+            GeoloqiError: If the document is an API error response.
+        """
+        if self.key is None:
+            self.expect('[')
+            return True
+
+        self.expect('{')
+        fields = {}
+        while self.peek() != '}':
+            name = self.decode()
+            self.expect(':')
+            if name == self.key:
+                if self.peek() != '[':
+                    raise ValueError('%r is not an array' % name)
+                self.pos += 1
+                return True
+
+            fields[name] = self.decode()
+            if self.peek() == ',':
+                self.pos += 1
+
+        if fields.has_key('error'):
+            raise GeoloqiError(fields)
+        return False
+
+    def elements(self):
+        """
+        Yield each element of the array in turn.
+        """
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            yield self.decode()
+
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError('Expected \',\' or \']\' at position %d' % (self.pos - 1))
+
+
+def iter_array(f, key=None, chunk_size=None):
+    """
+    Yield the elements of a JSON array from a file like object as they are
+    decoded.
+
+    Args:
+        f: A file like object holding a JSON document.
+        key: The key of the array in the top-level object, or None if the
+             document itself is an array.
+        chunk_size: The number of bytes to read at a time.
+
+    Returns:
+        A generator of array elements.
+
+    Raises:
+        GeoloqiError: If the document is an API error response.
+    """
+    return iter(ArrayDecoder(f, key, chunk_size))
@@ -0,0 +1,271 @@
+"""
+Acting on behalf of many Geoloqi users through one client.
+"""
+import threading
+
+from collections import OrderedDict
+from geoloqi import Geoloqi, Session
+
+
+def shared(name):
+    """
+    An attribute of a `UserSession` that is read from the application's
+    session rather than stored for each user.
+    """
+    return property(lambda self: getattr(self.registry.session, name))
+
+
+class UserSession(Session):
+    """
+    A session acting for one user. Only the user's tokens are kept for
+    each user; the connection pool, caches, policies and metrics all
+    belong to the application's session, so creating one is cheap. Renewed
+    tokens are passed to the registry's `on_refresh` function.
+
+    User sessions are kept to five instance attributes, the most a
+    dictionary holds before it grows from its smallest size.
+    """
+    api_key = shared('api_key')
+    api_secret = shared('api_secret')
+    pool = shared('pool')
+    opener = shared('opener')
+    url_template = shared('url_template')
+    refresh_margin = shared('refresh_margin')
+    cache = shared('cache')
+    compress_threshold = shared('compress_threshold')
+    transfer = shared('transfer')
+    retry_policy = shared('retry_policy')
+    rate_limiter = shared('rate_limiter')
+    metrics = shared('metrics')
+    timeout = shared('timeout')
+    codec = shared('codec')
+    coalescer = shared('coalescer')
+
+    def __init__(self, registry, user_id, auth):
+        """
+        Create a new user session.
+
+        Args:
+            registry: The `UserRegistry` the user belongs to.
+            user_id: The user's identifier.
+            auth: A dictionary holding the user's 'access_token', and
+                  optionally their 'refresh_token' and its 'expires_at'
+                  timestamp.
+        """
+        self.registry = registry
+        self.user_id = user_id
+        self.auth = auth
+        self.access_token = auth.get('access_token')
+        self.expires_at = auth.get('expires_at')
+
+    @property
+    def token_lock(self):
+        return self.registry.get_lock(self.user_id)
+
+    def establish(self, data, **kwargs):
+        refresh_token = self.auth and self.auth.get('refresh_token')
+        Session.establish(self, data, **kwargs)
+
+        # Keep the refresh token if the server didn't issue a new one
+        if refresh_token and not self.auth.get('refresh_token'):
+            self.auth['refresh_token'] = refresh_token
+        self.auth['expires_at'] = self.expires_at
+        self.registry.refreshed(self)
+
+
+class UserRegistry:
+    """
+    A thread-safe registry of the sessions of up to `maxsize` users, each
+    holding that user's tokens. The least recently used user is evicted
+    when the registry is full, and users that aren't registered are looked
+    up with the `loader` function, if one is provided.
+
+    Users' token renewals are made one at a time per user, using one of
+    `lock_stripes` locks shared between users rather than a lock each.
+    """
+    maxsize = 10000
+    lock_stripes = 64
+
+    def __init__(self, session, maxsize=None, loader=None, on_refresh=None):
+        """
+        Create a new user registry.
+
+        Args:
+            session: The application's `Session`, shared by every user.
+            maxsize: The maximum number of users to keep.
+            loader: An optional function taking a user's identifier and
+                    returning a dictionary of their 'access_token',
+                    'refresh_token' and 'expires_at', or None.
+            on_refresh: An optional function called with a user's
+                        identifier and a dictionary of their new tokens
+                        whenever their access token is renewed.
+        """
+        self.session = session
+        if maxsize is not None:
+            self.maxsize = maxsize
+        self.loader = loader
+        self.on_refresh = on_refresh
+
+        self.lock = threading.Lock()
+        self.users = OrderedDict()
+        self.locks = [threading.Lock() for i in range(self.lock_stripes)]
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def get_lock(self, user_id):
+        return self.locks[hash(user_id) % len(self.locks)]
+
+    def add(self, user_id, access_token, refresh_token=None, expires_at=None):
+        """
+        Register a user's tokens, replacing any already registered.
+
+        Args:
+            user_id: The user's identifier.
+            access_token: The user's access token.
+            refresh_token: An optional refresh token for renewing it.
+            expires_at: An optional timestamp of when the access token expires.
+
+        Returns:
+            The user's `UserSession`.
+        """
+        auth = {'access_token': access_token}
+        if refresh_token:
+            auth['refresh_token'] = refresh_token
+        if expires_at:
+            auth['expires_at'] = expires_at
+        session = UserSession(self, user_id, auth)
+
+        with self.lock:
+            self.users.pop(user_id, None)
+            self.users[user_id] = session
+            while len(self.users) > self.maxsize:
+                self.users.popitem(last=False)
+                self.evictions += 1
+        return session
+
+    def get(self, user_id):
+        """
+        Find a user's session, loading their tokens if they aren't registered.
+
+        Args:
+            user_id: The user's identifier.
+
+        Returns:
+            The user's `UserSession`.
+
+        Raises:
+            KeyError: If the user isn't registered and can't be loaded.
+        """
+        with self.lock:
+            session = self.users.pop(user_id, None)
+            if session is not None:
+                self.users[user_id] = session
+                return session
+
+        auth = self.loader and self.loader(user_id)
+        if not auth or not auth.get('access_token'):
+            raise KeyError(user_id)
+        return self.add(user_id, auth['access_token'],
+                auth.get('refresh_token'), auth.get('expires_at'))
+
+    def remove(self, user_id):
+        """
+        Forget a user's tokens.
+
+        Args:
+            user_id: The user's identifier.
+        """
+        with self.lock:
+            self.users.pop(user_id, None)
+
+    def refreshed(self, session):
+        """
+        Report a user's renewed tokens to the `on_refresh` function.
+
+        Args:
+            session: The user's `UserSession`.
+        """
+        if self.on_refresh:
+            self.on_refresh(session.user_id, dict(session.auth))
+
+
+class UserGeoloqi(Geoloqi):
+    """
+    A Geoloqi API wrapper acting for one user of a `MultiUserGeoloqi`.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.access_token = session.access_token
+
+
+class MultiUserGeoloqi(Geoloqi):
+    """
+    A Geoloqi API wrapper that acts on behalf of many users over the
+    application's connection pool:
+
+    ::
+
+        >>> g = MultiUserGeoloqi(loader=load_tokens, on_refresh=save_tokens)
+        >>> g.add_user(42, access_token, refresh_token)
+        >>> g.as_user(42).get('account/profile')
+
+    Calls made on the client itself are made as the application.
+    """
+    users = None
+
+    def __init__(self, api_key=None, api_secret=None, access_token=None,
+            maxsize=None, loader=None, on_refresh=None, **kwargs):
+        """
+        Initializes a new multi-user Geoloqi API wrapper.
+
+        Args:
+            api_key: Your application's Geoloqi API key.
+            api_secret: Your application's Geoloqi API secret.
+            access_token: Your personal user access token.
+            maxsize: The maximum number of users to keep tokens for.
+            loader: An optional function returning the tokens of users
+                    that aren't registered. See `UserRegistry`.
+            on_refresh: An optional function called with a user's
+                        identifier and new tokens when they are renewed.
+
+        Any other keyword arguments are passed on to the application's
+        `Session`.
+
+        Raises:
+            ValueError: If the proper client credentials were not provided.
+        """
+        Geoloqi.__init__(self, api_key, api_secret, access_token, **kwargs)
+        self.users = UserRegistry(self.session, maxsize, loader, on_refresh)
+
+    def add_user(self, user_id, access_token, refresh_token=None, expires_at=None):
+        """
+        Register a user's tokens. See `UserRegistry.add`.
+        """
+        self.users.add(user_id, access_token, refresh_token, expires_at)
+
+    def remove_user(self, user_id):
+        """
+        Forget a user's tokens.
+        """
+        self.users.remove(user_id)
+
+    def as_user(self, user_id):
+        """
+        Act on behalf of a user.
+
+        Args:
+            user_id: The user's identifier.
+
+        Returns:
+            A `UserGeoloqi` whose calls are made with the user's tokens.
+
+        Raises:
+            KeyError: If the user isn't registered and can't be loaded.
+        """
+        return UserGeoloqi(self.users.get(user_id))
@@ -1,17 +1,54 @@
 """
 Tests for the geoloqi module.
 """
+import httplib
 import json
+import mimetools
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import urllib
 import urllib2
+import zlib
 
 from mock import Mock, patch
+from Queue import Full
 from unittest import TestCase
 from urllib2 import HTTPError, URLError
 
-from geoloqi import Geoloqi, Session
+from archive import ArchiveReader, ArchiveWriter
+from asynchronous import AsyncGeoloqi, AsyncSession
+from batch import Batch
+from cache import ResponseCache, get_path
+from codec import JSONCodec, Payload, get_codec
+from coalesce import Coalescer
+from compression import ACCEPT_ENCODING, gzip_compress
+from errors import DeadlineExceeded, GeoloqiError, RateLimitExceeded
+from metrics import Histogram, Metrics
+from stream import iter_array
+from tenants import MultiUserGeoloqi
+from triggers import TriggerIndex, TriggerTracker, get_region
+from uploader import LocationUploader
+from StringIO import StringIO
+from geoloqi import Geoloqi, Session, read_config
+from location import distance, point_time
+from pool import ConnectionPool, PooledHandler
+from ratelimit import FileTokenBucket, RateLimiter, TokenBucket
+from retry import RetryPolicy, get_retry_after
+from simplify import TrackSimplifier, decode_track, encode_track, simplify
+from tokens import TokenCache
+from track import LocationTrack, TrackPoint
 from version import __version__
 
+try:
+    import geo
+except ImportError:
+    geo = None
+
 
 class GeoloqiTest(TestCase):
     @patch.object(Session, 'post')
@@ -57,6 +94,246 @@ class GeoloqiTest(TestCase):
         self.geoloqi.run('foo/bar', data, headers)
         mock_run.assert_called_with('foo/bar', data, headers)
 
+    def test_read_config(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'geoloqi.cfg')
+            with open(filename, 'w') as f:
+                f.write('[Credentials]\nuser_access_token = one\n')
+
+            # Parsed config is shared until the file changes
+            config = read_config([filename])
+            self.assertTrue(config is read_config([filename]))
+            self.assertEqual('one', config.get('Credentials', 'user_access_token'))
+
+            with open(filename, 'w') as f:
+                f.write('[Credentials]\nuser_access_token = two\n')
+            os.utime(filename, (0, 0))
+
+            config = read_config([filename])
+            self.assertEqual('two', config.get('Credentials', 'user_access_token'))
+        finally:
+            shutil.rmtree(tempdir)
+
+    @patch.object(Session, 'get')
+    def test_iter_history(self, mock_get):
+        history = [{'date_ts': ts, 'n': n}
+                for n, ts in enumerate([1, 2, 2, 2, 3, 4])]
+        mock_get.side_effect = lambda path, args, headers: {'points': [point
+                for point in history if point['date_ts'] > args.get('after', 0)]
+                [:args['count']]}
+
+        # Points sharing a second across a page boundary are all returned once
+        points = self.geoloqi.iter_history({'before': 10}, page_size=2)
+        self.assertEqual(range(6), [point['n'] for point in points])
+
+        # Pages continue from the second of the last point, and a page all
+        # in one second is followed by a larger one until paging moves on
+        self.assertEqual([
+                {'before': 10, 'count': 2, 'sort': 'asc'},
+                {'before': 10, 'count': 2, 'sort': 'asc', 'after': 1},
+                {'before': 10, 'count': 4, 'sort': 'asc', 'after': 1},
+                {'before': 10, 'count': 2, 'sort': 'asc', 'after': 2},
+                {'before': 10, 'count': 2, 'sort': 'asc', 'after': 3},
+            ], [call[0][1] for call in mock_get.call_args_list])
+
+    @patch.object(Session, 'get')
+    def test_iter_list(self, mock_get):
+        places = [{'place_id': n} for n in range(5)]
+        mock_get.side_effect = lambda path, args, headers: {
+            'places': places[args.get('offset', 0):][:args['count']]}
+
+        records = self.geoloqi.iter_list('place/list', 'places', page_size=2,
+                prefetch=False)
+        self.assertEqual(places, list(records))
+        self.assertEqual(3, mock_get.call_count)
+
+        # The server's paging information is followed when present
+        mock_get.reset_mock()
+        mock_get.side_effect = lambda path, args, headers: {
+            'places': places[args.get('offset', 0):][:args['count']],
+            'paging': {'next_offset': args.get('offset', 0) < 3 and 3 or None}}
+
+        self.assertEqual(places[:2] + places[3:5],
+                list(self.geoloqi.iter_list('place/list', 'places', page_size=2)))
+
+    @patch.object(Session, 'get')
+    def test_iter_errors(self, mock_get):
+        mock_get.return_value = {'error': 'forbidden', 'error_description': 'Nope'}
+
+        points = self.geoloqi.iter_history()
+        self.assertRaises(GeoloqiError, list, points)
+
+    @patch.object(Session, 'run')
+    def test_map(self, mock_run):
+        def run(path, data, headers):
+            if path == 'fail':
+                raise URLError('down')
+            time.sleep(0.01 * (path == 'slow'))
+            return {'path': path}
+        mock_run.side_effect = run
+
+        results = self.geoloqi.map(['slow', ('get', 'a', {'n': 1}), 'fail',
+                ('post', 'b', {'n': 2}), ('delete', 'c')], max_workers=3)
+
+        # Results keep their order and failures don't stop the others
+        self.assertEqual({'path': 'slow'}, results[0])
+        self.assertEqual({'path': 'a?n=1'}, results[1])
+        self.assertTrue(isinstance(results[2], URLError))
+        self.assertEqual({'path': 'b'}, results[3])
+        self.assertTrue(isinstance(results[4], ValueError))
+        self.assertEqual([], self.geoloqi.map([]))
+
+    @patch.object(Session, 'run')
+    def test_imap_unordered(self, mock_run):
+        def run(path, data, headers):
+            time.sleep(0.05 * (path == 'slow'))
+            return {'path': path}
+        mock_run.side_effect = run
+
+        results = list(self.geoloqi.imap_unordered(['slow', 'a', 'b'], 3))
+
+        # Responses arrive as they complete, tagged with their position
+        self.assertEqual((0, {'path': 'slow'}), results[-1])
+        self.assertEqual([(0, {'path': 'slow'}), (1, {'path': 'a'}),
+                (2, {'path': 'b'})], sorted(results))
+
+    def test_batch(self):
+        batch = self.geoloqi.batch(per_request_limit=5)
+        self.assertTrue(isinstance(batch, Batch))
+        self.assertEqual(self.geoloqi.session, batch.session)
+        self.assertEqual(5, batch.per_request_limit)
+
+
+class BatchTest(TestCase):
+    @patch.object(Session, 'post')
+    def setUp(self, mock_post):
+        # Mock out Session.post to return a fake access_token.
+        auth = {'access_token': 33187}
+        mock_post.return_value = auth
+
+        self.session = Geoloqi().session
+
+    @patch.object(Session, 'post')
+    def test_run_batched(self, mock_post):
+        mock_post.side_effect = lambda path, data: {'result': [
+            {'code': 200, 'body': {'n': job['body']['n']}}
+            for job in data['batch']
+        ]}
+
+        with Batch(self.session, per_request_limit=2) as batch:
+            for n in range(5):
+                batch.post('location/update', {'n': n})
+
+        # Results come back in order from as few requests as allowed
+        self.assertEqual([{'n': n} for n in range(5)], batch.results)
+        self.assertEqual(3, mock_post.call_count)
+        self.assertTrue(self.session.batch_supported)
+
+        path, data = mock_post.call_args[0]
+        self.assertEqual('batch/run', path)
+        self.assertEqual(33187, data['access_token'])
+        self.assertEqual([{'relative_url': 'location/update',
+                'body': {'n': 4}, 'headers': {}}], data['batch'])
+
+    @patch.object(Session, 'run')
+    @patch.object(Session, 'post')
+    def test_run_concurrently(self, mock_post, mock_run):
+        def post(path, data, headers=None):
+            if path == 'batch/run':
+                return {'error': 'not_found'}
+            if data['n'] == 1:
+                raise ValueError('bad response')
+            return {'n': data['n']}
+        mock_post.side_effect = post
+        mock_run.return_value = {'result': 'ok'}
+
+        results = Batch(self.session).get('account/profile', {'a': 1}) \
+                .post('foo/bar', {'n': 0}).post('foo/bar', {'n': 1}).run()
+
+        # Falls back to individual requests and isolates errors
+        self.assertEqual({'result': 'ok'}, results[0])
+        self.assertEqual({'n': 0}, results[1])
+        self.assertTrue(isinstance(results[2], ValueError))
+        mock_run.assert_called_with('account/profile?a=1', None, {})
+        self.assertFalse(self.session.batch_supported)
+
+        # The batch endpoint isn't tried again once it's known to be missing
+        mock_post.reset_mock()
+        Batch(self.session).post('foo/bar', {'n': 2}).run()
+        mock_post.assert_called_once_with('foo/bar', {'n': 2}, {})
+
+    @patch.object(Session, 'post')
+    def test_batch_errors(self, mock_post):
+        responses = []
+        def post(path, data, headers=None):
+            if path != 'batch/run':
+                return data
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        mock_post.side_effect = post
+
+        def run(*responses_):
+            responses[:] = responses_
+            batch = Batch(self.session)
+            for n in range(3):
+                batch.post('foo/bar', {'n': n})
+            return batch.run()
+
+        # Errors from the batch endpoint are returned for every call,
+        # without giving up on batching
+        unavailable = {'error': 'service_unavailable'}
+        self.assertEqual([unavailable] * 3, run(unavailable))
+        error = HTTPError('http://api/batch/run', 503, 'Unavailable', {},
+                StringIO('<html>'))
+        self.assertEqual([error] * 3, run(error))
+        results = run({'result': [{'body': {'n': 0}}]})
+        self.assertEqual(['invalid_response'] * 3,
+                [result['error'] for result in results])
+        self.assertEqual(None, self.session.batch_supported)
+        self.assertEqual(3, mock_post.call_count)
+
+        # Only a missing endpoint turns batching off
+        results = run(HTTPError('http://api/batch/run', 404, 'Not Found', {},
+                StringIO('')))
+        self.assertEqual([{'n': 0}, {'n': 1}, {'n': 2}], results)
+        self.assertFalse(self.session.batch_supported)
+
+    @patch.object(Session, 'post')
+    def test_run_failure(self, mock_post):
+        mock_post.side_effect = lambda path, data: {'result': [
+                {'body': {'n': job['body']['n']}} for job in data['batch']]}
+        batch = Batch(self.session, per_request_limit=2)
+        for n in range(5):
+            batch.post('foo/bar', {'n': n})
+
+        # Calls that weren't sent are queued again
+        mock_post.side_effect = [{'result': [{'body': {'n': 0}}, {'body': {'n': 1}}]},
+                URLError('down')]
+        self.assertRaises(URLError, batch.run)
+        self.assertEqual([{'n': 0}, {'n': 1}], batch.results)
+        self.assertEqual(3, len(batch))
+
+        mock_post.side_effect = lambda path, data: {'result': [
+                {'body': {'n': job['body']['n']}} for job in data['batch']]}
+        self.assertEqual([{'n': n} for n in range(2, 5)], batch.run())
+
+    def test_empty_post(self):
+        # Posts without a body still send an empty JSON object
+        sent = []
+        def open(request, timeout=None):
+            sent.append(request.get_data())
+            raise URLError('down')
+        self.session.opener = Mock()
+        self.session.opener.open.side_effect = open
+        self.session.batch_supported = False
+
+        results = Batch(self.session).post('location/update').run()
+        self.assertTrue(isinstance(results[0], URLError))
+        self.assertEqual(['{}'], sent)
+
 
 class SessionTest(TestCase):
     @patch.object(Session, 'post')
@@ -149,7 +426,127 @@ class SessionTest(TestCase):
             self.session.run('foo/bar')
             self.assertTrue(mock_renew_access_token.called)
 
-    @patch.object(urllib2, 'urlopen')
+    @patch.object(Session, 'execute')
+    def test_run_concurrent_refresh(self, mock_execute):
+        self.session.access_token = 'old'
+
+        def execute(path, data, headers, timeout=None):
+            result = Mock()
+            if headers['Authorization'] == 'OAuth old':
+                result.read.return_value = json.dumps({'error': 'expired_token'})
+            else:
+                result.read.return_value = json.dumps({'result': 'ok'})
+            return result
+        mock_execute.side_effect = execute
+
+        def renew_access_token(deadline=None):
+            time.sleep(0.05)
+            self.session.access_token = 'new'
+
+        # Many threads see the expired token at once, but only one renews it
+        with patch.object(Session, 'renew_access_token') as mock_renew:
+            mock_renew.side_effect = renew_access_token
+
+            responses = []
+            threads = [threading.Thread(target=lambda:
+                    responses.append(self.session.run('foo/bar')))
+                    for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(1, mock_renew.call_count)
+        self.assertEqual([{'result': 'ok'}] * 10, responses)
+
+    @patch.object(Session, 'execute')
+    def test_refresh_access_token(self, mock_execute):
+        self.session.access_token = 'new'
+
+        # A token that has already been replaced isn't renewed again
+        with patch.object(Session, 'renew_access_token') as mock_renew:
+            self.assertEqual('new', self.session.refresh_access_token('old'))
+            self.assertFalse(mock_renew.called)
+
+            self.session.refresh_access_token('new')
+            self.assertTrue(mock_renew.called)
+
+    @patch.object(Session, 'execute')
+    def test_run_proactive_refresh(self, mock_execute):
+        result = Mock()
+        result.read = Mock(return_value=json.dumps({'result': 'ok'}))
+        mock_execute.return_value = result
+
+        self.session.auth = {'access_token': 'old', 'refresh_token': 'r'}
+        self.session.access_token = 'old'
+
+        with patch.object(Session, 'renew_access_token') as mock_renew:
+            # Tokens that aren't close to expiring are left alone
+            self.session.expires_at = time.time() + 3600
+            self.session.run('foo/bar')
+            self.assertFalse(mock_renew.called)
+
+            # Tokens about to expire are renewed in the background while
+            # the request goes ahead with the current token
+            self.session.expires_at = time.time() + 10
+            self.session.run('foo/bar')
+            self.session.refresh_thread.join()
+            self.assertEqual(1, mock_renew.call_count)
+            self.assertEqual('OAuth old',
+                    mock_execute.call_args[0][2]['Authorization'])
+
+            # Expired tokens are renewed before the request is sent
+            self.session.refresh_thread = None
+            self.session.expires_at = time.time() - 10
+            self.session.run('foo/bar')
+            self.assertEqual(2, mock_renew.call_count)
+            self.assertEqual(None, self.session.refresh_thread)
+
+    @patch.object(Session, 'execute')
+    @patch.object(Session, 'post')
+    def test_failed_refresh(self, mock_post, mock_execute):
+        result = Mock()
+        result.read = Mock(return_value=json.dumps({'result': 'ok'}))
+        mock_execute.return_value = result
+        mock_post.return_value = {'error': 'service_unavailable'}
+
+        self.session.auth = {'access_token': 'old', 'refresh_token': 'r'}
+        self.session.access_token = 'old'
+        expires_at = self.session.expires_at = time.time() + 10
+
+        # An error from the OAuth server keeps the current token, and the
+        # renewal is tried again before the next request
+        self.session.run('foo/bar')
+        self.session.refresh_thread.join()
+        self.assertEqual('old', self.session.access_token)
+        self.assertEqual(expires_at, self.session.expires_at)
+
+        self.session.run('foo/bar')
+        self.session.refresh_thread.join()
+        self.assertEqual(2, mock_post.call_count)
+        self.assertEqual('OAuth old',
+                mock_execute.call_args[0][2]['Authorization'])
+
+        self.assertRaises(GeoloqiError, self.session.renew_access_token)
+        self.assertEqual('r', self.session.auth['refresh_token'])
+
+    @patch.object(Session, 'execute')
+    def test_run_stream(self, mock_execute):
+        points = [{'date_ts': n, 'uuid': 'p%d' % n} for n in range(100)]
+        mock_execute.return_value = StringIO(json.dumps({'points': points}))
+
+        # Array elements are yielded as they are decoded
+        result = self.session.run('location/history', stream='points')
+        self.assertFalse(isinstance(result, dict))
+        self.assertEqual(points, list(result))
+
+        # Errors are raised rather than streamed
+        mock_execute.return_value = HTTPError('', 401, 'Unauthorized', {},
+                StringIO(json.dumps({'error': 'forbidden'})))
+        self.assertRaises(GeoloqiError, self.session.run, 'location/history',
+                stream='points')
+
+    @patch.object(urllib2.OpenerDirector, 'open')
     def test_execute(self, mock_urlopen):
         # Test a basic request
         self.session.execute('foo/bar')
@@ -187,6 +584,128 @@ class SessionTest(TestCase):
         self.assertTrue(mock_urlopen.called)
         self.assertEqual(type(e), URLError)
 
+    @patch.object(urllib2.OpenerDirector, 'open')
+    def test_execute_compression(self, mock_open):
+        body = json.dumps({'points': range(1000)})
+
+        def response(encoding, data):
+            headers = mimetools.Message(StringIO(
+                    'Content-Encoding: %s\r\n\r\n' % encoding))
+            return urllib.addinfourl(StringIO(data), headers, '', 200)
+
+        # Compressed responses are decoded and their size counted
+        mock_open.return_value = response('gzip', gzip_compress(body))
+        f = self.session.execute('foo/bar')
+        self.assertEqual(body, f.read())
+        self.assertEqual(len(body), f.transfer.received_logical)
+        self.assertTrue(f.transfer.received_wire < len(body) / 2)
+        self.assertEqual(ACCEPT_ENCODING,
+                mock_open.call_args[0][0].unredirected_hdrs['Accept-encoding'])
+
+        # Including deflate responses with or without the zlib header
+        mock_open.return_value = response('deflate', zlib.compress(body))
+        self.assertEqual(body, self.session.execute('foo/bar').read())
+        mock_open.return_value = response('deflate', zlib.compress(body)[2:-4])
+        self.assertEqual(body, self.session.execute('foo/bar').read())
+
+        stats = self.session.transfer.stats()
+        self.assertEqual(3, stats['requests'])
+        self.assertEqual(3 * len(body), stats['received_logical'])
+
+        # Large request bodies are only compressed above the threshold
+        data = {'points': range(1000)}
+        self.session.execute('foo/bar', data)
+        request = mock_open.call_args[0][0]
+        self.assertEqual(json.dumps(data), request.data)
+
+        self.session.compress_threshold = 1024
+        f = self.session.execute('foo/bar', data)
+        request = mock_open.call_args[0][0]
+        self.assertEqual('gzip', request.headers['Content-encoding'])
+        self.assertEqual(json.dumps(data),
+                zlib.decompress(request.data, 16 + zlib.MAX_WBITS))
+        self.assertEqual(len(request.data), f.transfer.sent_wire)
+        self.assertEqual(len(json.dumps(data)), f.transfer.sent_logical)
+
+    @patch.object(Session, 'execute')
+    def test_timeouts(self, mock_execute):
+        mock_execute.side_effect = lambda *args: StringIO('{}')
+
+        # Requests use the session's timeout unless the call sets its own
+        self.session.timeout = (2, 10)
+        self.session.run('foo/bar')
+        self.assertEqual((2, 10), mock_execute.call_args[0][3])
+        self.session.get('foo/bar', timeout=5)
+        self.assertEqual((5, 5), mock_execute.call_args[0][3])
+
+        # A deadline shortens the timeouts to the time left
+        self.session.run('foo/bar', deadline=1)
+        connect, read = mock_execute.call_args[0][3]
+        self.assertTrue(0.9 < connect <= 1 and 0.9 < read <= 1)
+
+    @patch.object(Session, 'execute')
+    def test_error_page(self, mock_execute):
+        # Error pages that aren't JSON are raised once retries run out
+        mock_execute.return_value = HTTPError('', 502, 'Bad Gateway', {},
+                StringIO('<html>Bad Gateway</html>'))
+        self.session.retry_policy = RetryPolicy(max_retries=0)
+        try:
+            self.session.run('foo/bar')
+            self.fail('HTTPError not raised')
+        except HTTPError, e:
+            self.assertEqual(502, e.code)
+            self.assertEqual('<html>Bad Gateway</html>', e.read())
+
+    @patch.object(RetryPolicy, 'sleep')
+    @patch.object(Session, 'execute')
+    def test_deadline(self, mock_execute, mock_sleep):
+        # Retries stop once the next one would start after the deadline
+        mock_execute.return_value = HTTPError('', 503, '', {'Retry-After': '2'},
+                StringIO('{"error": "unavailable"}'))
+        self.session.retry_policy = RetryPolicy(max_retries=5)
+        self.assertEqual({'error': 'unavailable'},
+                self.session.run('foo/bar', deadline=1))
+        self.assertEqual(1, mock_execute.call_count)
+
+        # Calls fail without a request once the deadline has passed
+        mock_execute.reset_mock()
+        self.assertRaises(DeadlineExceeded, self.session.run, 'foo/bar',
+                deadline=0)
+        self.assertFalse(mock_execute.called)
+
+        # Waiting for another thread's token renewal counts too
+        self.session.token_lock.acquire()
+        try:
+            start = time.time()
+            self.assertRaises(DeadlineExceeded,
+                    self.session.refresh_access_token, 33187, 0.05)
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            self.session.token_lock.release()
+
+    def test_read_timeout(self):
+        # A server that accepts connections but never answers
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        try:
+            session = Session(access_token='abc', timeout=(1, 0.1),
+                    retry_policy=RetryPolicy(max_retries=0))
+            session.url_template = 'http://127.0.0.1:%d/%%d/%%s' % \
+                    server.getsockname()[1]
+
+            start = time.time()
+            try:
+                session.run('foo/bar')
+                self.fail('The request should have timed out')
+            except URLError, e:
+                self.assertTrue(isinstance(e.reason, socket.timeout))
+            self.assertTrue(time.time() - start < 1)
+            self.assertEqual({'timeout': 1},
+                    session.stats()['endpoints']['foo/bar']['errors'])
+        finally:
+            server.close()
+
     @patch.object(Session, 'post')
     def test_establish(self, mock_post):
         auth = {'access_token': 33187}
@@ -203,6 +722,12 @@ class SessionTest(TestCase):
         # Ensure establish sets the access token correctly
         self.assertEqual(auth, self.session.auth)
         self.assertEqual(auth['access_token'], self.session.access_token)
+        self.assertEqual(None, self.session.expires_at)
+
+        # Ensure the token's expiry time is recorded
+        mock_post.return_value = {'access_token': 33188, 'expires_in': 3600}
+        self.session.establish({})
+        self.assertAlmostEqual(time.time() + 3600, self.session.expires_at, -1)
 
     @patch.object(Session, 'establish')
     def test_renew_access_token(self, mock_establish):
@@ -236,5 +761,1445 @@ class SessionTest(TestCase):
         self.assertTrue(__version__ in ua)
 
 
+class AsyncSessionTest(TestCase):
+    @patch.object(Session, 'post')
+    def setUp(self, mock_post):
+        # Mock out Session.post to return a fake access_token.
+        auth = {'access_token': 33187}
+        mock_post.return_value = auth
+
+        self.geoloqi = AsyncGeoloqi(max_concurrency=2)
+
+    def tearDown(self):
+        self.geoloqi.close()
+
+    def test_init(self):
+        self.assertTrue(isinstance(self.geoloqi.session, AsyncSession))
+        self.assertEqual(33187, self.geoloqi.session.access_token)
+        self.assertEqual(2, self.geoloqi.session.session.pool.maxsize)
+
+    @patch.object(Session, 'run')
+    def test_get(self, mock_run):
+        mock_run.return_value = {'result': 'ok'}
+
+        results = [self.geoloqi.get('foo/bar', {'one': i}) for i in range(5)]
+        self.assertEqual([{'result': 'ok'}] * 5, [r.get(1) for r in results])
+        mock_run.assert_any_call('foo/bar?one=4', None, None)
+
+    @patch.object(Session, 'run')
+    def test_post(self, mock_run):
+        mock_run.return_value = {'result': 'ok'}
+        callback = Mock()
+
+        result = self.geoloqi.post('foo/bar', {'one': 1}, callback=callback)
+        self.assertEqual({'result': 'ok'}, result.get(1))
+        callback.assert_called_with({'result': 'ok'})
+        mock_run.assert_called_with('foo/bar', {'one': 1},
+                {'Content-Type': 'application/json'})
+
+    @patch.object(Session, 'run')
+    def test_errors(self, mock_run):
+        mock_run.side_effect = ValueError('bad response')
+
+        result = self.geoloqi.run('foo/bar')
+        self.assertRaises(ValueError, result.get, 1)
+
+    @patch.object(Session, 'run')
+    def test_map(self, mock_run):
+        def run(path, data, headers):
+            if path == 'fail':
+                raise URLError('down')
+            return {'path': path}
+        mock_run.side_effect = run
+        callback = Mock()
+
+        # Responses keep their order and failures are returned in place
+        result = self.geoloqi.map(['a', ('post', 'b', {'n': 1}), 'fail'],
+                callback=callback)
+        responses = result.get(1)
+        self.assertEqual([{'path': 'a'}, {'path': 'b'}], responses[:2])
+        self.assertTrue(isinstance(responses[2], URLError))
+        callback.assert_called_with(responses)
+
+    @patch.object(Session, 'renew_access_token')
+    def test_renew_access_token(self, mock_renew):
+        mock_renew.return_value = {'access_token': 'new'}
+        result = self.geoloqi.renew_access_token()
+        self.assertEqual({'access_token': 'new'}, result.get(1))
+
+
+class TokenCacheTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = TokenCache(os.path.join(self.tempdir, 'tokens'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_get_set(self):
+        self.assertEqual(None, self.cache.get('key'))
+
+        auth = {'access_token': 'a', 'refresh_token': 'r'}
+        expires_at = time.time() + 3600
+        self.cache.set('key', auth, expires_at)
+        self.cache.set('other', {'access_token': 'b'})
+
+        entry = TokenCache(self.cache.path).get('key')
+        self.assertEqual('a', entry['access_token'])
+        self.assertEqual('r', entry['refresh_token'])
+        self.assertEqual(expires_at, entry['expires_at'])
+        self.assertEqual('b', self.cache.get('other')['access_token'])
+        self.assertEqual(0600, os.stat(self.cache.path).st_mode & 0777)
+
+        # Expired tokens aren't returned
+        self.cache.set('key', auth, time.time() - 1)
+        self.assertEqual(None, self.cache.get('key'))
+
+        self.cache.delete('other')
+        self.assertEqual(None, self.cache.get('other'))
+
+    @patch.object(Session, 'post')
+    def test_session(self, mock_post):
+        mock_post.return_value = {'access_token': 'a', 'expires_in': 3600}
+
+        # The first session stores its token in the cache
+        session = Session('key', 'secret', token_cache=self.cache)
+        self.assertEqual(1, mock_post.call_count)
+        self.assertEqual('a', self.cache.get('key')['access_token'])
+
+        # Later sessions reuse it without contacting the server
+        session = Session('key', 'secret', token_cache=self.cache)
+        self.assertEqual(1, mock_post.call_count)
+        self.assertEqual('a', session.access_token)
+        self.assertAlmostEqual(time.time() + 3600, session.expires_at, -1)
+
+    @patch.object(Session, 'post')
+    def test_rotated_refresh_token(self, mock_post):
+        mock_post.return_value = {'access_token': 'a1', 'refresh_token': 'r1',
+                'expires_in': 3600}
+        one = Session('key', 'secret', token_cache=self.cache)
+        two = Session('key', 'secret', token_cache=self.cache)
+        self.assertEqual('r1', two.auth['refresh_token'])
+
+        # The server issues a new refresh token with each renewal
+        mock_post.return_value = {'access_token': 'a2', 'refresh_token': 'r2',
+                'expires_in': 3600}
+        one.renew_access_token()
+        self.assertEqual('r1', mock_post.call_args[0][1]['refresh_token'])
+
+        # A token another process has renewed is used as it is
+        mock_post.reset_mock()
+        two.renew_access_token()
+        self.assertFalse(mock_post.called)
+        self.assertEqual('a2', two.access_token)
+
+        # And a renewal uses the newest refresh token in the cache
+        mock_post.return_value = {'access_token': 'a3', 'refresh_token': 'r3',
+                'expires_in': 3600}
+        one.auth = {'access_token': 'a1', 'refresh_token': 'r1'}
+        one.access_token = 'a1'
+        self.cache.update('key', lambda entry: (entry, time.time() - 1))
+        one.renew_access_token()
+        self.assertEqual('r2', mock_post.call_args[0][1]['refresh_token'])
+        self.assertEqual('r3', self.cache.read()['key']['refresh_token'])
+
+
+class LocationUploaderTest(TestCase):
+    @patch.object(Session, 'post')
+    def setUp(self, mock_post):
+        # Mock out Session.post to return a fake access_token.
+        auth = {'access_token': 33187}
+        mock_post.return_value = auth
+
+        self.session = Geoloqi().session
+
+    def point(self, latitude, longitude):
+        return {'location': {'position': {'latitude': latitude,
+                'longitude': longitude}}}
+
+    @patch.object(Session, 'post')
+    def test_flush_size(self, mock_post):
+        mock_post.return_value = {'result': 'ok'}
+
+        uploader = LocationUploader(self.session, batch_size=3, max_age=60)
+        for n in range(7):
+            uploader.add(self.point(45 + n, -122))
+        uploader.close()
+
+        # Full batches are posted as they fill, and the rest on close
+        self.assertEqual([3, 3, 1],
+                [len(call[0][1]) for call in mock_post.call_args_list])
+        mock_post.assert_called_with('location/update', [self.point(51, -122)])
+
+        stats = uploader.stats()
+        self.assertEqual(7, stats['added'])
+        self.assertEqual(7, stats['sent'])
+        self.assertEqual(3, stats['flushes'])
+        self.assertEqual(0, stats['queue_depth'])
+
+    @patch.object(Session, 'post')
+    def test_flush_age(self, mock_post):
+        mock_post.return_value = {'result': 'ok'}
+
+        uploader = LocationUploader(self.session, max_age=0.05)
+        uploader.add(self.point(45, -122))
+        time.sleep(0.2)
+        self.assertEqual(1, mock_post.call_count)
+        uploader.close()
+
+    @patch.object(Session, 'post')
+    def test_coalesce(self, mock_post):
+        mock_post.return_value = {'result': 'ok'}
+
+        uploader = LocationUploader(self.session, coalesce_distance=10)
+        uploader.add(self.point(45.52, -122.68), device='a')
+        uploader.add(self.point(45.52001, -122.68), device='a')
+        uploader.add(self.point(45.52001, -122.68), device='b')
+        uploader.add(self.point(45.53, -122.68), device='a')
+        self.assertTrue(uploader.flush(1))
+
+        # Nearby points from the same device replace each other
+        self.assertEqual([self.point(45.52001, -122.68),
+                self.point(45.52001, -122.68), self.point(45.53, -122.68)],
+                mock_post.call_args[0][1])
+        self.assertEqual(1, uploader.stats()['coalesced'])
+        uploader.close()
+
+    @patch.object(Session, 'post')
+    def test_errors(self, mock_post):
+        mock_post.return_value = {'error': 'bad_request'}
+        on_error = Mock()
+
+        uploader = LocationUploader(self.session, on_error=on_error)
+        uploader.add(self.point(45, -122))
+        uploader.close()
+
+        on_error.assert_called_with([self.point(45, -122)], {'error': 'bad_request'})
+        self.assertEqual(1, uploader.stats()['failed'])
+        self.assertRaises(ValueError, uploader.add, self.point(45, -122))
+        self.assertRaises(ValueError, uploader.flush)
+
+    @patch.object(Session, 'post')
+    def test_close_race(self, mock_post):
+        mock_post.return_value = {'result': 'ok'}
+        uploader = LocationUploader(self.session, batch_size=10)
+
+        def add():
+            try:
+                while True:
+                    uploader.add(self.point(45, -122))
+            except ValueError:
+                pass
+        threads = [threading.Thread(target=add) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        uploader.close()
+        for thread in threads:
+            thread.join()
+
+        # Every point added before the close is sent
+        stats = uploader.stats()
+        self.assertEqual(stats['added'], stats['sent'])
+        self.assertEqual(stats['added'],
+                sum(len(call[0][1]) for call in mock_post.call_args_list))
+
+    @patch.object(Session, 'post')
+    def test_callback_errors(self, mock_post):
+        mock_post.return_value = {'error': 'bad_request'}
+        simplifier = Mock()
+        simplifier.accept.side_effect = [True, ValueError('bad point'), True]
+        simplifier.simplify.side_effect = lambda points, device: points
+
+        # Exceptions from callbacks don't stop the background thread
+        uploader = LocationUploader(self.session, coalesce_distance=0,
+                on_error=Mock(side_effect=RuntimeError('oops')),
+                simplifier=simplifier)
+        for n in range(3):
+            uploader.add(self.point(45 + n, -122), device='a')
+        self.assertTrue(uploader.flush(1))
+        self.assertTrue(uploader.thread.is_alive())
+
+        simplifier.accept.side_effect = None
+        simplifier.accept.return_value = True
+        simplifier.simplify.side_effect = ValueError('bad track')
+        uploader.add(self.point(45, -122), device='a')
+        self.assertTrue(uploader.flush(1))
+        uploader.close()
+        self.assertFalse(uploader.thread.is_alive())
+
+        stats = uploader.stats()
+        self.assertEqual(4, stats['failed'])
+        self.assertEqual(3, stats['errors'])
+        self.assertEqual(1, mock_post.call_count)
+
+    @patch.object(LocationUploader, 'process')
+    def test_backpressure(self, mock_process):
+        # Without the background thread draining it the queue fills up
+        uploader = LocationUploader(self.session, queue_size=1)
+        uploader.add(self.point(45, -122))
+        self.assertRaises(Full, uploader.add, self.point(45, -122), block=False)
+        self.assertRaises(Full, uploader.add, self.point(45, -122), timeout=0.01)
+        self.assertEqual(1, uploader.stats()['queue_depth'])
+
+
+class SimplifyTest(TestCase):
+    def point(self, latitude, longitude, date_ts=None):
+        point = {'location': {'position': {'latitude': latitude,
+                'longitude': longitude}}}
+        if date_ts is not None:
+            point['date_ts'] = date_ts
+        return point
+
+    def test_point_time(self):
+        self.assertEqual(1331143200.0, point_time({'date': '2012-03-07T10:00:00-08:00'}))
+        self.assertEqual(1331114400.0, point_time({'date': '2012-03-07T10:00:00Z'}))
+        self.assertEqual(1331114400.0, point_time({'date': '2012-03-07T10:00:00+0000'}))
+        self.assertEqual(1331114400.0, point_time({'date_ts': 1331114400,
+                'date': 'garbage'}))
+        self.assertEqual(None, point_time({'date': 'garbage'}))
+        self.assertEqual(None, point_time({}))
+
+    def test_simplify(self):
+        # A nearly straight road north, then a turn east
+        track = [self.point(45.5 + n * 0.001, -122.6 + (n % 2) * 0.00001, n)
+                for n in range(10)]
+        track += [self.point(45.509, -122.6 + n * 0.001, 10 + n)
+                for n in range(1, 10)]
+        self.assertEqual([track[0], track[9], track[-1]], simplify(track, 5))
+        self.assertEqual(track, simplify(track, 0))
+        # At a finer tolerance the wiggles along the road are kept
+        self.assertEqual(track[:10] + track[-1:], simplify(track, 0.1))
+
+        # Points without a position are kept where they are
+        marker = {'date_ts': 5}
+        self.assertEqual([track[0], marker, track[9], track[-1]],
+                simplify(track[:5] + [marker] + track[5:], 5))
+
+        # Waiting at the corner is only kept by time-aware simplification
+        stop = track[:10] + [self.point(45.509, -122.6, 10 + n)
+                for n in range(30)] + [self.point(45.509, -122.6 + n * 0.001, 39 + n)
+                for n in range(1, 10)]
+        self.assertEqual(3, len(simplify(stop, 5)))
+        kept = simplify(stop, 5, time_aware=True)
+        self.assertEqual([0, 9, 39, 48], [stop.index(point) for point in kept])
+
+    def test_encode_track(self):
+        track = [self.point(45.5165, -122.6764, 1331114400),
+                self.point(45.51651, -122.67641, 1331114405),
+                {'date_ts': 1331114406},
+                self.point(-33.8688, 151.2093)]
+        data = encode_track(track)
+        self.assertEqual([(45.5165, -122.6764, 1331114400),
+                (45.51651, -122.67641, 1331114405),
+                (-33.8688, 151.2093, None)], decode_track(data))
+        self.assertTrue(len(data) < 40)
+        self.assertEqual([], decode_track(encode_track([])))
+
+    def test_track_simplifier(self):
+        simplifier = TrackSimplifier(min_distance=20, min_time=10)
+        self.assertTrue(simplifier.accept(self.point(45.5, -122.6, 0), 'a'))
+        # Too close, then too soon, then far and late enough
+        self.assertFalse(simplifier.accept(self.point(45.5001, -122.6, 60), 'a'))
+        self.assertFalse(simplifier.accept(self.point(45.51, -122.6, 5), 'a'))
+        self.assertTrue(simplifier.accept(self.point(45.51, -122.6, 15), 'a'))
+        # Devices are filtered separately, and points without times use
+        # the time they were received
+        self.assertTrue(simplifier.accept(self.point(45.5001, -122.6), 'b', 100))
+        self.assertFalse(simplifier.accept(self.point(45.6, -122.6), 'b', 105))
+        self.assertTrue(simplifier.accept({'date_ts': 16}, 'a'))
+
+        stats = simplifier.stats()
+        self.assertEqual(5, stats['a']['points'])
+        self.assertEqual(2, stats['a']['filtered'])
+        self.assertEqual(2, stats['a']['dropped'])
+        self.assertEqual(len(json.dumps(self.point(45.5001, -122.6, 60))) +
+                len(json.dumps(self.point(45.51, -122.6, 5))) + 2,
+                stats['a']['bytes_saved'])
+        self.assertEqual(1, stats['b']['dropped'])
+
+    @patch.object(Session, 'post')
+    def test_uploader(self, mock_post):
+        mock_post.return_value = {'access_token': 33187}
+        session = Geoloqi().session
+        mock_post.return_value = {'result': 'ok'}
+
+        simplifier = TrackSimplifier(min_time=5, tolerance=5)
+        uploader = LocationUploader(session, coalesce_distance=0,
+                simplifier=simplifier)
+        # A device reporting every second down a straight road, and points
+        # without a device
+        for n in range(20):
+            uploader.add(self.point(45.5 + n * 0.001, -122.6, n), device='a')
+        uploader.add(self.point(45, -122, 3))
+        uploader.add(self.point(45, -122, 4))
+        uploader.close()
+
+        self.assertEqual([self.point(45.5, -122.6, 0), self.point(45.515, -122.6, 15),
+                self.point(45, -122, 3), self.point(45, -122, 4)],
+                mock_post.call_args[0][1])
+        stats = uploader.stats()
+        self.assertEqual(4, stats['sent'])
+        self.assertEqual({'points': 20, 'filtered': 16, 'simplified': 2,
+                'dropped': 18, 'bytes_saved': stats['simplifier']['a']['bytes_saved']},
+                stats['simplifier']['a'])
+        self.assertTrue(stats['simplifier']['a']['bytes_saved'] > 18 * 50)
+
+
+class LocationTrackTest(TestCase):
+    def point(self, n):
+        return {
+            'date_ts': 1331114400 + n * 10,
+            'location': {'position': {
+                'latitude': 45.5 + n * 0.001,
+                'longitude': '-122.6',
+                'speed': n,
+                'horizontal_accuracy': 10,
+            }},
+        }
+
+    def test_track(self):
+        track = LocationTrack([self.point(n) for n in range(5)])
+        track.extend([self.point(n) for n in range(5, 8)])
+        track.append(self.point(8))
+        track.extend([])
+
+        self.assertEqual(9, len(track))
+        self.assertEqual(45.503, track.latitude[3])
+        self.assertEqual(-122.6, track.longitude[-1])
+        point = track[2]
+        self.assertEqual(TrackPoint(1331114420.0, 45.502, -122.6, 10.0, 2.0,
+                point.altitude, point.heading), point)
+        self.assertTrue(point.altitude != point.altitude)
+        self.assertEqual(range(9), [int(point.speed) for point in track])
+        self.assertEqual(9 * (3 * 8 + 4 * 4), track.nbytes())
+
+        # Points without a date or out of order are refused
+        self.assertRaises(ValueError, track.append, {'latitude': 45, 'longitude': -122})
+        self.assertRaises(ValueError, track.extend, [self.point(9), self.point(1)])
+        self.assertEqual(9, len(track))
+
+        # Dates are used when there is no timestamp
+        track.append({'date': '2012-03-07T10:01:30Z', 'latitude': 45, 'longitude': -122})
+        self.assertEqual(1331114490.0, track.timestamp[-1])
+
+    def test_slicing(self):
+        track = LocationTrack([self.point(n) for n in range(10)])
+        self.assertEqual(range(3, 7), [int(point.speed) for point in
+                track.between(1331114430, 1331114470)])
+        self.assertEqual(range(3, 7), [int(point.speed) for point in
+                track.between(1331114425, 1331114461)])
+        self.assertEqual(range(8), [int(point.speed) for point in
+                track.between(end=1331114480)])
+        self.assertEqual(range(8, 10), [int(point.speed) for point in
+                track.between(1331114480)])
+        self.assertEqual(0, len(track.between(1331114500)))
+        self.assertEqual(0, len(track.between(1331114450, 1331114400)))
+        self.assertEqual(range(0, 10, 3), [int(point.speed) for point in track[::3]])
+
+        # Slices are copies
+        part = track[2:4]
+        part.append(self.point(20))
+        self.assertEqual(3, len(part))
+        self.assertEqual(10, len(track))
+
+    @patch.object(Session, 'get')
+    @patch.object(Session, 'post')
+    def test_location_track(self, mock_post, mock_get):
+        mock_post.return_value = {'access_token': 33187}
+        points = [self.point(n) for n in range(5)]
+        mock_get.side_effect = lambda path, args, headers: {'points':
+                [point for point in points if point['date_ts'] > args.get('after', 0)
+                ][:args['count']]}
+
+        track = Geoloqi().location_track(page_size=2)
+        self.assertEqual([point['date_ts'] for point in points], list(track.timestamp))
+        # Each page starts again at its previous page's last point
+        self.assertEqual(5, mock_get.call_count)
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'history.glq')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def point(self, n):
+        return {
+            'date_ts': 1331114400 + n * 10,
+            'location': {'position': {'latitude': 45.5 + n * 0.001,
+                    'longitude': -122.6, 'speed': n}},
+        }
+
+    def speeds(self, points):
+        return [int(point.speed) for point in points]
+
+    def test_archive(self):
+        with ArchiveWriter(self.path) as archive:
+            self.assertEqual(5, archive.write([self.point(n) for n in range(5)], 'a'))
+            self.assertEqual(3, archive.write(LocationTrack(
+                    [self.point(n) for n in range(5, 8)]), 'a'))
+            self.assertEqual(2, archive.write([self.point(n) for n in range(2)], 42))
+            self.assertEqual(1, archive.write([self.point(0)]))
+            self.assertEqual(0, archive.write([]))
+
+        with ArchiveReader(self.path) as archive:
+            self.assertEqual(11, len(archive))
+            self.assertEqual(set([u'a', u'42', None]), set(archive.devices()))
+            self.assertEqual(1331114470.0, archive.last_timestamp('a'))
+            self.assertEqual(None, archive.last_timestamp('b'))
+
+            # Time ranges are read across blocks
+            track = archive.read('a')
+            self.assertEqual(range(8), self.speeds(track))
+            expected = LocationTrack([self.point(n) for n in range(8)])
+            for column in ['timestamp', 'latitude', 'longitude', 'speed']:
+                self.assertEqual(getattr(expected, column), getattr(track, column))
+            self.assertEqual(range(3, 7), self.speeds(archive.read('a',
+                    1331114430, 1331114470)))
+            self.assertEqual(range(3, 7), self.speeds(archive.scan('a',
+                    1331114425, 1331114461)))
+            self.assertEqual(range(6, 8), self.speeds(archive.read('a', 1331114460)))
+            self.assertEqual([], self.speeds(archive.read('a', 1331114480)))
+            self.assertEqual(range(2), self.speeds(archive.scan(42)))
+            self.assertEqual([0], self.speeds(archive.read()))
+
+    def test_append(self):
+        with ArchiveWriter(self.path) as archive:
+            archive.write([self.point(n) for n in range(5)], 'a')
+        reader = ArchiveReader(self.path)
+
+        # Points already archived are skipped when writing again
+        with ArchiveWriter(self.path) as archive:
+            self.assertEqual(1331114440.0, archive.last_timestamp('a'))
+            self.assertEqual(3, archive.write([self.point(n) for n in range(3, 8)], 'a'))
+            self.assertEqual(0, archive.write([self.point(n) for n in range(8)], 'a'))
+
+        # Readers pick up blocks appended since they were opened
+        self.assertEqual(5, len(reader))
+        reader.refresh()
+        self.assertEqual(range(8), self.speeds(reader.read('a')))
+        reader.close()
+
+        # A block cut short by a crash is ignored, then overwritten
+        size = os.path.getsize(self.path)
+        with ArchiveWriter(self.path) as archive:
+            archive.write([self.point(n) for n in range(8, 12)], 'a')
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 10)
+        with ArchiveReader(self.path) as archive:
+            self.assertEqual(range(8), self.speeds(archive.read('a')))
+            self.assertEqual(size, archive.size)
+        with ArchiveWriter(self.path) as archive:
+            self.assertEqual(2, archive.write([self.point(n) for n in range(8, 10)], 'a'))
+        with ArchiveReader(self.path) as archive:
+            self.assertEqual(range(10), self.speeds(archive.read('a')))
+
+        with open(self.path, 'wb') as f:
+            f.write('not an archive')
+        self.assertRaises(ValueError, ArchiveReader, self.path)
+        self.assertRaises(ValueError, ArchiveWriter, self.path)
+
+    @patch.object(Session, 'get')
+    @patch.object(Session, 'post')
+    def test_export_history(self, mock_post, mock_get):
+        mock_post.return_value = {'access_token': 33187}
+        points = [self.point(n) for n in range(5)]
+        mock_get.side_effect = lambda path, args, headers: {'points':
+                [point for point in points if point['date_ts'] > args.get('after', 0)
+                ][:args['count']]}
+
+        geoloqi = Geoloqi()
+        self.assertEqual(5, geoloqi.export_history(self.path, device='a', page_size=2))
+
+        # Only newer points are requested the next time
+        points.extend(self.point(n) for n in range(5, 7))
+        mock_get.reset_mock()
+        self.assertEqual(2, geoloqi.export_history(self.path, device='a', page_size=2))
+        self.assertEqual(1331114440, mock_get.call_args_list[0][0][1]['after'])
+
+        with ArchiveReader(self.path) as archive:
+            self.assertEqual(range(7), self.speeds(archive.read('a')))
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(maxsize=2, ttl=60, ttls={'place/list': 0})
+
+    def headers(self, **headers):
+        info = Mock()
+        info.getheader.side_effect = lambda name: headers.get(name.replace('-', '_'))
+        return info
+
+    def test_lookup_store(self):
+        self.assertEqual(None, self.cache.lookup('account/profile', 'a'))
+
+        self.cache.store('account/profile', 'a', {'name': 'a'})
+        entry = self.cache.lookup('account/profile', 'a')
+        self.assertEqual({'name': 'a'}, entry.response)
+        self.assertTrue(entry.is_fresh())
+
+        # Responses are cached per access token
+        self.assertEqual(None, self.cache.lookup('account/profile', 'b'))
+
+        # Paths with a zero TTL are only kept if they can be revalidated
+        self.cache.store('place/list?count=5', 'a', {'places': []})
+        self.assertEqual(None, self.cache.lookup('place/list?count=5', 'a'))
+
+        self.cache.store('place/list?count=5', 'a', {'places': []},
+                self.headers(ETag='"v1"'))
+        entry = self.cache.lookup('place/list?count=5', 'a')
+        self.assertFalse(entry.is_fresh())
+        self.assertEqual({'If-None-Match': '"v1"'}, entry.validators())
+
+        self.assertEqual({'hits': 1, 'misses': 4, 'revalidations': 0,
+                'evictions': 0, 'size': 2}, self.cache.stats())
+
+    def test_eviction(self):
+        self.cache.store('one', 'a', 1)
+        self.cache.store('two', 'a', 2)
+        self.cache.lookup('one', 'a')
+        self.cache.store('three', 'a', 3)
+
+        # The least recently used entry is evicted
+        self.assertEqual(None, self.cache.lookup('two', 'a'))
+        self.assertEqual(1, self.cache.lookup('one', 'a').response)
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_get_path(self):
+        self.assertEqual('place/list', get_path('place/list'))
+
+        # Arguments are sorted, however the dictionary orders them
+        args = dict(('key%d' % n, n) for n in range(20))
+        other = dict(reversed(args.items()))
+        self.assertEqual(get_path('place/list', args),
+                get_path('place/list', other))
+        self.assertEqual('place/list?after=1&count=5',
+                get_path('place/list', {'count': 5, 'after': 1}))
+
+    def test_invalidate(self):
+        self.cache.store('place/info?place_id=1', 'a', 1)
+        self.cache.store('trigger/list', 'a', 2)
+
+        self.cache.invalidate('place/update/1')
+        self.assertEqual(None, self.cache.lookup('place/info?place_id=1', 'a'))
+        self.assertEqual(2, self.cache.lookup('trigger/list', 'a').response)
+
+    @patch.object(Session, 'execute')
+    @patch.object(Session, 'post')
+    def test_session(self, mock_post, mock_execute):
+        mock_post.return_value = {'access_token': 33187}
+        session = Session('key', 'secret', cache=self.cache)
+
+        result = Mock()
+        result.read.return_value = json.dumps({'name': 'a'})
+        result.info.return_value = self.headers(ETag='"v1"')
+        mock_execute.return_value = result
+
+        # Fresh responses are served without a request
+        self.assertEqual({'name': 'a'}, session.run('account/profile'))
+        self.assertEqual({'name': 'a'}, session.run('account/profile'))
+        self.assertEqual(1, mock_execute.call_count)
+
+        # Stale responses are revalidated
+        self.cache.lookup('account/profile', 33187).expires_at = 0
+        mock_execute.return_value = HTTPError('', 304, 'Not Modified', {}, None)
+        self.assertEqual({'name': 'a'}, session.run('account/profile'))
+        self.assertEqual('"v1"', mock_execute.call_args[0][2]['If-None-Match'])
+        self.assertEqual(1, self.cache.stats()['revalidations'])
+
+        # The revalidation's body is closed, releasing its connection
+        body = Mock()
+        body.read.return_value = ''
+        self.cache.lookup('account/profile', 33187).expires_at = 0
+        mock_execute.return_value = HTTPError('', 304, 'Not Modified', {}, body)
+        self.assertEqual({'name': 'a'}, session.run('account/profile'))
+        self.assertTrue(body.read.called)
+        self.assertTrue(body.close.called)
+
+        # POSTs invalidate the resource family
+        mock_execute.return_value = result
+        session.run('account/update', {'name': 'b'})
+        self.assertEqual(None, self.cache.lookup('account/profile', 33187))
+
+
+class StreamTest(TestCase):
+    def test_iter_array(self):
+        document = {
+            'count': 3,
+            'paging': {'next_offset': None},
+            'points': [{'a': [1, 2.5, '],}']}, 12345, 'x', None, True, []],
+            'after': 'ignored',
+        }
+
+        # Elements are decoded however the document is split into chunks
+        for chunk_size in (1, 2, 7, 100):
+            f = StringIO(json.dumps(document, indent=1))
+            self.assertEqual(document['points'],
+                    list(iter_array(f, 'points', chunk_size)))
+            self.assertTrue(f.closed)
+
+        f = StringIO(json.dumps(document['points']))
+        self.assertEqual(document['points'], list(iter_array(f, chunk_size=3)))
+
+        self.assertEqual([], list(iter_array(StringIO('{"points": []}'), 'points')))
+        self.assertEqual([], list(iter_array(StringIO('{"places": []}'), 'points')))
+
+    def test_split_numbers(self):
+        # Numbers cut after their '.', 'e' or '-' aren't taken as complete
+        document = {'count': 45.5165, 'points': [45.5165 + i * 1e-5 for i in
+                range(200)] + [-1.5e-07, -122.6764, 12345678]}
+        for chunk_size in range(1, 40):
+            f = StringIO(json.dumps(document))
+            self.assertEqual(document['points'],
+                    list(iter_array(f, 'points', chunk_size)))
+
+        points = [45.5165 + i * 1e-5 for i in range(20000)]
+        f = StringIO(json.dumps({'points': points}))
+        self.assertEqual(points, list(iter_array(f, 'points')))
+
+    def test_errors(self):
+        f = StringIO(json.dumps({'error': 'forbidden'}))
+        self.assertRaises(GeoloqiError, list, iter_array(f, 'points'))
+
+        f = StringIO('{"points": [1, 2')
+        self.assertRaises(ValueError, list, iter_array(f, 'points', 4))
+
+
+class RetryPolicyTest(TestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(max_retries=2, backoff=1, max_backoff=3,
+                budget=10)
+
+    def error(self, code, headers=None):
+        return HTTPError('', code, '', headers or {}, StringIO('{}'))
+
+    def test_is_retryable(self):
+        self.assertTrue(self.policy.is_retryable(self.error(503)))
+        self.assertTrue(self.policy.is_retryable(self.error(429), post=True))
+        self.assertTrue(self.policy.is_retryable(URLError('down')))
+        self.assertTrue(self.policy.is_retryable(socket.timeout()))
+
+        # Client errors and successful responses aren't retried
+        self.assertFalse(self.policy.is_retryable(self.error(400)))
+        self.assertFalse(self.policy.is_retryable(self.error(401)))
+        self.assertFalse(self.policy.is_retryable(StringIO('{}')))
+
+        # POSTs are only retried if they are known not to have been handled
+        self.assertFalse(self.policy.is_retryable(self.error(503), post=True))
+        self.assertFalse(self.policy.is_retryable(URLError('down'), post=True))
+        self.policy.retry_post = True
+        self.assertTrue(self.policy.is_retryable(self.error(503), post=True))
+
+    def test_get_delay(self):
+        for attempt in range(5):
+            delay = self.policy.get_delay(attempt)
+            self.assertTrue(0 <= delay <= min(3, 2 ** attempt))
+
+        # Retry-After is honored as seconds or as a date
+        error = self.error(429, {'Retry-After': '7'})
+        self.assertEqual(7, self.policy.get_delay(0, error))
+
+        error = self.error(503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(0, get_retry_after(error))
+        self.assertEqual(None, get_retry_after(self.error(503)))
+
+    @patch.object(RetryPolicy, 'sleep')
+    @patch.object(Session, 'execute')
+    @patch.object(Session, 'post')
+    def test_session(self, mock_post, mock_execute, mock_sleep):
+        mock_post.return_value = {'access_token': 33187}
+        session = Session('key', 'secret', retry_policy=self.policy)
+
+        # Transient failures are retried until one succeeds
+        results = iter([URLError('down'), self.error(503),
+                StringIO('{"result": "ok"}')])
+        mock_execute.side_effect = lambda *args: results.next()
+        self.assertEqual({'result': 'ok'}, session.run('foo/bar'))
+        self.assertEqual(3, mock_execute.call_count)
+        self.assertEqual(2, mock_sleep.call_count)
+
+        # Connection errors are raised once the retries run out
+        mock_execute.reset_mock()
+        mock_execute.side_effect = None
+        mock_execute.return_value = URLError('down')
+        self.assertRaises(URLError, session.run, 'foo/bar')
+        self.assertEqual(3, mock_execute.call_count)
+
+        # And no retry is made that would overrun the budget
+        mock_execute.reset_mock()
+        mock_execute.return_value = self.error(429, {'Retry-After': '60'})
+        self.assertEqual({}, session.run('foo/bar'))
+        self.assertEqual(1, mock_execute.call_count)
+
+
+class CodecTest(TestCase):
+    def test_get_codec(self):
+        self.assertEqual('json', get_codec('json').name)
+        self.assertTrue(isinstance(get_codec(), JSONCodec))
+        self.assertRaises(ValueError, get_codec, 'no-such-codec')
+
+        # The standard library is used unless a faster codec is asked for
+        self.assertEqual('json', get_codec().name)
+        self.assertTrue(isinstance(get_codec('fastest'), JSONCodec))
+
+    @patch.object(urllib2.OpenerDirector, 'open')
+    @patch.object(Session, 'post')
+    def test_session(self, mock_post, mock_open):
+        mock_post.return_value = {'access_token': 33187}
+        codec = Mock(wraps=JSONCodec())
+        session = Session('key', 'secret', codec=codec)
+
+        mock_open.side_effect = lambda *args, **kwargs: urllib.addinfourl(
+                StringIO('{"result": "ok"}'), mimetools.Message(StringIO('')),
+                '', 200)
+
+        # Bodies are encoded and decoded with the session's codec
+        self.assertEqual({'result': 'ok'}, session.run('foo/bar', {'one': 1}))
+        codec.dumps.assert_called_with({'one': 1})
+        codec.loads.assert_called_with('{"result": "ok"}')
+
+        # Encoded strings and payloads are sent as they are
+        codec.dumps.reset_mock()
+        session.run('foo/bar', '{"two": 2}')
+        self.assertEqual('{"two": 2}', mock_open.call_args[0][0].data)
+        session.run('foo/bar', u'{"two": "\u00e9"}')
+        self.assertEqual('{"two": "\xc3\xa9"}', mock_open.call_args[0][0].data)
+        self.assertFalse(codec.dumps.called)
+
+        payload = Payload([{'three': 3}], codec)
+        self.assertEqual(1, codec.dumps.call_count)
+        for n in range(3):
+            session.run('location/update', payload)
+        self.assertEqual(payload.body, mock_open.call_args[0][0].data)
+        self.assertEqual(1, codec.dumps.call_count)
+
+    @patch.object(Session, 'post')
+    def test_batch(self, mock_post):
+        mock_post.return_value = {'access_token': 33187}
+        batch = Batch(Session('key', 'secret'))
+
+        # Batched bodies are nested in the batch request, so are decoded
+        batch.post('a', Payload({'one': 1})).post('b', '{"two": 2}') \
+                .post('c', u'{"three": 3}')
+        self.assertEqual([{'one': 1}, {'two': 2}, {'three': 3}],
+                [job['body'] for job in batch.jobs])
+
+
+class MultiUserGeoloqiTest(TestCase):
+    @patch.object(Session, 'post')
+    def setUp(self, mock_post):
+        mock_post.return_value = {'access_token': 33187}
+        self.saved = {}
+        self.geoloqi = MultiUserGeoloqi(maxsize=2,
+                loader=lambda user_id: self.saved.get(user_id),
+                on_refresh=self.saved.__setitem__)
+
+    @patch.object(Session, 'execute')
+    def test_as_user(self, mock_execute):
+        mock_execute.side_effect = lambda *args: StringIO('{"result": "ok"}')
+        self.geoloqi.add_user(1, 'one')
+        self.geoloqi.add_user(2, 'two')
+
+        # Each user's calls are made with their own token
+        self.assertEqual({'result': 'ok'},
+                self.geoloqi.as_user(2).get('account/profile'))
+        self.assertEqual('OAuth two',
+                mock_execute.call_args[0][2]['Authorization'])
+        self.geoloqi.as_user(1).get('account/profile')
+        self.assertEqual('OAuth one',
+                mock_execute.call_args[0][2]['Authorization'])
+
+        # Over the application's pool, metrics and policies
+        user = self.geoloqi.as_user(1).session
+        self.assertTrue(user.pool is self.geoloqi.session.pool)
+        self.assertTrue(user.retry_policy is self.geoloqi.session.retry_policy)
+        self.assertEqual(2, self.geoloqi.session.stats()['endpoints']
+                ['account/profile']['requests'])
+        self.assertEqual(33187, self.geoloqi.session.access_token)
+
+    def test_registry(self):
+        users = self.geoloqi.users
+        users.add(1, 'one')
+        users.add(2, 'two')
+        users.get(1)
+        users.add(3, 'three')
+
+        # The least recently used user is evicted
+        self.assertEqual(2, len(users))
+        self.assertFalse(2 in users)
+        self.assertEqual(1, users.evictions)
+        self.assertRaises(KeyError, self.geoloqi.as_user, 2)
+
+        # User sessions only hold the user's own state
+        self.assertTrue(len(vars(users.get(1))) <= 5)
+
+        # Unknown users are loaded
+        self.saved[4] = {'access_token': 'four', 'refresh_token': 'r4'}
+        self.assertEqual('four', self.geoloqi.as_user(4).session.access_token)
+        self.assertTrue(4 in users)
+
+    @patch.object(Session, 'execute')
+    def test_refresh(self, mock_execute):
+        self.geoloqi.add_user(1, 'old', 'refresh-1')
+        self.geoloqi.add_user(2, 'other', 'refresh-2')
+
+        def execute(path, data, headers, timeout=None):
+            if path == 'oauth/token':
+                return StringIO(json.dumps({'access_token': 'new',
+                        'expires_in': 3600}))
+            if headers['Authorization'] == 'OAuth old':
+                return StringIO('{"error": "expired_token"}')
+            return StringIO('{"result": "ok"}')
+        mock_execute.side_effect = execute
+
+        # Expired tokens are renewed with the user's own refresh token
+        self.assertEqual({'result': 'ok'},
+                self.geoloqi.as_user(1).get('account/profile'))
+        refresh = [call[0][1] for call in mock_execute.call_args_list
+                if call[0][0] == 'oauth/token']
+        self.assertEqual('refresh-1', refresh[0]['refresh_token'])
+
+        # And the new tokens are handed back for safe keeping
+        self.assertEqual('new', self.saved[1]['access_token'])
+        self.assertEqual('refresh-1', self.saved[1]['refresh_token'])
+        self.assertEqual('new', self.geoloqi.as_user(1).session.access_token)
+        self.assertEqual('other', self.geoloqi.as_user(2).session.access_token)
+        self.assertEqual(33187, self.geoloqi.session.access_token)
+
+
+class CoalescerTest(TestCase):
+    def concurrently(self, func, n=5):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func()))
+                for i in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_call(self):
+        coalescer = Coalescer()
+        calls = []
+
+        def slow(value):
+            calls.append(value)
+            time.sleep(0.1)
+            if isinstance(value, Exception):
+                raise value
+            return {'value': value}
+
+        # Identical calls in flight share one result
+        results = self.concurrently(lambda: coalescer.call('a',
+                lambda: slow(1)))
+        self.assertEqual(1, len(calls))
+        self.assertEqual([{'value': 1}] * 5, results)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual({'made': 1, 'coalesced': 4, 'in_flight': 0},
+                coalescer.stats())
+
+        # But nothing is kept once the call has finished
+        coalescer.call('a', lambda: slow(2))
+        self.assertEqual(2, len(calls))
+
+        # Exceptions are shared too
+        def failing():
+            try:
+                coalescer.call('b', lambda: slow(ValueError('down')))
+            except ValueError, e:
+                return e
+        errors = self.concurrently(failing)
+        self.assertEqual(3, len(calls))
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+
+        # Callers waiting on another's call can give up
+        thread = threading.Thread(target=coalescer.call,
+                args=('c', lambda: slow(3)))
+        thread.start()
+        time.sleep(0.01)
+        self.assertRaises(DeadlineExceeded, coalescer.call, 'c',
+                lambda: slow(4), 0.01)
+        thread.join()
+
+    @patch.object(Session, 'run')
+    @patch.object(Session, 'post')
+    def test_session(self, mock_post, mock_run):
+        mock_post.return_value = {'access_token': 33187}
+        session = Session('key', 'secret', coalescer=Coalescer())
+
+        def run(*args, **kwargs):
+            time.sleep(0.1)
+            return {'places': []}
+        mock_run.side_effect = run
+
+        # Identical GETs are coalesced, whatever order their args are in
+        args = iter([{'layer_id': 'a', 'count': 10},
+                {'count': 10, 'layer_id': 'a'}] * 3)
+        results = self.concurrently(lambda: session.get('place/list',
+                args.next()))
+        self.assertEqual([{'places': []}] * 5, results)
+        self.assertEqual(1, mock_run.call_count)
+        self.assertEqual(4, session.stats()['coalescer']['coalesced'])
+
+        # GETs with other arguments, and streamed GETs, are not
+        mock_run.reset_mock()
+        self.concurrently(lambda: session.get('place/list',
+                {'layer_id': threading.current_thread().name}))
+        self.assertEqual(5, mock_run.call_count)
+
+        mock_run.reset_mock()
+        self.concurrently(lambda: session.get('place/list', stream='places'))
+        self.assertEqual(5, mock_run.call_count)
+
+
+class TriggerIndexTest(TestCase):
+    def setUp(self):
+        # Two overlapping triggers downtown, and one across the river
+        self.triggers = [
+            {'trigger_id': 'a', 'place': {'latitude': 45.5165,
+                    'longitude': -122.6764, 'radius': 200}},
+            {'trigger_id': 'b', 'latitude': '45.5175',
+                    'longitude': '-122.6764', 'radius': '200'},
+            {'trigger_id': 'c', 'latitude': 45.5230, 'longitude': -122.6610,
+                    'radius': 100},
+            {'trigger_id': 'd', 'text': 'No place'},
+        ]
+        self.index = TriggerIndex(self.triggers, cell_size=0.001)
+
+    def ids(self, regions):
+        return [region.id for region in regions]
+
+    def test_get_region(self):
+        region = get_region(self.triggers[1])
+        self.assertEqual(('b', 45.5175, -122.6764, 200.0),
+                region[:4])
+        self.assertTrue(region.record is self.triggers[1])
+        self.assertEqual(None, get_region(self.triggers[3]))
+
+    def test_containing(self):
+        self.assertEqual(3, len(self.index))
+        self.assertEqual(['a', 'b'], self.ids(self.index.containing(45.5166, -122.6764)))
+        self.assertEqual(['b', 'a'], self.ids(self.index.containing(45.5174, -122.6764)))
+        self.assertEqual(['c'], self.ids(self.index.containing(45.5230, -122.6620)))
+        self.assertEqual([], self.ids(self.index.containing(45.5230, -122.6630)))
+
+        # The grid agrees with checking every trigger
+        for n in range(200):
+            latitude = 45.514 + n % 20 * 0.0005
+            longitude = -122.680 + n / 20 * 0.002
+            expected = [region for region in self.index.regions.values()
+                    if distance(latitude, longitude, region.latitude,
+                            region.longitude) <= region.radius]
+            self.assertEqual(sorted(self.ids(expected)),
+                    sorted(self.ids(self.index.containing(latitude, longitude))))
+
+        # Triggers covering many cells are listed in a coarser grid
+        city = get_region({'trigger_id': 'city', 'latitude': 45.52,
+                'longitude': -122.67, 'radius': 5000})
+        self.index.add(city)
+        self.assertEqual(3, self.index.get_cells(city)[0])
+        self.assertEqual(0, self.index.get_cells(self.index.regions['c'])[0])
+        self.assertEqual(['c', 'city'], self.ids(self.index.containing(45.5230, -122.6620)))
+
+        # And triggers can be replaced and removed
+        self.index.add(get_region({'trigger_id': 'c', 'latitude': 45.5,
+                'longitude': -122.6, 'radius': 100}))
+        self.assertEqual(['city'], self.ids(self.index.containing(45.5230, -122.6620)))
+        for region_id in ['a', 'b', 'c', 'city']:
+            self.index.remove(region_id)
+        self.assertEqual(0, len(self.index))
+        self.assertEqual([{}] * self.index.levels, self.index.grids)
+
+    def test_tracker(self):
+        tracker = TriggerTracker(self.index)
+        self.assertEqual(([], []), tracker.update(45.5140, -122.6764))
+
+        entered, exited = tracker.update(45.5155, -122.6764)
+        self.assertEqual((['a'], []), (self.ids(entered), self.ids(exited)))
+        entered, exited = tracker.update(45.5170, -122.6764)
+        self.assertEqual((['b'], []), (self.ids(entered), self.ids(exited)))
+
+        # Devices are tracked separately
+        entered, exited = tracker.update(45.5170, -122.6764, device='other')
+        self.assertEqual(['a', 'b'], sorted(self.ids(entered)))
+        self.assertEqual(['a', 'b'], sorted(self.ids(tracker.inside_regions())))
+
+        entered, exited = tracker.update(45.5190, -122.6764)
+        self.assertEqual(([], ['a']), (self.ids(entered), self.ids(exited)))
+        entered, exited = tracker.update(45.5230, -122.6610)
+        self.assertEqual((['c'], ['b']), (self.ids(entered), self.ids(exited)))
+
+        tracker.forget('other')
+        self.assertEqual([], tracker.inside_regions('other'))
+
+    @patch.object(Session, 'get')
+    @patch.object(Session, 'post')
+    def test_trigger_index(self, mock_post, mock_get):
+        mock_post.return_value = {'access_token': 33187}
+        places = [{'place_id': 'p', 'latitude': 45.5, 'longitude': -122.6,
+                'radius': 100}]
+        mock_get.side_effect = lambda path, args, headers: {
+            'trigger/list': {'triggers': self.triggers},
+            'place/list': {'places': places},
+        }[path]
+
+        index = Geoloqi().trigger_index(cell_size=0.001)
+        self.assertEqual(3, len(index))
+        self.assertEqual(0.001, index.cell_size)
+        self.assertEqual(['trigger/list'],
+                [call[0][0] for call in mock_get.call_args_list])
+
+        index = Geoloqi().trigger_index(places=True)
+        self.assertEqual(4, len(index))
+        self.assertTrue('p' in index)
+
+
+@unittest.skipIf(geo is None, 'NumPy is not installed')
+class GeoTest(TestCase):
+    def setUp(self):
+        self.history = {'points': [
+            {'location': {'position': {'latitude': 45.5165, 'longitude': -122.6764}}},
+            {'location': {'position': {'latitude': '45.5175', 'longitude': '-122.6764'}}},
+            {'latitude': 45.5175, 'longitude': -122.6750},
+            {'date': '2012-03-07T10:00:00-08:00'},
+        ]}
+        self.pairs = [(45.5165, -122.6764), (45.5175, -122.6764),
+                (45.5175, -122.6750)]
+
+    def assertClose(self, expected, actual):
+        self.assertTrue(geo.numpy.allclose(expected, actual, equal_nan=True),
+                '%r != %r' % (expected, actual))
+
+    def test_coordinates(self):
+        lat, lng = geo.coordinates(self.history)
+        self.assertClose([45.5165, 45.5175, 45.5175, float('nan')], lat)
+        self.assertClose([-122.6764, -122.6764, -122.6750, float('nan')], lng)
+        self.assertClose(lat[:3], geo.coordinates(self.pairs)[0])
+        track = LocationTrack([dict(point, date_ts=n)
+                for n, point in enumerate(self.history['points'][:3])])
+        self.assertClose(lng[:3], geo.coordinates(track)[1])
+        self.assertEqual(0, len(geo.coordinates({'points': []})[0]))
+
+    def test_distances(self):
+        # They agree with the scalar distance
+        expected = [distance(a[0], a[1], b[0], b[1])
+                for a, b in zip(self.pairs, self.pairs[1:])]
+        self.assertClose(expected, geo.track_distances(self.pairs))
+        self.assertClose(expected, geo.track_distances(self.history)[:2])
+
+        matrix = geo.distance_matrix(self.pairs)
+        self.assertEqual((3, 3), matrix.shape)
+        self.assertClose(matrix, matrix.T)
+        self.assertClose([0, 0, 0], matrix.diagonal())
+        self.assertClose(expected[1], matrix[1, 2])
+        self.assertEqual((3, 1), geo.distance_matrix(self.pairs,
+                self.pairs[:1]).shape)
+
+        self.assertClose([0, 90, 180, 270], geo.bearing(0, 0,
+                [1, 0, -1, 0], [0, 1, 0, -1]))
+
+    def test_within(self):
+        places = [
+            {'place_id': 'a', 'latitude': 45.5165, 'longitude': -122.6764, 'radius': 100},
+            {'place_id': 'b', 'place': {'latitude': 45.5175,
+                    'longitude': -122.6757, 'radius': 100}},
+            {'place_id': 'c'},
+        ]
+        self.assertEqual([
+            [True, False, False],
+            [False, True, False],
+            [False, True, False],
+            [False, False, False],
+        ], geo.within(self.history, places).tolist())
+        self.assertEqual([[False, True]], geo.within(self.pairs[1:2],
+                [get_region(place) for place in places[:2]]).tolist())
+
+        south, west, north, east = geo.bounding_boxes([45.5165], [-122.6764], [100])
+        self.assertClose(100, distance(45.5165, -122.6764, north[0], -122.6764))
+        self.assertClose(100, distance(45.5165, -122.6764, 45.5165, east[0]))
+        self.assertEqual([True, False, False, False],
+                geo.in_bounding_box(self.history, 45.516, -122.677,
+                        45.517, -122.676).tolist())
+
+
+class RateLimiterTest(TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(10, capacity=2)
+
+        # A full bucket allows a burst, then refills at its rate
+        self.assertTrue(bucket.acquire(block=False))
+        self.assertTrue(bucket.acquire(block=False))
+        self.assertFalse(bucket.acquire(block=False))
+        self.assertTrue(0 < bucket.take() <= 0.1)
+
+        start = time.time()
+        self.assertTrue(bucket.acquire(timeout=1))
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertFalse(bucket.acquire(timeout=0.01))
+
+    def test_adaptive_rate(self):
+        bucket = TokenBucket(10, min_rate=2)
+
+        # Throttling halves the rate and pauses for Retry-After
+        bucket.throttled(0.5)
+        self.assertEqual(5, bucket.rate)
+        self.assertTrue(0.4 < bucket.take() <= 0.5)
+        bucket.throttled()
+        bucket.throttled()
+        self.assertEqual(2, bucket.rate)
+
+        # Successful requests restore it gradually
+        bucket.succeeded()
+        self.assertEqual(3, bucket.rate)
+        for n in range(20):
+            bucket.succeeded()
+        self.assertEqual(10, bucket.rate)
+
+    def test_file_token_bucket(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'bucket')
+
+            # Buckets backed by the same file share their tokens
+            one = FileTokenBucket(path, 1, capacity=2)
+            two = FileTokenBucket(path, 1, capacity=2)
+            self.assertTrue(one.acquire(block=False))
+            self.assertTrue(two.acquire(block=False))
+            self.assertFalse(one.acquire(block=False))
+
+            two.throttled()
+            self.assertEqual(0.5, one.rate)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_rate_limiter(self):
+        shared = TokenBucket(100)
+        updates = TokenBucket(1, capacity=1)
+        limiter = RateLimiter(shared, per_token=(10, 2),
+                prefixes={'location/': TokenBucket(100), 'location/update': updates},
+                block=False)
+
+        self.assertEqual([shared, updates],
+                limiter.get_buckets('location/update?foo=1'))
+        self.assertEqual(3, len(limiter.get_buckets('location/update', 'a')))
+
+        # A rejected request returns the tokens it already took
+        limiter.acquire('location/update', 'a')
+        self.assertRaises(RateLimitExceeded, limiter.acquire,
+                'location/update', 'a')
+        self.assertTrue(98 < shared.load()[0] < 99.1)
+
+        # Each access token has its own bucket
+        limiter.acquire('account/profile', 'a')
+        self.assertRaises(RateLimitExceeded, limiter.acquire,
+                'account/profile', 'a')
+        limiter.acquire('account/profile', 'b')
+
+        # 429 responses slow down every bucket involved
+        limiter.observe('account/profile', 'b',
+                HTTPError('', 429, '', {'Retry-After': '1'}, None))
+        self.assertEqual(50, shared.rate)
+        self.assertRaises(RateLimitExceeded, limiter.acquire, 'place/list')
+
+    def test_per_token_maxsize(self):
+        limiter = RateLimiter(per_token=(10, 2), maxsize=2)
+        a = limiter.get_buckets('foo/bar', 'a')[0]
+        b = limiter.get_buckets('foo/bar', 'b')[0]
+
+        # The least recently used access token's bucket is dropped
+        self.assertTrue(a is limiter.get_buckets('foo/bar', 'a')[0])
+        limiter.get_buckets('foo/bar', 'c')
+        self.assertEqual(['a', 'c'], list(limiter.tokens))
+        self.assertFalse(b is limiter.get_buckets('foo/bar', 'b')[0])
+
+    @patch.object(Session, 'execute')
+    @patch.object(Session, 'post')
+    def test_session(self, mock_post, mock_execute):
+        mock_post.return_value = {'access_token': 33187}
+        limiter = RateLimiter(TokenBucket(1, capacity=1), block=False)
+        session = Session('key', 'secret', rate_limiter=limiter)
+
+        mock_execute.side_effect = lambda *args: StringIO('{}')
+        session.run('foo/bar')
+        self.assertRaises(RateLimitExceeded, session.run, 'foo/bar')
+        self.assertEqual(1, mock_execute.call_count)
+
+
+class MetricsTest(TestCase):
+    def test_histogram(self):
+        histogram = Histogram()
+        self.assertEqual(None, histogram.percentile(50))
+
+        for n in range(1, 101):
+            histogram.add(n / 1000.0)
+
+        # Percentiles are accurate to within a bucket
+        stats = histogram.stats()
+        self.assertEqual(100, stats['count'])
+        self.assertAlmostEqual(0.0505, stats['mean'])
+        self.assertEqual(0.001, stats['min'])
+        self.assertEqual(0.1, stats['max'])
+        self.assertTrue(0.05 <= stats['p50'] <= 0.055)
+        self.assertTrue(0.095 <= stats['p95'] <= 0.1045)
+        self.assertTrue(0.099 <= stats['p99'] <= 0.1)
+
+    def test_record(self):
+        samples = []
+        metrics = Metrics(hooks=[samples.append, lambda sample: 1 / 0])
+        metrics.record({'path': 'place/list?count=5', 'sent': 10,
+                'received': 100, 'timings': {'total': 0.01}})
+        metrics.record({'path': 'place/list', 'error': 'not_found',
+                'timings': {'total': 0.03, 'decode': 0.001}})
+
+        # Paths are grouped by endpoint, and broken hooks are ignored
+        self.assertEqual(2, len(samples))
+        self.assertEqual('place/list', samples[0]['endpoint'])
+
+        stats = metrics.stats()['place/list']
+        self.assertEqual(2, stats['requests'])
+        self.assertEqual({'not_found': 1}, stats['errors'])
+        self.assertEqual((10, 100), (stats['sent'], stats['received']))
+        self.assertEqual(['decode', 'total'], sorted(stats['latency']))
+        self.assertEqual(0.03, stats['latency']['total']['max'])
+
+        metrics.reset()
+        self.assertEqual({}, metrics.stats())
+
+    @patch.object(Session, 'execute')
+    @patch.object(Session, 'post')
+    def test_session(self, mock_post, mock_execute):
+        mock_post.return_value = {'access_token': 33187}
+        samples = []
+        session = Session('key', 'secret', retry_policy=RetryPolicy(max_retries=0),
+                metrics=Metrics(hooks=[samples.append]))
+
+        def respond(*args):
+            f = StringIO(json.dumps({'result': 'ok'}))
+            f.timings = {'connect': 0.002, 'first_byte': 0.001}
+            return f
+        mock_execute.side_effect = respond
+        session.run('account/profile')
+        session.run('location/update', [{'latitude': 45.5}])
+
+        self.assertEqual('GET', samples[0]['method'])
+        self.assertEqual('POST', samples[1]['method'])
+        self.assertEqual(['connect', 'decode', 'first_byte', 'read', 'total'],
+                sorted(samples[0]['timings']))
+
+        # API errors are counted by their code, and connection errors too
+        mock_execute.side_effect = lambda *args: StringIO(json.dumps(
+                {'error': 'not_found'}))
+        session.run('account/profile')
+        mock_execute.side_effect = lambda *args: URLError('refused')
+        self.assertRaises(URLError, session.run, 'account/profile')
+
+        stats = session.stats()
+        self.assertEqual(3, stats['endpoints']['account/profile']['requests'])
+        self.assertEqual({'not_found': 1, 'connection_error': 1},
+                stats['endpoints']['account/profile']['errors'])
+        self.assertEqual(1, stats['endpoints']['location/update']['requests'])
+        self.assertTrue('transfer' in stats)
+
+        # Streams are recorded once they have been consumed
+        mock_execute.side_effect = lambda *args: StringIO('[1, 2]')
+        points = session.run('location/history', stream=True)
+        self.assertEqual(4, len(samples))
+        self.assertEqual([1, 2], list(points))
+        self.assertEqual(5, len(samples))
+
+
+class ConnectionPoolTest(TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(maxsize=2, idle_timeout=30)
+
+    @patch.object(ConnectionPool, 'connect')
+    def test_acquire_release(self, mock_connect):
+        conn = Mock()
+        mock_connect.return_value = conn
+
+        # An empty pool opens a new connection
+        self.assertEqual((conn, False),
+                self.pool.acquire('https', 'api.geoloqi.com'))
+        mock_connect.assert_called_with('https', 'api.geoloqi.com',
+                socket._GLOBAL_DEFAULT_TIMEOUT)
+
+        # A released connection is reused by the next request to the host
+        self.pool.release('https', 'api.geoloqi.com', conn)
+        self.assertEqual(1, self.pool.size())
+        self.assertEqual((conn, True),
+                self.pool.acquire('https', 'api.geoloqi.com'))
+        self.assertEqual(0, self.pool.size())
+
+        # But not by requests to other hosts
+        self.pool.release('https', 'api.geoloqi.com', conn)
+        self.assertEqual(False, self.pool.acquire('https', 'example.com')[1])
+
+    def test_maxsize(self):
+        conns = [Mock(), Mock(), Mock()]
+        for conn in conns:
+            self.pool.release('https', 'api.geoloqi.com', conn)
+
+        # Connections beyond the per-host limit are closed
+        self.assertEqual(2, self.pool.size())
+        self.assertFalse(conns[0].close.called)
+        self.assertTrue(conns[2].close.called)
+
+        self.pool.clear()
+        self.assertEqual(0, self.pool.size())
+        self.assertTrue(conns[0].close.called)
+
+    @patch.object(ConnectionPool, 'connect')
+    def test_idle_timeout(self, mock_connect):
+        stale = Mock()
+        self.pool.release('https', 'api.geoloqi.com', stale)
+
+        with patch.object(time, 'time', return_value=time.time() + 60):
+            conn, reused = self.pool.acquire('https', 'api.geoloqi.com')
+
+        # Connections idle for too long are closed rather than reused
+        self.assertFalse(reused)
+        self.assertTrue(stale.close.called)
+        self.assertEqual(mock_connect.return_value, conn)
+
+    def test_resend(self):
+        handler = PooledHandler(self.pool)
+
+        def request(data=None):
+            req = urllib2.Request('http://api.geoloqi.com/1/a', data)
+            req.timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+            return req
+
+        fresh = Mock(sock=None)
+        fresh.getresponse.return_value = Mock(status=200, reason='OK')
+
+        def stale(**kwargs):
+            conn = Mock(**kwargs)
+            self.pool.release('http', 'api.geoloqi.com', conn)
+            return conn
+
+        # A GET whose reused connection was closed is sent again
+        conn = stale(**{'getresponse.side_effect': httplib.BadStatusLine('')})
+        with patch.object(ConnectionPool, 'connect', return_value=fresh):
+            response = handler.http_open(request())
+        self.assertEqual(200, response.code)
+        self.assertTrue(conn.close.called)
+
+        # So is a POST that failed before it was written
+        stale(**{'request.side_effect': socket.error(32, 'Broken pipe')})
+        with patch.object(ConnectionPool, 'connect', return_value=fresh):
+            response = handler.http_open(request('{}'))
+        self.assertEqual(200, response.code)
+
+        # But not one the server may have received
+        stale(**{'getresponse.side_effect': httplib.BadStatusLine('')})
+        with patch.object(ConnectionPool, 'connect', return_value=fresh) \
+                as mock_connect:
+            self.assertRaises(URLError, handler.http_open, request('{}'))
+        self.assertFalse(mock_connect.called)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,150 @@
+"""
+An on-disk cache of OAuth access tokens shared between processes.
+"""
+import json
+import os
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class TokenCache:
+    """
+    Stores the access tokens issued to applications in a JSON file so that
+    new processes can reuse a valid token instead of asking the OAuth
+    server for another one.
+
+    Tokens are keyed by application api_key and stored along with their
+    refresh token and expiry time. Reads and writes hold an exclusive lock
+    on a companion `.lock` file, and the cache file is only readable by
+    its owner.
+    """
+    path = '~/.geoloqi_tokens'
+
+    def __init__(self, path=None):
+        """
+        Create a new token cache.
+
+        Args:
+            path: The file to store tokens in. Defaults to `~/.geoloqi_tokens`.
+        """
+        self.path = os.path.expanduser(path or self.path)
+
+    def get(self, api_key):
+        """
+        Look up the cached token for an application.
+
+        Args:
+            api_key: The application's Geoloqi API key.
+
+        Returns:
+            A dictionary of the OAuth response with an added 'expires_at'
+            timestamp, or None if there is no unexpired token.
+        """
+        lock = self.lock()
+        try:
+            entry = self.read().get(api_key)
+        finally:
+            self.unlock(lock)
+
+        if not entry or not entry.get('access_token'):
+            return None
+        if entry.get('expires_at') and entry['expires_at'] <= time.time():
+            return None
+        return entry
+
+    def set(self, api_key, auth, expires_at=None):
+        """
+        Store the token issued to an application.
+
+        Args:
+            api_key: The application's Geoloqi API key.
+            auth: The OAuth response containing the access and refresh tokens.
+            expires_at: An optional timestamp of when the access token expires.
+        """
+        entry = dict(auth)
+        entry['expires_at'] = expires_at
+
+        lock = self.lock()
+        try:
+            tokens = self.read()
+            tokens[api_key] = entry
+            self.write(tokens)
+        finally:
+            self.unlock(lock)
+
+    def update(self, api_key, func):
+        """
+        Replace the token of an application while holding the cache's lock,
+        so processes sharing the cache take turns, each seeing the token the
+        last one stored. Used to renew a token with the newest refresh token
+        when the server issues a new one with every renewal.
+
+        Args:
+            api_key: The application's Geoloqi API key.
+            func: A function called with the cached entry, or None, that
+                  returns a tuple of the OAuth response and its expiry
+                  timestamp to store, or None to leave the entry as it is.
+        """
+        lock = self.lock()
+        try:
+            tokens = self.read()
+            result = func(tokens.get(api_key))
+            if result is not None:
+                auth, expires_at = result
+                entry = tokens[api_key] = dict(auth)
+                entry['expires_at'] = expires_at
+                self.write(tokens)
+        finally:
+            self.unlock(lock)
+
+    def delete(self, api_key):
+        """
+        Forget the token issued to an application.
+
+        Args:
+            api_key: The application's Geoloqi API key.
+        """
+        lock = self.lock()
+        try:
+            tokens = self.read()
+            if tokens.pop(api_key, None) is not None:
+                self.write(tokens)
+        finally:
+            self.unlock(lock)
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write(self, tokens):
+        # Write to a temporary file first so readers never see a partial file
+        directory = os.path.dirname(self.path) or '.'
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.geoloqi_tokens')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(tokens, f)
+            os.chmod(temp, 0600)
+            os.rename(temp, self.path)
+        except:
+            os.unlink(temp)
+            raise
+
+    def lock(self):
+        if fcntl is None:
+            return None
+        f = open(self.path + '.lock', 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def unlock(self, lock):
+        if lock is not None:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
@@ -0,0 +1,182 @@
+"""
+Compact, columnar storage of location history.
+"""
+import array
+import bisect
+
+from collections import namedtuple
+from itertools import izip
+from location import point_time
+
+# The columns of a track, their array type codes and the keys of the
+# location's 'position' they are read from
+COLUMNS = (
+    ('timestamp', 'd', None),
+    ('latitude', 'd', 'latitude'),
+    ('longitude', 'd', 'longitude'),
+    ('accuracy', 'f', 'horizontal_accuracy'),
+    ('speed', 'f', 'speed'),
+    ('altitude', 'f', 'altitude'),
+    ('heading', 'f', 'heading'),
+)
+
+TrackPoint = namedtuple('TrackPoint', [name for name, code, key in COLUMNS])
+
+NAN = float('nan')
+
+
+def get_row(point):
+    """
+    Read the column values of a location history point.
+
+    Returns:
+        A tuple of values in the order of `COLUMNS`. Missing values are NaN.
+
+    Raises:
+        ValueError: If the point has no time.
+    """
+    timestamp = point_time(point)
+    if timestamp is None:
+        raise ValueError('The point has no date.')
+
+    pos = point.get('location', {}).get('position', point)
+    row = [timestamp]
+    for name, code, key in COLUMNS[1:]:
+        value = pos.get(key)
+        try:
+            row.append(value is None and NAN or float(value))
+        except (TypeError, ValueError):
+            row.append(NAN)
+    return tuple(row)
+
+
+class LocationTrack:
+    """
+    A track of location history points stored in typed arrays, one per
+    column, which takes a small fraction of the memory of the points'
+    dictionaries. Each column is an attribute holding an `array.array`:
+
+    ::
+
+        >>> track = g.location_track({'after': 1331000000})
+        >>> track.latitude[0], track.speed[-1]
+        >>> morning = track.between(1331020800, 1331064000)
+
+    Points must be added oldest first, as `Geoloqi.iter_history` returns
+    them, so tracks can be sliced by time with a binary search. Only the
+    columns in `COLUMNS` are kept.
+    """
+
+    def __init__(self, points=None):
+        """
+        Create a new track.
+
+        Args:
+            points: An optional list of location history points to add.
+        """
+        for name, code, key in COLUMNS:
+            setattr(self, name, array.array(code))
+        if points:
+            self.extend(points)
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __iter__(self):
+        return (TrackPoint(*row) for row in self.rows())
+
+    def __getitem__(self, index):
+        """
+        Read a point, or a slice of the track.
+
+        Returns:
+            A `TrackPoint`, or a new `LocationTrack` given a slice.
+        """
+        if isinstance(index, slice):
+            return self.copy(index)
+        return TrackPoint(*[getattr(self, name)[index] for name, code, key in COLUMNS])
+
+    def rows(self):
+        return izip(*[getattr(self, name) for name, code, key in COLUMNS])
+
+    def append(self, point):
+        """
+        Add a point to the end of the track.
+
+        Args:
+            point: A location history point.
+
+        Raises:
+            ValueError: If the point has no time or is older than the last.
+        """
+        self.extend([point])
+
+    def extend(self, points):
+        """
+        Add points, such as a page of location history, to the end of the
+        track.
+
+        Args:
+            points: A list of location history points, oldest first.
+
+        Raises:
+            ValueError: If a point has no time or is out of order. No points
+                        are added then.
+        """
+        rows = [get_row(point) for point in points]
+        if not rows:
+            return
+
+        last = rows[0][0]
+        if len(self):
+            last = self.timestamp[-1]
+        for row in rows:
+            if row[0] < last:
+                raise ValueError('Points must be added oldest first.')
+            last = row[0]
+
+        for (name, code, key), values in zip(COLUMNS, zip(*rows)):
+            getattr(self, name).fromlist(list(values))
+
+    def copy(self, index=slice(None)):
+        """
+        Copy the track, or a slice of its points.
+        """
+        track = LocationTrack()
+        for name, code, key in COLUMNS:
+            setattr(track, name, getattr(self, name)[index])
+        return track
+
+    def find(self, timestamp):
+        """
+        Find the position of the first point at or after a time.
+
+        Returns:
+            The point's index, or the track's length if there is none.
+        """
+        return bisect.bisect_left(self.timestamp, timestamp)
+
+    def between(self, start=None, end=None):
+        """
+        Slice the track by time with a binary search.
+
+        Args:
+            start: The earliest timestamp to include.
+            end: The timestamp to stop before.
+
+        Returns:
+            A new `LocationTrack` of the points in the time range.
+        """
+        first, last = 0, len(self)
+        if start is not None:
+            first = self.find(start)
+        if end is not None:
+            last = max(first, self.find(end))
+        return self.copy(slice(first, last))
+
+    def nbytes(self):
+        """
+        Count the bytes taken by the track's points.
+        """
+        return sum(len(column) * column.itemsize
+                for column in [getattr(self, name) for name, code, key in COLUMNS])
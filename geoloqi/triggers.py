@@ -0,0 +1,277 @@
+"""
+Local evaluation of radius triggers and places against device positions.
+"""
+import math
+import threading
+
+from collections import namedtuple
+from location import METERS_PER_DEGREE, distance
+
+Region = namedtuple('Region', 'id latitude longitude radius record')
+
+
+def get_region(record):
+    """
+    Find the circle of a trigger or place record from the API, whose
+    position and radius may either be at the top level or in its 'place'.
+
+    Args:
+        record: A trigger or place as a dictionary.
+
+    Returns:
+        A `Region`, or None if the record has no position and radius.
+    """
+    circle = record
+    if 'latitude' not in circle and isinstance(record.get('place'), dict):
+        circle = record['place']
+
+    region_id = record.get('trigger_id') or record.get('place_id')
+    try:
+        return Region(region_id, float(circle['latitude']),
+                float(circle['longitude']), float(circle['radius']), record)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class TriggerIndex:
+    """
+    A thread-safe spatial index of circular regions, such as radius
+    triggers and places, that finds the regions containing a point without
+    checking every region.
+
+    The index is a grid of `cell_size` degree cells, like a geohash grid.
+    Each region is listed in every cell its bounding box touches, so a
+    lookup only measures the distance to the regions in the point's cell.
+    Regions that would cover more than `max_cells` cells are listed in a
+    coarser grid instead, whose cells are `scale` times larger, and so on
+    for `levels` grids. The grids don't wrap around the 180th meridian, so
+    regions across it are only found on the side their center is on.
+
+    ::
+
+        >>> index = g.trigger_index()
+        >>> [region.id for region in index.containing(45.5165, -122.6764)]
+    """
+    cell_size = 0.005
+    max_cells = 16
+    scale = 4
+    levels = 6
+
+    def __init__(self, regions=None, cell_size=None, max_cells=None):
+        """
+        Create a new index.
+
+        Args:
+            regions: An optional list of trigger or place records to add.
+            cell_size: The size of the finest grid's cells in degrees.
+            max_cells: The most cells a region is listed in, unless it is
+                       too large for even the coarsest grid.
+        """
+        if cell_size is not None:
+            self.cell_size = cell_size
+        if max_cells is not None:
+            self.max_cells = max_cells
+
+        self.lock = threading.Lock()
+        self.sizes = [self.cell_size * self.scale ** level
+                for level in range(self.levels)]
+        self.grids = [{} for size in self.sizes]
+        self.regions = {}
+        if regions:
+            self.load(regions)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __contains__(self, region_id):
+        return region_id in self.regions
+
+    def get_cells(self, region):
+        """
+        Find the grid a region is listed in, and the cells of it that the
+        region's bounding box touches.
+
+        Returns:
+            A tuple of the grid's level and a list of cells.
+        """
+        dlat = region.radius / METERS_PER_DEGREE
+        cos = math.cos(math.radians(min(89.0, abs(region.latitude))))
+        dlng = min(180.0, dlat / cos)
+
+        for level, size in enumerate(self.sizes):
+            low_lat = int(math.floor((region.latitude - dlat) / size))
+            high_lat = int(math.floor((region.latitude + dlat) / size))
+            low_lng = int(math.floor((region.longitude - dlng) / size))
+            high_lng = int(math.floor((region.longitude + dlng) / size))
+            if (high_lat - low_lat + 1) * (high_lng - low_lng + 1) <= self.max_cells:
+                break
+
+        return level, [(x, y) for x in xrange(low_lat, high_lat + 1)
+                for y in xrange(low_lng, high_lng + 1)]
+
+    def add(self, region):
+        """
+        Add a region to the index, replacing any region with the same id.
+
+        Args:
+            region: A `Region`.
+        """
+        level, cells = self.get_cells(region)
+        grid = self.grids[level]
+        entry = (region.latitude, region.longitude, region.radius, region)
+        with self.lock:
+            self.discard(region.id)
+            self.regions[region.id] = region
+            for cell in cells:
+                grid.setdefault(cell, []).append(entry)
+
+    def load(self, records):
+        """
+        Add trigger or place records from the API to the index. Records
+        without a position and radius are skipped.
+
+        Args:
+            records: An iterable of records (example: the 'triggers' of a
+                     'trigger/list' response).
+
+        Returns:
+            The number of regions added.
+        """
+        added = 0
+        for record in records:
+            region = get_region(record)
+            if region is not None:
+                self.add(region)
+                added += 1
+        return added
+
+    def remove(self, region_id):
+        """
+        Remove a region from the index.
+
+        Args:
+            region_id: The id of the trigger or place.
+        """
+        with self.lock:
+            self.discard(region_id)
+
+    def discard(self, region_id):
+        region = self.regions.pop(region_id, None)
+        if region is None:
+            return
+
+        level, cells = self.get_cells(region)
+        grid = self.grids[level]
+        entry = (region.latitude, region.longitude, region.radius, region)
+        for cell in cells:
+            regions = grid[cell]
+            regions.remove(entry)
+            if not regions:
+                del grid[cell]
+
+    def containing(self, latitude, longitude):
+        """
+        Find the regions a point falls inside.
+
+        Args:
+            latitude: The point's latitude.
+            longitude: The point's longitude.
+
+        Returns:
+            A list of `Region` tuples, nearest center first.
+        """
+        # Meters in a degree of longitude at the point's latitude
+        meters_lng = METERS_PER_DEGREE * math.cos(math.radians(latitude))
+
+        # Copy the point's cells, so regions can be added and removed while
+        # they are measured
+        candidates = []
+        with self.lock:
+            for size, grid in zip(self.sizes, self.grids):
+                if not grid:
+                    continue
+                cell = (int(math.floor(latitude / size)),
+                        int(math.floor(longitude / size)))
+                candidates.extend(grid.get(cell, ()))
+
+        found = []
+        for lat, lng, radius, region in candidates:
+            # Most candidates are ruled out by their bounding box alone
+            if abs(latitude - lat) * METERS_PER_DEGREE > radius or \
+                    abs(longitude - lng) * meters_lng > radius:
+                continue
+            meters = distance(latitude, longitude, lat, lng)
+            if meters <= radius:
+                found.append((meters, region))
+        found.sort()
+        return [region for meters, region in found]
+
+
+class TriggerTracker:
+    """
+    Follows devices through a `TriggerIndex`, reporting the regions each
+    device enters and exits as its positions arrive.
+
+    ::
+
+        >>> tracker = TriggerTracker(index)
+        >>> entered, exited = tracker.update(45.5165, -122.6764, device='truck-12')
+    """
+
+    def __init__(self, index):
+        """
+        Create a new tracker.
+
+        Args:
+            index: The `TriggerIndex` to evaluate positions against.
+        """
+        self.index = index
+        self.lock = threading.Lock()
+        self.inside = {}
+
+    def update(self, latitude, longitude, device=None):
+        """
+        Move a device to a new position.
+
+        Args:
+            latitude: The device's latitude.
+            longitude: The device's longitude.
+            device: An optional identifier of the device.
+
+        Returns:
+            A tuple of the lists of regions the device entered and exited.
+        """
+        regions = self.index.containing(latitude, longitude)
+        current = dict((region.id, region) for region in regions)
+
+        with self.lock:
+            previous = self.inside.get(device, {})
+            if current:
+                self.inside[device] = current
+            else:
+                self.inside.pop(device, None)
+
+        entered = [region for region in regions if region.id not in previous]
+        exited = [region for region_id, region in previous.items()
+                if region_id not in current]
+        return entered, exited
+
+    def inside_regions(self, device=None):
+        """
+        List the regions a device was last found inside.
+
+        Args:
+            device: An optional identifier of the device.
+
+        Returns:
+            A list of `Region` tuples.
+        """
+        with self.lock:
+            return self.inside.get(device, {}).values()
+
+    def forget(self, device=None):
+        """
+        Stop tracking a device.
+        """
+        with self.lock:
+            self.inside.pop(device, None)
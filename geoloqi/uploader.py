@@ -0,0 +1,309 @@
+"""
+Buffered, bulk uploading of location updates.
+"""
+import threading
+import time
+
+from Queue import Empty, Queue
+from location import distance, position
+
+
+class LocationUploader:
+    """
+    Collects location updates in memory and posts them to the
+    'location/update' endpoint in bulk from a background thread.
+
+    A flush happens once `batch_size` points are buffered, once the oldest
+    buffered point is `max_age` seconds old, or when `flush` is called. A
+    point from the same device that arrives within `coalesce_seconds` of
+    the previous one and within `coalesce_distance` meters of it replaces
+    the previous point instead of being sent as well.
+
+    Points wait in a queue of at most `queue_size` points on their way to
+    the background thread. When the queue is full, `add` blocks until there
+    is room, or raises `Queue.Full` if asked not to block.
+
+    An optional `TrackSimplifier` drops each device's redundant points as
+    they are buffered and simplifies its track before each flush. Points
+    without a device are left as they are.
+
+    ::
+
+        >>> uploader = g.uploader(batch_size=200, max_age=5)
+        >>> uploader.add(point, device='truck-12')
+        >>> uploader.close()
+    """
+    batch_size = 100
+    max_age = 10
+    queue_size = 10000
+    coalesce_seconds = 5
+    coalesce_distance = 10
+
+    def __init__(self, session, batch_size=None, max_age=None, queue_size=None,
+            coalesce_seconds=None, coalesce_distance=None, on_error=None,
+            simplifier=None):
+        """
+        Create a new uploader and start its background thread.
+
+        Args:
+            session: The `Session` used to post the points.
+            batch_size: The number of points that triggers a flush.
+            max_age: The number of seconds a point may wait before a flush.
+            queue_size: The maximum number of points waiting to be buffered.
+            coalesce_seconds: The time window for coalescing points.
+            coalesce_distance: The distance in meters for coalescing points.
+            on_error: An optional function called with the points and the
+                      error response or exception when a flush fails.
+            simplifier: An optional `TrackSimplifier` for devices' points.
+        """
+        self.session = session
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if max_age is not None:
+            self.max_age = max_age
+        if queue_size is not None:
+            self.queue_size = queue_size
+        if coalesce_seconds is not None:
+            self.coalesce_seconds = coalesce_seconds
+        if coalesce_distance is not None:
+            self.coalesce_distance = coalesce_distance
+        self.on_error = on_error
+        self.simplifier = simplifier
+
+        self.queue = Queue(self.queue_size)
+        self.buffer = []
+        self.devices = []
+        self.latest = {}
+        self.oldest = None
+
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = {
+            'added': 0,
+            'coalesced': 0,
+            'sent': 0,
+            'failed': 0,
+            'flushes': 0,
+            'errors': 0,
+        }
+        self.flush_time = 0.0
+        self.last_flush_time = None
+
+        # Held while checking `closed` and queueing, so nothing is queued
+        # after the close
+        self.close_lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self.process)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, point, device=None, block=True, timeout=None):
+        """
+        Queue a location update to be uploaded.
+
+        Args:
+            point: The location update as a dictionary.
+            device: An optional identifier of the device that reported the
+                    point, used to coalesce near-duplicate points.
+            block: Wait for room in the queue if it is full.
+            timeout: The maximum number of seconds to wait for room.
+
+        Raises:
+            Queue.Full: If the queue is full and blocking wasn't allowed or
+                        timed out.
+            ValueError: If the uploader has been closed.
+        """
+        with self.close_lock:
+            if self.closed:
+                raise ValueError('The uploader has been closed.')
+            self.queue.put((point, device, time.time()), block, timeout)
+        with self.lock:
+            self.counts['added'] += 1
+
+    def flush(self, timeout=None):
+        """
+        Upload every queued point, waiting until the upload has finished.
+
+        Args:
+            timeout: The maximum number of seconds to wait.
+
+        Returns:
+            True if the flush finished within the timeout.
+
+        Raises:
+            ValueError: If the uploader has been closed.
+        """
+        done = threading.Event()
+        with self.close_lock:
+            if self.closed:
+                raise ValueError('The uploader has been closed.')
+            self.queue.put((None, None, done))
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        """
+        Upload every queued point and stop the background thread.
+
+        Args:
+            timeout: The maximum number of seconds to wait.
+        """
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put((None, None, None))
+        self.thread.join(timeout)
+
+    def process(self):
+        """
+        Move points from the queue into the buffer, flushing as needed. This
+        runs on the uploader's background thread.
+        """
+        while True:
+            wait = None
+            if self.oldest is not None:
+                wait = max(0, self.oldest + self.max_age - time.time())
+
+            try:
+                point, device, received = self.queue.get(True, wait)
+            except Empty:
+                self.attempt(self.send)
+                continue
+
+            if point is not None:
+                if not self.attempt(self.buffer_point, point, device, received):
+                    with self.lock:
+                        self.counts['failed'] += 1
+                if len(self.buffer) >= self.batch_size:
+                    self.attempt(self.send)
+            elif received is not None:
+                # An explicit flush, carrying the event to set once done
+                self.attempt(self.send)
+                received.set()
+            else:
+                self.attempt(self.send)
+                return
+
+    def attempt(self, func, *args):
+        """
+        Call a function on the background thread, counting any exception it
+        raises, such as from `on_error`, rather than letting it stop the
+        thread.
+
+        Returns:
+            True if the function didn't raise an exception.
+        """
+        try:
+            func(*args)
+            return True
+        except Exception:
+            with self.lock:
+                self.counts['errors'] += 1
+            return False
+
+    def buffer_point(self, point, device, received):
+        """
+        Add a point to the buffer, replacing the device's previous point if
+        the new one is a near duplicate of it.
+        """
+        if self.simplifier is not None and device is not None and \
+                not self.simplifier.accept(point, device, received):
+            return
+
+        if device is not None:
+            previous = self.latest.get(device)
+            if previous is not None and self.is_duplicate(previous, point, received):
+                index = previous[0]
+                self.buffer[index] = point
+                self.latest[device] = (index, point, received)
+                with self.lock:
+                    self.counts['coalesced'] += 1
+                return
+            self.latest[device] = (len(self.buffer), point, received)
+
+        if self.oldest is None:
+            self.oldest = received
+        self.buffer.append(point)
+        self.devices.append(device)
+
+    def is_duplicate(self, previous, point, received):
+        index, last_point, last_received = previous
+        if received - last_received > self.coalesce_seconds:
+            return False
+
+        a, b = position(last_point), position(point)
+        if a is None or b is None:
+            return False
+        return distance(a[0], a[1], b[0], b[1]) <= self.coalesce_distance
+
+    def send(self):
+        """
+        Post the buffered points to the API server.
+        """
+        points, self.buffer = self.buffer, []
+        devices, self.devices = self.devices, []
+        self.latest = {}
+        self.oldest = None
+        if not points:
+            return
+
+        start = time.time()
+        try:
+            if self.simplifier is not None:
+                points = self.simplify(points, devices)
+                if not points:
+                    return
+            response = self.session.post('location/update', points)
+            error = isinstance(response, dict) and response.has_key('error') \
+                    and response or None
+        except Exception, e:
+            error = e
+        elapsed = time.time() - start
+
+        with self.lock:
+            self.counts['flushes'] += 1
+            self.counts[error is None and 'sent' or 'failed'] += len(points)
+            self.flush_time += elapsed
+            self.last_flush_time = elapsed
+
+        if error is not None and self.on_error:
+            self.on_error(points, error)
+
+    def simplify(self, points, devices):
+        """
+        Simplify each device's buffered track.
+        """
+        tracks = {}
+        for point, device in zip(points, devices):
+            if device is not None:
+                tracks.setdefault(device, []).append(point)
+
+        kept = set()
+        for device, track in tracks.items():
+            kept.update(id(point) for point in self.simplifier.simplify(track, device))
+        return [point for point, device in zip(points, devices)
+                if device is None or id(point) in kept]
+
+    def stats(self):
+        """
+        Report the uploader's progress.
+
+        Returns:
+            A dictionary of point and flush counts, the number of exceptions
+            raised on the background thread, the current queue depth,
+            the throughput in points sent per second and the mean and most
+            recent flush latency in seconds. With a simplifier, its reports
+            of each device's dropped points are under 'simplifier'.
+        """
+        with self.lock:
+            stats = dict(self.counts)
+            stats.update({
+                'queue_depth': self.queue.qsize(),
+                'buffered': len(self.buffer),
+                'throughput': stats['sent'] / max(time.time() - self.started, 1e-6),
+                'flush_latency': stats['flushes'] and self.flush_time / stats['flushes'] or 0.0,
+                'last_flush_latency': self.last_flush_time,
+            })
+        if self.simplifier is not None:
+            stats['simplifier'] = self.simplifier.stats()
+        return stats
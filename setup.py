@@ -17,6 +17,10 @@ setup(
     author_email='tristan.waddington@gmail.com',
     url='https://github.com/geoloqi/geoloqi-python',
     packages=['geoloqi',],
+    extras_require={
+        # The vectorized calculations in geoloqi.geo
+        'geo': ['numpy'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta', # 4 Beta, 5 Production/Stable
         'Environment :: Console',